@@ -0,0 +1,157 @@
+# assetmanager.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the asset manager, which loads the game's images. Loading
+# happens on a background thread, so snowfall_client can start it before it
+# connects to the server and the PNGs get read while the handshake runs. All
+# of the sprites are packed into one texture atlas, which is converted to the
+# display's pixel format once the window exists, so blits don't have to
+# convert pixels every frame. The atlas can also be cached on disk, which turns
+# ~25 PNG loads into one on later runs.
+
+import hashlib
+import json
+import os
+import threading
+import pygame
+
+ASSET_DIR = './assets'
+ATLAS_WIDTH = 1024
+
+JUDGMENT_FILES = {
+    "Excellent": 'EXCELLENT.png',
+    "Very Good": 'VERYGOOD.png',
+    "Good": 'GOOD.png',
+    "Fair": 'FAIR.png',
+    "Poor": 'POOR.png',
+    "No Credit": 'NOCREDIT.png',
+}
+KEY_NAMES = {1: 'q', 2: 'w', 3: 'e', 4: 'r', 5: 'o', 6: 'p', 7: '[', 8: ']'}
+NOTE_SIZE = (64, 62)
+
+# every sprite in the atlas: name -> (file name, size to scale to or None)
+SPRITES = {f"judgment/{judgment}": (file, None)
+           for judgment, file in JUDGMENT_FILES.items()}
+SPRITES.update({f"press/{lane}": (f"{key}_press.png", None)
+                for lane, key in KEY_NAMES.items()})
+SPRITES.update({f"limit/{lane}": (f"{key}_limit.png", None)
+                for lane, key in KEY_NAMES.items()})
+SPRITES["body"] = ('long_p1.png', None)
+SPRITES["note"] = ('note_p1.png', NOTE_SIZE)
+BACKGROUND_FILE = 'main_screen.png' # full-screen, so kept out of the atlas
+
+
+def pack(sizes, width=ATLAS_WIDTH):
+    """ Shelf-pack rectangles of the given sizes into rows at most width wide.
+    Returns (name -> (x, y, w, h), total height). """
+    layout = {}
+    x = y = shelf_height = 0
+    # tallest first keeps the shelves tight
+    for name, (w, h) in sorted(sizes.items(), key=lambda item: -item[1][1]):
+        if x + w > width: # start a new shelf
+            x, y = 0, y + shelf_height
+            shelf_height = 0
+        layout[name] = (x, y, w, h)
+        x += w
+        shelf_height = max(shelf_height, h)
+    return layout, y + shelf_height
+
+
+class AssetManager:
+    def __init__(self, asset_dir=ASSET_DIR, cache_dir=None):
+        self.asset_dir = asset_dir
+        self.cache_dir = cache_dir # None -> don't cache the atlas on disk
+        self.thread = None
+        self.error = None # exception from the loading thread, if any
+        self.atlas = None
+        self.layout = None
+        self.background = None
+        self.loaded = False
+
+    def start(self):
+        """ Start loading images on a background thread. """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._load, daemon=True)
+            self.thread.start()
+
+    def _path(self, file):
+        return os.path.join(self.asset_dir, file)
+
+    def _cache_key(self):
+        """ Hash of every source image's name, size and modification time, so
+        a cached atlas is thrown out when any of them changes. """
+        digest = hashlib.sha1()
+        for name, (file, size) in sorted(SPRITES.items()):
+            stat = os.stat(self._path(file))
+            digest.update(f"{name}:{file}:{size}:{stat.st_size}:"
+                          f"{stat.st_mtime_ns};".encode())
+        return digest.hexdigest()
+
+    def _load(self):
+        """ Loading thread: read the atlas from the cache, or load every
+        sprite and pack them. """
+        try:
+            self.background = pygame.image.load(self._path(BACKGROUND_FILE))
+            cache_base = None
+            if self.cache_dir is not None:
+                cache_base = os.path.join(self.cache_dir,
+                                          f"atlas-{self._cache_key()}")
+                if os.path.exists(cache_base + ".json"):
+                    with open(cache_base + ".json", 'r') as file:
+                        self.layout = {name: tuple(rect) for name, rect
+                                       in json.load(file).items()}
+                    self.atlas = pygame.image.load(cache_base + ".png")
+                    return
+            images = {}
+            loaded = {} # file -> image, for sprites that share a file
+            for name, (file, size) in SPRITES.items():
+                if file not in loaded:
+                    loaded[file] = pygame.image.load(self._path(file))
+                image = loaded[file]
+                if size is not None:
+                    image = pygame.transform.scale(image, size)
+                images[name] = image
+            self.layout, height = pack({name: image.get_size()
+                                        for name, image in images.items()})
+            self.atlas = pygame.Surface((ATLAS_WIDTH, height), pygame.SRCALPHA)
+            for name, image in images.items():
+                x, y, _, _ = self.layout[name]
+                # adding onto a fully transparent surface copies the pixels
+                # exactly, without blending the alpha twice
+                self.atlas.blit(image, (x, y),
+                                special_flags=pygame.BLEND_RGBA_ADD)
+            if cache_base is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                pygame.image.save(self.atlas, cache_base + ".png")
+                with open(cache_base + ".json", 'w') as file:
+                    json.dump(self.layout, file)
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """ Wait for loading to finish and convert everything to the display's
+        pixel format. Must be called after the display mode is set. """
+        if self.loaded:
+            return
+        self.start()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.atlas = self.atlas.convert_alpha()
+        self.background = self.background.convert()
+        sprites = {name: self.atlas.subsurface(rect)
+                   for name, rect in self.layout.items()}
+        # same names the images used to have as module globals in client.py
+        self.judgment_images = {judgment: sprites[f"judgment/{judgment}"]
+                                for judgment in JUDGMENT_FILES}
+        self.key_images = {lane: sprites[f"press/{lane}"]
+                           for lane in KEY_NAMES}
+        self.key_limit_images = {lane: sprites[f"limit/{lane}"]
+                                 for lane in KEY_NAMES}
+        self.body_image = sprites["body"]
+        self.head_image = sprites["note"]
+        self.note_image = sprites["note"]
+        self.background_image = self.background
+        self.loaded = True
@@ -0,0 +1,257 @@
+# async_server.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the asyncio engine for snowfall_server (run it with
+# --engine asyncio). It speaks exactly the same protocol as the threaded
+# engine: the same handshake as connect_client, then binary hit messages (see
+# protocol.py). Every connection gets one reader task, and everything runs on
+# one event loop thread, so the Server object is still the single point of
+# truth and it decides who gets told about a hit. Since only the loop thread
+# touches it, hits go through push_hit/apply_hits without taking a lock.
+# Writes never block: each message is handed to the connection's transport,
+# and a client whose unsent backlog grows past max_backlog bytes is dropped
+# instead of holding up everyone else.
+
+import asyncio
+import struct
+import chartcache
+import sys
+import time
+from notetable import JUDGMENTS
+import clocksync
+from clocksync import HANDSHAKE_SAMPLES
+from protocol import HEADER, HIT, SIZES, TIME_REQUEST, VERSION, encode_hit, \
+    decode_hit
+
+# unsent bytes we'll hold for one client before deciding it's too slow
+DEFAULT_MAX_BACKLOG = 64 * 1024
+
+class Player:
+    """ One connected client during a match. """
+    def __init__(self, index, name, rtt, reader, writer, max_backlog):
+        self.index = index
+        self.name = name
+        self.rtt = rtt
+        self.reader = reader
+        self.writer = writer
+        self.max_backlog = max_backlog
+        self.connected = True
+
+    def send(self, message):
+        """ Queue message on the connection without waiting. Returns False
+        (and drops the client) if the client isn't keeping up. """
+        if not self.connected:
+            return False
+        self.writer.write(message)
+        if self.writer.transport.get_write_buffer_size() > self.max_backlog:
+            print(f"Client {self.name} is too far behind, disconnecting.",
+                  file=sys.stderr)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.writer.close()
+
+
+async def handshake(reader, writer, blobs):
+    """ The same handshake connect_client does: get the client's name,
+    confirm the connection, send the chart and audio if the client needs them
+    (blobs, see chartcache.py), and answer time requests so the client can
+    sync its clock. Returns (name, rtt), or None if the client didn't follow
+    the protocol. The start time is sent afterwards by send_start. """
+    try:
+        writer.write(b"Retrieving client name...")
+        name_length = struct.unpack("!I", await reader.readexactly(4))[0]
+        client_name = (await reader.readexactly(name_length)).decode('utf-8')
+        client_name = client_name.strip()
+        print(f"This player has joined:", client_name)
+        # confirm connection
+        writer.write(b"Connection Established")
+        if await reader.readexactly(3) != b"ACK":
+            print(f"{client_name} did not acknowledge connection!",
+                  file=sys.stderr)
+            return None
+        # hand over the chart and audio, if the client doesn't have them
+        sent = await chartcache.offer_async(reader, writer, blobs)
+        if sent:
+            print(f"Sent {', '.join(sent)} to {client_name}")
+        # sync clocks: the client sends time requests and we answer each one
+        writer.write(b"ping!")
+        rtt = None
+        answered = None # when we answered the last request
+        for _ in range(HANDSHAKE_SAMPLES):
+            message = await read_message(reader)
+            received = time.time()
+            if message is None or message[0] != TIME_REQUEST:
+                print(f"{client_name} disconnected before syncing clocks.",
+                      file=sys.stderr)
+                return None
+            # the client asks again as soon as it hears back, so the time from
+            # one answer to the next request is about one round trip
+            if answered is not None and (rtt is None or 
+                                         received - answered < rtt):
+                rtt = received - answered
+            writer.write(clocksync.answer(message[1], received))
+            answered = time.time()
+        print(f"{client_name} has ping {rtt}")
+        return client_name, rtt
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+        print(f"Client disconnected during handshake: {e}", file=sys.stderr)
+        return None
+
+
+async def send_start(reader, writer, name, future_time):
+    """ Send the start time (on our clock; the client converts it to its own)
+    and wait for the client to acknowledge it. Returns False if the client
+    went away. """
+    try:
+        writer.write(struct.pack("!d", future_time))
+        if await reader.readexactly(3) != b"ACK":
+            print(f"{name} did not acknowledge future time!", file=sys.stderr)
+        return True
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        print(f"{name} disconnected before the start time: {e}",
+              file=sys.stderr)
+        return False
+
+
+async def start_match(connections, blobs, max_backlog):
+    """ Handshake every connection at once, then send everyone the same start
+    time, 3 seconds from when the last one finished. Returns a Player for
+    each client that made it through (the rest are closed) and the start
+    time. """
+    results = await asyncio.gather(*(handshake(reader, writer, blobs)
+                                     for reader, writer in connections))
+    future_time = time.time() + 3
+
+    async def start(reader, writer, result):
+        if result is None or \
+                not await send_start(reader, writer, result[0], future_time):
+            writer.close()
+            return None
+        return result
+
+    results = await asyncio.gather(*(start(reader, writer, result)
+                                     for (reader, writer), result
+                                     in zip(connections, results)))
+    players = []
+    for (reader, writer), result in zip(connections, results):
+        if result is not None:
+            name, rtt = result
+            players.append(Player(len(players), name, rtt, reader, writer,
+                                  max_backlog))
+    return players, future_time
+
+
+async def read_message(reader):
+    """ Read one whole protocol message. Returns (message type, message bytes),
+    or None if the connection closed or sent something invalid. """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        version, message_type = HEADER.unpack(header)
+        if version != VERSION or message_type not in SIZES:
+            print(f"Bad message header {header!r}", file=sys.stderr)
+            return None
+        rest = await reader.readexactly(SIZES[message_type] - HEADER.size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return message_type, header + rest
+
+
+async def player_reader(server, player, players):
+    """ Reader task for one player: score every hit they send, and pass it on
+    to everyone if the server says so. """
+    metrics = server.metrics
+
+    def broadcast(hit_player, note_id, code):
+        # one encoded message, written to every client
+        message = encode_hit(hit_player, note_id, code)
+        for other in players:
+            if other.send(message):
+                metrics.sent(len(message))
+
+    while player.connected:
+        message = await read_message(player.reader)
+        if message is None: # client DC
+            print(f"Client {player.name} disconnected.", file=sys.stderr)
+            break
+        message_type, message_bytes = message
+        if message_type == TIME_REQUEST:
+            metrics.received("time_request", len(message_bytes))
+            # answer right away, so the client's sample is accurate
+            answer = clocksync.answer(message_bytes, time.time())
+            if player.send(answer):
+                metrics.sent(len(answer))
+            continue
+        if message_type != HIT:
+            metrics.received("bad", len(message_bytes))
+            continue
+        # first is the player index, which the client doesn't know
+        _, note_id, note_judgment = decode_hit(message_bytes)
+        if not server.has_note(note_id) or \
+                not 0 <= note_judgment < len(JUDGMENTS):
+            print(f"Error parsing message from {player.name}: "
+                  f"bad note {note_id} or judgment {note_judgment}",
+                  file=sys.stderr)
+            metrics.received("bad", len(message_bytes))
+            continue
+        metrics.received("hit", len(message_bytes))
+        # the event loop thread owns the server, so no lock is needed
+        if not server.push_hit(note_id, note_judgment, player.index):
+            server.apply_hits(broadcast)
+            server.push_hit(note_id, note_judgment, player.index)
+        if len(server.hits) == 1:
+            # apply once every reader that's ready this loop pass has pushed
+            asyncio.get_running_loop().call_soon(server.apply_hits, broadcast)
+    player.close()
+    metrics.drop_client(player.index)
+
+
+async def run_match(server, players):
+    """ Run gameplay for a set of players who finished the handshake. Returns
+    once every player has disconnected. """
+    for player in players:
+        transport = player.writer.transport
+        server.metrics.add_client(player.index, player.name, player.rtt,
+                                  transport.get_write_buffer_size)
+    await asyncio.gather(*(player_reader(server, player, players)
+                           for player in players))
+    print("All clients disconnected. Ending gameplay.")
+
+
+async def serve(server, host, port, num_players=2,
+                max_backlog=DEFAULT_MAX_BACKLOG):
+    """ Accept num_players clients, hand them all the same start time, and run
+    one match on server's chart. Returns when the match is over. """
+    connections = []
+    enough = asyncio.Event()
+
+    async def accept(reader, writer):
+        if len(connections) >= num_players: # match is already full
+            writer.close()
+            return
+        print(f"Accepted connection from {writer.get_extra_info('peername')}")
+        connections.append((reader, writer))
+        if len(connections) == num_players:
+            enough.set()
+
+    listener = await asyncio.start_server(accept, host, port)
+    print(f"Server started on {host}:{port}")
+    async with listener:
+        await enough.wait()
+        players, future_time = await start_match(connections, server.blobs,
+                                                 max_backlog)
+        if len(players) != num_players:
+            print("Error: Not enough clients to start gameplay.",
+                  file=sys.stderr)
+            for player in players:
+                player.close()
+            return
+        if server.recorder is not None:
+            server.recorder.begin(server, future_time)
+        await run_match(server, players)
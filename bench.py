@@ -0,0 +1,222 @@
+# bench.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file is a benchmark for one match on snowfall_server. For every engine,
+# player count and speed given, it starts a fresh server on the chart, connects
+# that many simulated clients (see simclient.py, which does the same handshake
+# as snowfall_client), and has each of them send the hits a real player would.
+# Those hits come from playing the chart headless (see headless.py), each
+# player a little off the beat in their own way, and are sent at the times
+# they happened, sped up by the speed multiplier.
+#
+# For each run it reports hits received per second, how long the server took
+# to pass each hit on to every player (p50, p99 and p99.9 of that broadcast
+# latency) and the server's CPU time per hit received. A hit's latency is
+# measured from when the first player sent it (or for a miss, the last, since
+# misses are only passed on once everyone has missed). Everything runs in one
+# process on one clock, so no clock sync is needed to measure it. Results are
+# printed as a table and, with --out, written as JSON so runs can be compared
+# across changes.
+#
+# Usage: python bench.py --chart charts/speedcoreSonata.chart --speeds 4 16
+#        python bench.py --engines threads asyncio --players 2 8 --out b.json
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from headless import Simulation, autoplay
+from notetable import JUDGMENT_CODE, NO_CREDIT, NoteTable
+from perfstats import percentile
+from simclient import SimClient
+
+# how long to keep listening for broadcasts after the last hit is sent
+GRACE = 1.0
+
+
+def plan_hits(chartpath, players, jitter, seed):
+    """ The hits each player will send: a list per player of (time in ms,
+    note id, judgment code), from playing the chart headless with up to
+    jitter ms of timing error. """
+    notes = NoteTable.load(chartpath)
+    rng = random.Random(seed)
+    plans = []
+    for _ in range(players):
+        result = Simulation(notes.copy()).run(autoplay(notes, jitter, rng))
+        plans.append([(t, note_id, JUDGMENT_CODE[judgment])
+                      for t, note_id, judgment in result.hits])
+    return plans
+
+
+def server_cpu(pid):
+    """ CPU time (user + system, in seconds) the process has used so far, or
+    None where /proc isn't available. """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name is in parentheses and could have spaces
+            fields = f.read().rpartition(')')[2].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def connect(host, port, name, timeout=10):
+    """ Open a connection, retrying until the server is listening. """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await SimClient.open(host, port, name)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def play(host, port, plans, speed, server_pid):
+    """ Connect a client per plan, send every planned hit at speed times
+    real time, and measure what comes back. Returns a dict of results. """
+    clients = [await connect(host, port, f"bench{index}")
+               for index in range(len(plans))]
+    await asyncio.gather(*(client.handshake() for client in clients))
+    loop = asyncio.get_running_loop()
+    first_sent = {} # note id -> when the first non-NC hit on it was sent
+    last_missed = {} # note id -> when the last NC on it was sent
+    latencies = []
+    sent = 0
+
+    async def send(client, plan):
+        nonlocal sent
+        # the song starts at the future time the server gave us
+        start = loop.time() + client.future_time - client.sync.server_now()
+        for t, note_id, code in plan:
+            delay = start + t / 1000 / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = loop.time()
+            if code == NO_CREDIT:
+                last_missed[note_id] = now
+            else:
+                first_sent.setdefault(note_id, now)
+            client.send_hit(note_id, code)
+            sent += 1
+
+    async def receive(client):
+        while True:
+            hit = await client.read_hit()
+            if hit is None:
+                return
+            _, note_id, code = hit
+            sent_at = (last_missed if code == NO_CREDIT
+                       else first_sent).get(note_id)
+            if sent_at is not None:
+                latencies.append(1000 * (loop.time() - sent_at))
+
+    receivers = [asyncio.create_task(receive(client)) for client in clients]
+    cpu_start = server_cpu(server_pid)
+    # throughput counts from when the song starts, not from now
+    started = loop.time() + max(client.future_time - client.sync.server_now()
+                                for client in clients)
+    await asyncio.gather(*(send(client, plan)
+                           for client, plan in zip(clients, plans)))
+    await asyncio.sleep(GRACE)
+    seconds = loop.time() - started - GRACE
+    cpu_end = server_cpu(server_pid)
+    for client in clients:
+        await client.close()
+    await asyncio.wait(receivers, timeout=5)
+    cpu = None if cpu_start is None or cpu_end is None \
+        else cpu_end - cpu_start
+    return {
+        "hits_sent": sent,
+        "broadcasts_received": len(latencies),
+        "seconds": seconds,
+        "hits_per_second": sent / seconds if seconds else 0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": max(latencies, default=float('nan')),
+        },
+        "server_cpu_seconds": cpu,
+        "cpu_us_per_hit": None if cpu is None or not sent
+                          else 1e6 * cpu / sent,
+    }
+
+
+def run(args, engine, players, speed, port):
+    """ One benchmark run against a fresh server. """
+    plans = plan_hits(args.chart, players, args.jitter, args.seed)
+    server = subprocess.Popen(
+        [sys.executable, "snowfall_server.py", "--host", args.host,
+         "--port", str(port), "--chart", args.chart, "--engine", engine,
+         "--players", str(players)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        result = asyncio.run(play(args.host, port, plans, speed, server.pid))
+    finally:
+        try:
+            server.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            server.terminate()
+            server.wait()
+    return dict(engine=engine, players=players, speed=speed, **result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark snowfall_server with simulated players.")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65440,
+                        help='First port to use; each run gets the next one.')
+    parser.add_argument('--chart', type=str,
+                        default='./charts/speedcoreSonata.chart',
+                        help='Chart whose hits the players replay.')
+    parser.add_argument('--engines', nargs='+', default=['threads'],
+                        choices=['threads', 'asyncio'])
+    parser.add_argument('--players', type=int, nargs='+', default=[2],
+                        help='Player counts to test.')
+    parser.add_argument('--speeds', type=float, nargs='+', default=[4, 16],
+                        help='How many times faster than real time to send '
+                             'hits.')
+    parser.add_argument('--jitter', type=float, default=50,
+                        help='Players hit up to this many ms off the beat.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the players\' timing.')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    print(f"{'engine':>8} {'players':>7} {'speed':>6} {'hits/s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'cpu us/hit':>10}")
+    for engine in args.engines:
+        for players in args.players:
+            for speed in args.speeds:
+                result = run(args, engine, players, speed, port)
+                port += 1
+                results.append(result)
+                latency = result["latency_ms"]
+                cpu = result["cpu_us_per_hit"]
+                print(f"{engine:>8} {players:>7} {speed:>6g} "
+                      f"{result['hits_per_second']:>9.0f} "
+                      f"{latency['p50']:>8.2f} {latency['p99']:>8.2f} "
+                      f"{latency['p999']:>8.2f} "
+                      f"{'n/a' if cpu is None else f'{cpu:.1f}':>10}")
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump({"chart": args.chart, "jitter": args.jitter,
+                       "seed": args.seed, "python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "runs": results}, f, indent=2)
+        print("Wrote ", args.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# chartcache.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines how the server hands its chart and audio to clients during
+# the handshake, so every player plays exactly the server's chart. The server
+# offers each file by its SHA-256 hash and size. The client keeps a cache of
+# files named by their hash, asks only for the ones it doesn't have, and the
+# server streams those straight from disk with sendfile. Nothing is sent for a
+# chart the client has played before, and a file that arrives with the wrong
+# hash is thrown away.
+#
+# Offer and request are each a 4-byte length followed by JSON. The offer is
+# {"chart": {"name", "size", "sha256"}, "audio": {...}}, and the request is a
+# list of the keys the client wants, which the server then sends in order, each
+# as exactly size raw bytes.
+#
+# The client doesn't trust the offer: hashes must be 64 lowercase hex digits
+# and file extensions must be ones we play, so a server can't point us at a
+# path outside the cache, and a file already in the cache is hashed again
+# before it's used.
+
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from pathlib import Path
+from protocol import recv_exact
+
+# bytes read or received at a time
+CHUNK = 64 * 1024
+
+LENGTH = struct.Struct("!I")
+# longest offer or request we'll read; both are a few hundred bytes
+MAX_JSON = 64 * 1024
+
+# extensions the client will keep for each kind of file offered
+SUFFIXES = {
+    "chart": {".chart", ".chartb", ".chartl"},
+    "audio": {".mp3", ".ogg", ".wav", ".flac"},
+}
+HEX_DIGITS = set("0123456789abcdef")
+
+
+def hash_file(path):
+    """ SHA-256 of the file at path, as a hex string. """
+    digest = hashlib.sha256()
+    buffer = bytearray(CHUNK)
+    view = memoryview(buffer)
+    with open(path, 'rb') as file:
+        while True:
+            count = file.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+
+class Blob:
+    """ A file the server can offer. """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.name = self.path.name
+        self.size = self.path.stat().st_size
+        self.sha256 = hash_file(path)
+
+    def describe(self):
+        return {"name": self.name, "size": self.size, "sha256": self.sha256}
+
+
+def chart_blobs(chartpath, audio):
+    """ The blobs to offer for a chart: the chart itself, and its audio file
+    (audio is the file name from the chart, next to the chart) if the server
+    has it. """
+    blobs = {"chart": Blob(chartpath)}
+    if audio:
+        audio_path = Path(chartpath).parent / audio
+        if audio_path.exists():
+            blobs["audio"] = Blob(audio_path)
+    return blobs
+
+
+def encode_json(obj):
+    """ A length-prefixed JSON message. """
+    data = json.dumps(obj).encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+
+def recv_json(sock):
+    """ Read a length-prefixed JSON message, or None if the connection
+    closed. """
+    length = recv_exact(sock, LENGTH.size)
+    if len(length) < LENGTH.size:
+        return None
+    data = recv_exact(sock, json_length(length))
+    return json.loads(data)
+
+
+def json_length(prefix):
+    """ The length in a JSON message's prefix. Raises ValueError if it's more
+    than we'll read. """
+    length = LENGTH.unpack(prefix)[0]
+    if length > MAX_JSON:
+        raise ValueError(f"message of {length} bytes is too long")
+    return length
+
+
+def wanted_keys(wanted, blobs):
+    """ Check a client's request: it has to be a list of keys we offered.
+    Returns it, or raises ValueError. """
+    if not isinstance(wanted, list) or \
+            not all(isinstance(key, str) and key in blobs for key in wanted):
+        raise ValueError("bad request for the chart")
+    return wanted
+
+
+def offer(sock, blobs):
+    """ Server side, blocking: offer blobs and send whichever the client asks
+    for. Returns the keys that were sent, or None if the client went away.
+    Raises ValueError if the client's request isn't a list of offered keys.
+    """
+    sock.sendall(encode_json({key: blob.describe()
+                              for key, blob in blobs.items()}))
+    wanted = recv_json(sock)
+    if wanted is None:
+        return None
+    wanted = wanted_keys(wanted, blobs)
+    for key in wanted:
+        with open(blobs[key].path, 'rb') as file:
+            # zero-copy where the OS has sendfile, chunked send otherwise
+            sock.sendfile(file)
+    return wanted
+
+
+async def offer_async(reader, writer, blobs):
+    """ Server side, on asyncio streams: the same as offer. """
+    writer.write(encode_json({key: blob.describe()
+                              for key, blob in blobs.items()}))
+    length = json_length(await reader.readexactly(LENGTH.size))
+    wanted = wanted_keys(json.loads(await reader.readexactly(length)), blobs)
+    loop = asyncio.get_running_loop()
+    for key in wanted:
+        await writer.drain()
+        with open(blobs[key].path, 'rb') as file:
+            await loop.sendfile(writer.transport, file)
+    return wanted
+
+
+class ContentCache:
+    """ Client side: a directory of files named by their hash. """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, key, description):
+        """ Where the file described by an offer lives in the cache. The
+        original extension is kept so the mixer can tell what the audio is.
+        Raises ValueError if the description isn't one we'll accept. """
+        sha256 = description.get("sha256")
+        if not isinstance(sha256, str) or len(sha256) != 64 or \
+                not set(sha256) <= HEX_DIGITS:
+            raise ValueError(f"bad hash offered for {key}")
+        size = description.get("size")
+        if not isinstance(size, int) or size < 0:
+            raise ValueError(f"bad size offered for {key}")
+        name = description.get("name")
+        suffix = Path(name).suffix.lower() if isinstance(name, str) else ""
+        if suffix not in SUFFIXES.get(key, ()):
+            raise ValueError(f"can't accept a {key} named {name!r}")
+        return self.directory / (sha256 + suffix)
+
+    def has(self, key, description):
+        """ True if the cache has this file and it still matches its hash.
+        A file that doesn't match is thrown away so it can be fetched again.
+        """
+        path = self.path_for(key, description)
+        if not path.is_file():
+            return False
+        if hash_file(path) == description["sha256"]:
+            return True
+        path.unlink()
+        return False
+
+    def fetch(self, sock):
+        """ Read the server's offer, ask for everything we don't have, and
+        receive it. Returns {key: path in the cache} for everything offered.
+        Raises ConnectionError if the server goes away or a file doesn't match
+        its hash, and ValueError if the offer isn't one we'll accept. """
+        described = recv_json(sock)
+        if described is None:
+            raise ConnectionError("server closed the connection")
+        if not isinstance(described, dict) or \
+                not all(isinstance(description, dict)
+                        for description in described.values()):
+            raise ValueError("bad offer from the server")
+        wanted = [key for key, description in described.items()
+                  if not self.has(key, description)]
+        sock.sendall(encode_json(wanted))
+        for key in wanted:
+            self.receive(sock, key, described[key])
+        return {key: self.path_for(key, description)
+                for key, description in described.items()}
+
+    def receive(self, sock, key, description):
+        """ Receive one file straight into a temporary file, checking its hash
+        as it comes in, then move it into place. """
+        path = self.path_for(key, description)
+        digest = hashlib.sha256()
+        buffer = bytearray(CHUNK)
+        view = memoryview(buffer)
+        remaining = description["size"]
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                while remaining:
+                    count = sock.recv_into(view[:min(remaining, CHUNK)])
+                    if not count:
+                        raise ConnectionError("server closed the connection "
+                                              f"sending {description['name']}")
+                    digest.update(view[:count])
+                    file.write(view[:count])
+                    remaining -= count
+            if digest.hexdigest() != description["sha256"]:
+                raise ConnectionError(f"{description['name']} doesn't match "
+                                      f"its hash")
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
@@ -0,0 +1,247 @@
+# chartformat.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the packed binary chart format (.chartb) and the loader
+# that both the client and the server use to open charts. A packed chart is a
+# small header (audio file name, offset, end time, note count) followed by one
+# column per note field, so loading it is a single mmap instead of building a
+# dict per note the way json.load does. Plain JSON .chart files still work; the
+# loader checks the magic bytes at the start of the file and falls back to
+# JSON if they aren't there.
+#
+# This file also defines the line chart format (.chartl), which is made to be
+# streamed: the first line is a JSON header (audio, offset, end) and every line
+# after it is one note, [time, lane, duration], in time order. Packed charts
+# whose notes are in time order stream too, straight out of the mapping. Plain
+# JSON charts can't be streamed, since their header comes after the notes.
+#
+# Usage: python chartformat.py song.chart /path/to/output.chartb
+#        python chartformat.py song.chart /path/to/output.chartl
+
+from pathlib import Path
+import array
+import json
+import mmap
+import struct
+import sys
+
+MAGIC = b"SNWF"
+VERSION = 1
+# magic, version, flags, note count, offset (ms), end (ms), audio name length
+HEADER = struct.Struct("<4sHHIiiH")
+# header flags
+SORTED = 1 # notes are in time order, so the chart can be streamed
+# columns are stored in this order, all little-endian. lane goes last so that
+# the 4-byte columns stay 4-byte aligned.
+COLUMNS = (("time", "i"), ("duration", "i"), ("id", "i"), ("lane", "B"))
+
+# every line chart starts with exactly these bytes
+LINES_MAGIC = b'{"snowfall": 1'
+
+
+def _align(n, to=8):
+    """ Round n up to a multiple of to. """
+    return (n + to - 1) // to * to
+
+
+class PackedChart:
+    """ A chart opened from a .chartb file. The note columns are memoryviews
+    straight into the mapped file, so nothing is copied until someone indexes
+    into them. """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.count, self.offset, self.end, \
+            audio_len = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a packed chart")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported version {version}")
+        start = HEADER.size
+        self.audio = bytes(self._mmap[start:start + audio_len]).decode('utf-8')
+        start = _align(start + audio_len)
+        view = memoryview(self._mmap)
+        self.columns = {}
+        for name, typecode in COLUMNS:
+            size = array.array(typecode).itemsize * self.count
+            column = view[start:start + size]
+            if sys.byteorder == 'little':
+                self.columns[name] = column.cast(typecode)
+            else: # file is little-endian, so copy and swap on big-endian hosts
+                swapped = array.array(typecode, column.tobytes())
+                swapped.byteswap()
+                self.columns[name] = swapped
+            start += size
+
+    def __len__(self):
+        return self.count
+
+    def to_dict(self):
+        """ Build the same object that json.load gives for a .chart file. """
+        time, duration = self.columns['time'], self.columns['duration']
+        ids, lane = self.columns['id'], self.columns['lane']
+        notes = [dict(id=ids[i], lane=lane[i], time=time[i],
+                      duration=duration[i], judgment="")
+                 for i in range(self.count)]
+        return {"notes": notes, "end": self.end, "audio": self.audio,
+                "offset": self.offset}
+
+    def close(self):
+        """ Release the columns and the mapping. """
+        for column in self.columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = {}
+        self._mmap.close()
+
+
+def is_packed(path):
+    """ Returns true if the file at path starts with the packed chart magic. """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def is_lines(path):
+    """ Returns true if the file at path is a line chart. """
+    with open(path, 'rb') as file:
+        return file.read(len(LINES_MAGIC)) == LINES_MAGIC
+
+
+def load_chart(path):
+    """ Open the chart at path. Returns a PackedChart for .chartb files and the
+    parsed JSON object for anything else. """
+    if is_packed(path):
+        return PackedChart(path)
+    if is_lines(path):
+        header, notes = stream_chart(path)
+        header['notes'] = [dict(id=i, time=time, lane=lane, duration=duration,
+                                judgment="")
+                           for i, (time, lane, duration) in enumerate(notes)]
+        return header
+    # encoding UTF-8 to handle weird outputs from chart conversion script
+    with open(path, 'r', encoding="utf-8") as file:
+        return json.load(file)
+
+
+def stream_chart(path):
+    """ Open the chart at path for streaming. Returns (header, notes), where
+    header is a dict with audio, offset and end, and notes is a generator of 
+    (time, lane, duration) in time order that only reads as far as it's asked
+    to. Returns (None, None) for charts that can't be streamed (plain JSON, or
+    a packed chart whose notes are out of order). """
+    # the generators open the file themselves, so a generator that's never
+    # run never holds it open
+    if is_packed(path):
+        chart = PackedChart(path)
+        try:
+            if not chart.flags & SORTED:
+                return None, None
+            header = dict(audio=chart.audio, offset=chart.offset,
+                          end=chart.end)
+        finally:
+            chart.close()
+        return header, _stream_packed(path)
+    if is_lines(path):
+        with open(path, 'r', encoding="utf-8") as file:
+            header = json.loads(file.readline())
+        return header, _stream_lines(path)
+    return None, None
+
+
+def _stream_packed(path):
+    chart = PackedChart(path)
+    try:
+        time, lane = chart.columns['time'], chart.columns['lane']
+        duration = chart.columns['duration']
+        for i in range(chart.count):
+            yield time[i], lane[i], duration[i]
+    finally:
+        chart.close()
+
+
+def _stream_lines(path):
+    with open(path, 'r', encoding="utf-8") as file:
+        file.readline() # the header, read by stream_chart
+        last = None
+        for line_number, line in enumerate(file, start=2):
+            if not line.strip():
+                continue
+            time, lane, duration = json.loads(line)
+            if last is not None and time < last:
+                raise ValueError(f"{path}:{line_number}: note is out of "
+                                 f"time order")
+            last = time
+            yield time, lane, duration
+
+
+def read_chart(path):
+    """ Open the chart at path and return it as a json-style chart object, no
+    matter which format it is stored in. """
+    chart = load_chart(path)
+    if isinstance(chart, PackedChart):
+        data = chart.to_dict()
+        chart.close()
+        return data
+    return chart
+
+
+def write_packed(chart, out_path):
+    """ Write a json-style chart object to out_path in the packed format. """
+    columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+    for note in chart['notes']:
+        for name, _ in COLUMNS:
+            columns[name].append(note[name])
+    write_columns(columns, chart.get('audio'), chart.get('offset', 0),
+                  chart['end'], out_path)
+
+
+def write_columns(columns, audio, offset, end, out_path):
+    """ Write note columns (a dict of arrays, named and typed like COLUMNS)
+    to out_path in the packed format. """
+    audio = (audio or "").encode('utf-8')
+    times = columns['time']
+    count = len(times)
+    flags = SORTED if all(times[i] <= times[i + 1]
+                          for i in range(count - 1)) else 0
+    header = HEADER.pack(MAGIC, VERSION, flags, count, offset, end,
+                         len(audio))
+    with open(out_path, 'wb') as f:
+        f.write(header)
+        f.write(audio)
+        f.write(b"\0" * (_align(len(header) + len(audio)) - len(header) -
+                         len(audio)))
+        for name, typecode in COLUMNS:
+            column = columns[name]
+            if sys.byteorder == 'big': # swap a copy, not the caller's
+                column = array.array(typecode, column)
+                column.byteswap()
+            column.tofile(f)
+
+
+def write_lines(chart, out_path):
+    """ Write a json-style chart object to out_path in the line format. Notes
+    are written in time order (notes at the same time keep their order), and
+    a note's id is its line, so ids are renumbered if they weren't already 
+    in time order. """
+    notes = sorted(chart['notes'], key=lambda note: note['time'])
+    header = {"snowfall": 1, "audio": chart.get('audio'),
+              "offset": chart.get('offset', 0), "end": chart['end']}
+    with open(out_path, 'w', encoding="utf-8") as f:
+        f.write(json.dumps(header) + "\n")
+        for note in notes:
+            f.write(f"[{note['time']}, {note['lane']}, {note['duration']}]\n")
+
+
+if __name__ == "__main__":
+    # python chartformat.py song.chart /path/to/output.chartb (or .chartl)
+    chart = read_chart(sys.argv[1])
+    out_path = Path(sys.argv[2])
+    if out_path.suffix == '.chartl':
+        write_lines(chart, out_path)
+    else:
+        out_path = out_path.with_suffix('.chartb')
+        write_packed(chart, out_path)
+    print("Wrote ", out_path)
@@ -0,0 +1,142 @@
+# chartprep.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the preprocessing pass every chart goes through when it is
+# loaded into a NoteTable. Notes are put in time order (so a note's id, its
+# row in the table, is the same on every machine that loads the chart), and
+# the chart is checked for things the game can't play: lanes outside 1 to
+# LANES, negative durations, and notes that start while a hold in the same lane
+# is still going. Then the fields the game loop would otherwise work out every
+# frame are computed once per note: the lane's x position, when the hold's tail
+# ends, and when the note enters and leaves the hit window (see layout.py).
+#
+# Run it on its own to check a chart before serving it, and optionally to
+# write it back out in time order, in any of the chart formats.
+#
+# Usage: python chartprep.py song.chart
+#        python chartprep.py song.chart /path/to/output.chartb
+
+from array import array
+from pathlib import Path
+import json
+import sys
+from chartformat import read_chart, write_lines, write_packed
+from layout import HIT_WINDOW_END, HIT_WINDOW_START, LANES, SPEED, lane_x
+
+# when a note enters and leaves the hit window, in ms after its time
+HIT_START_MS = round(HIT_WINDOW_START / SPEED)
+HIT_END_MS = round(HIT_WINDOW_END / SPEED)
+
+
+class ChartError(ValueError):
+    """ A chart the game can't play. problems lists everything wrong with
+    it. """
+    def __init__(self, problems):
+        self.problems = problems
+        more = f" (and {len(problems) - 1} more)" if len(problems) > 1 else ""
+        super().__init__(problems[0] + more)
+
+
+class NoteChecker:
+    """ Checks notes one at a time, in time order. Used for whole charts by
+    validate, and note by note for streamed charts. """
+    def __init__(self):
+        self.last_time = None
+        self.hold_end = {} # lane -> when the latest hold in it ends
+
+    def check(self, time, lane, duration):
+        """ Returns what's wrong with the next note, or None if nothing is.
+        """
+        if not 1 <= lane <= LANES:
+            return f"note at {time} ms is in lane {lane} (lanes are 1-{LANES})"
+        if duration < 0:
+            return f"note at {time} ms has negative duration {duration}"
+        if self.last_time is not None and time < self.last_time:
+            return f"note at {time} ms is out of time order"
+        self.last_time = time
+        end = self.hold_end.get(lane)
+        if duration > 0:
+            self.hold_end[lane] = max(time + duration, end or 0)
+        if end is not None and time < end:
+            return (f"note at {time} ms in lane {lane} starts before the hold "
+                    f"in that lane ends at {end} ms")
+        return None
+
+
+def time_order(time):
+    """ The note ids in time order (notes at the same time keep chart order),
+    or None if they already are. """
+    if all(time[i] <= time[i + 1] for i in range(len(time) - 1)):
+        return None
+    return sorted(range(len(time)), key=time.__getitem__)
+
+
+def validate(time, lane, duration):
+    """ Everything wrong with a chart's notes, which have to be in time order.
+    An empty list means the chart is fine. """
+    checker = NoteChecker()
+    problems = []
+    for note in zip(time, lane, duration):
+        problem = checker.check(*note)
+        if problem is not None:
+            problems.append(problem)
+    return problems
+
+
+def derive_note(time, lane, duration):
+    """ (x position, tail time, hit window start, hit window end) of one note,
+    with the times in ms of song time. """
+    return (lane_x(lane), time + duration, time + HIT_START_MS,
+            time + HIT_END_MS)
+
+
+def derive(time, lane, duration):
+    """ The derived columns (see derive_note) for a whole chart. """
+    x = array('H', [lane_x(l) for l in lane])
+    tail = array('i', [t + d for t, d in zip(time, duration)])
+    hit_start = array('i', [t + HIT_START_MS for t in time])
+    hit_end = array('i', [t + HIT_END_MS for t in time])
+    return x, tail, hit_start, hit_end
+
+
+def prepare_chart(chart):
+    """ Sort a json-style chart object's notes into time order and renumber
+    their ids, in place. Raises ChartError if the chart can't be played. """
+    notes = sorted(chart['notes'], key=lambda note: note['time'])
+    for i, note in enumerate(notes):
+        note['id'] = i
+    chart['notes'] = notes
+    problems = validate([n['time'] for n in notes], [n['lane'] for n in notes],
+                        [n['duration'] for n in notes])
+    if problems:
+        raise ChartError(problems)
+    return chart
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python chartprep.py song.chart [output chart]",
+              file=sys.stderr)
+        sys.exit(2)
+    try:
+        chart = prepare_chart(read_chart(sys.argv[1]))
+    except ChartError as e:
+        for problem in e.problems:
+            print(f"{sys.argv[1]}: {problem}", file=sys.stderr)
+        sys.exit(1)
+    print(f"{sys.argv[1]}: {len(chart['notes'])} notes, OK")
+    if len(sys.argv) == 3:
+        out_path = Path(sys.argv[2])
+        if out_path.suffix == '.chartb':
+            write_packed(chart, out_path)
+        elif out_path.suffix == '.chartl':
+            write_lines(chart, out_path)
+        else:
+            with open(out_path, "w", encoding="utf-8") as f:
+                json.dump(chart, f, separators=(',', ':'))
+        print("Wrote ", out_path)
+
+if __name__ == "__main__":
+    main()
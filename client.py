@@ -12,43 +12,19 @@
 # handling code to send messages to the server related to this.
 
 import pygame
-import time
-import json
 import pathlib
+import threading
+from notetable import NoteTable, JUDGMENT_CODE, NO_CREDIT, NO_JUDGMENT, \
+    HOLDING, COMPLETED, FINISHED, PREDICTED
+from render import HoldBodyCache, Renderer
+from gameclock import GameClock
+from assetmanager import AssetManager
+from frameprofile import SCAN, EVENTS, CLEAR, NOTES, HOLDS, BANNER, KEYS, \
+    SLEEP
+from layout import JUDGE_Y, SPEED
 
-JUDGE_Y = 615
-SPEED = 1
-# load images once and only once
-JUDGMENT_IMAGES = {
-                "Excellent": pygame.image.load('./assets/EXCELLENT.png'),
-                "Very Good": pygame.image.load('./assets/VERYGOOD.png'),
-                "Good": pygame.image.load('./assets/GOOD.png'),
-                "Fair": pygame.image.load('./assets/FAIR.png'),
-                "Poor": pygame.image.load('./assets/POOR.png'),
-                "No Credit": pygame.image.load('./assets/NOCREDIT.png')
-            }
-
-KEY_IMAGES = {
-    1: pygame.image.load('./assets/q_press.png'),
-    2: pygame.image.load('./assets/w_press.png'),
-    3: pygame.image.load('./assets/e_press.png'),
-    4: pygame.image.load('./assets/r_press.png'),
-    5: pygame.image.load('./assets/o_press.png'),
-    6: pygame.image.load('./assets/p_press.png'),
-    7: pygame.image.load('./assets/[_press.png'),
-    8: pygame.image.load('./assets/]_press.png')  
-}
-
-KEY_LIMIT_IMAGES = {
-    1: pygame.image.load('./assets/q_limit.png'),
-    2: pygame.image.load('./assets/w_limit.png'),
-    3: pygame.image.load('./assets/e_limit.png'),
-    4: pygame.image.load('./assets/r_limit.png'),
-    5: pygame.image.load('./assets/o_limit.png'),
-    6: pygame.image.load('./assets/p_limit.png'),
-    7: pygame.image.load('./assets/[_limit.png'),
-    8: pygame.image.load('./assets/]_limit.png')  
-}
+# ms of notes to have read from a streamed chart ahead of the song
+READ_AHEAD = 5000
 # map keys to lanes, lanes to positions on the screen
 LANE_KEY = {                
     pygame.K_q:1, pygame.K_w:2, pygame.K_e:3, pygame.K_r:4,
@@ -59,22 +35,12 @@ LANE_POS = {
     1:(166,650), 2:(264,650), 3:(362,650), 4:(460,650),
     5:(558,650), 6:(656,650), 7:(754,650), 8:(852,650),
 }
-# load & transform more images, only once
-body_image = pygame.image.load('./assets/long_p1.png')
-body_width, body_height = body_image.get_size()
-
-head_image = pygame.image.load('./assets/note_p1.png')
-head_image = pygame.transform.scale(head_image, (64, 62)) 
-
-note_image = pygame.image.load('./assets/note_p1.png')
-note_image = pygame.transform.scale(note_image, (64, 62))  
-background_image = pygame.image.load('./assets/main_screen.png')
 
 def parse_chart(filepath):
-    """ Turn chart at filepath into json object. """
-    with open(filepath, 'r') as file:
-        data = json.load(file)
-    return data
+    """ Open chart at filepath as a note table. Works for packed .chartb, 
+    line .chartl and plain JSON .chart files. Streamable charts are read as 
+    the song goes (see update_notes). """
+    return NoteTable.open(filepath)
 
 
 def norman(acc):
@@ -95,21 +61,27 @@ def norman(acc):
     else:
         return "No Credit"
 
-def accuracy(note, currenttime, key):
+def accuracy(notes, note_id, currenttime, key):
     """ Given a note and a time, calculate an accuracy score (scalar 0-1). """
-    if note['lane'] != key:
+    if notes.lane[note_id] != key:
         return 0
-    if currenttime - note['time'] < 0:
+    note_time = notes.time[note_id]
+    if currenttime - note_time < 0:
         return 0
     else:
-        return 1 - (currenttime - (note['time'] + JUDGE_Y)) / 1000 
+        return 1 - (currenttime - (note_time + JUDGE_Y)) / 1000 
         # + JUDGE_Y for judgment window
 
 class Client:
-    def __init__(self, name, gamestate, starttime):
+    def __init__(self, name, gamestate, starttime, dirty_rects=False, 
+                 clock=None, assets=None, profiler=None):
         self.name = name
         self.gamestate = gamestate
         self.starttime = starttime
+        # paces the gameplay loop; made in client_init if not given
+        self.clock = clock
+        # images, possibly already loading in the background
+        self.assets = assets if assets is not None else AssetManager()
         self.server_socket = None # will be set from the main client script
         self.active_holds = {}
         self.release_window = 0.15 # for holds release timing
@@ -117,14 +89,77 @@ class Client:
                                # -- start index to check notes to show
         self.last_announced_id = -1
         self.pressed_keys = set() # for holds
+        # only redraw the parts of the screen that changed each frame
+        self.dirty_rects = dirty_rects
+        # per-lane index into notes.lane_notes of the first note that could 
+        # still be hit -- everything before it has left the hit window
+        self.lane_cursor = {}
+        # our own hits (game loop) and the server's confirmations (receive 
+        # thread) both change judgments
+        self.judgment_lock = threading.Lock()
+        # a FrameProfiler to record where each frame's time goes, if any
+        self.profiler = profiler
+
+    def clock_sync(self):
+        """ (offset, error) of our game clock against the server's clock, in
+        ms. Both are None if we aren't synced to the server. """
+        if self.clock is None or self.clock.sync is None:
+            return None, None
+        error = self.clock.error()
+        return (1000 * self.clock.offset, 
+                None if error is None else 1000 * error)
 
     def active_lanes(self):
         """Return the right-most (max index) two lanes currently held."""
         return set(sorted(self.pressed_keys)[-2:])
 
+    def find_hittable(self, lane, elapsed_time):
+        """ Returns the id of the first unjudged note in lane that is inside 
+        the hit window at elapsed_time, or None if there isn't one. """
+        notes = self.gamestate.notes
+        lane_times = notes.lane_times.get(lane)
+        if lane_times is None: # no notes in this lane at all
+            return None
+        lane_notes = notes.lane_notes[lane]
+        hit_start, hit_end = notes.hit_start, notes.hit_end
+        # notes whose hit window has closed are gone for good, since time
+        # only moves forward, so the cursor skips them (a lane's windows
+        # close in order)
+        cursor = self.lane_cursor.get(lane, 0)
+        while cursor < len(lane_notes) and \
+                hit_end[lane_notes[cursor]] <= elapsed_time:
+            cursor += 1
+        self.lane_cursor[lane] = cursor
+        for k in range(cursor, len(lane_times)):
+            note_id = lane_notes[k]
+            # this note (and every one after it) hasn't reached the hit 
+            # window yet
+            if hit_start[note_id] >= elapsed_time:
+                break
+            if notes.judgment[note_id] == NO_JUDGMENT and \
+                    not notes.flags[note_id] & FINISHED:
+                return note_id
+        return None
+
+    def predict(self, note_id, judgment):
+        """ Apply our own judgment of a note right away instead of waiting
+        for the server to send it back, marked PREDICTED until it does. We 
+        follow the server's rules so our guess is almost always what it says:
+        the first judgment counts, and a non-NC judgment beats an NC. """
+        notes = self.gamestate.notes
+        code = JUDGMENT_CODE[judgment]
+        with self.judgment_lock:
+            current = notes.judgment[note_id]
+            if current == NO_JUDGMENT or \
+                    (current == NO_CREDIT and code != NO_CREDIT):
+                notes.judgment[note_id] = code
+                notes.set_flag(note_id, PREDICTED)
+
     def update_recent_hit(self, note_id, judgment):
-        """Update recent id and put that in the queue for snowfall_client 
-        sender thread. This is a function because it happens so often."""
+        """Predict the hit, update recent id and put that in the queue for 
+        snowfall_client sender thread. This is a function because it happens 
+        so often."""
+        self.predict(note_id, judgment)
         self.gamestate.recent_id       = note_id
         self.gamestate.recent_judgment = judgment
         self.gamestate.outbox.put((note_id, judgment))
@@ -136,50 +171,91 @@ class Client:
             self.last_announced_id         = note_id
 
     def receive_hit_confirmation(self, note_id, judgment): 
-        """ This is where we actually record that a note was hit, so it stops
-        being drawn on the screen. This is called from snowfall_client when it
-        receives a message from the server indicating that a note was hit. """
-        # set the judgment of the note to the one we received
-        self.gamestate.notes['notes'][note_id]['judgment'] = judgment 
+        """ This is where we record what the server says a note got, so it
+        stops being drawn on the screen, and where our own predicted 
+        judgments are reconciled with the server's. This is called from 
+        snowfall_client when it receives a message from the server indicating
+        that a note was hit. """
+        notes = self.gamestate.notes
+        code = JUDGMENT_CODE[judgment]
+        with self.judgment_lock:
+            if note_id >= len(notes):
+                # we haven't read this far into the chart, so we're way off
+                # from the server; only the game loop reads more notes
+                return
+            current = notes.judgment[note_id]
+            # like the server: once a note has a non-NC judgment, an NC 
+            # doesn't change it (if it's our prediction, the server will 
+            # confirm it once our hit gets there)
+            if code == NO_CREDIT and current > NO_CREDIT:
+                return
+            # otherwise the server's word is final
+            notes.judgment[note_id] = code
+            notes.clear_flag(note_id, PREDICTED)
+        if note_id == self.gamestate.recent_id:
+            # the server disagreed with the judgment we're showing
+            self.gamestate.recent_judgment = judgment
         self.announce(note_id, judgment)
 
     def set_socket(self, server_socket):
         """ For good OOP practices. Sets the server socket to what's given. """
         self.server_socket = server_socket
 
-    def client_init(self, chartfile):
+    def client_init(self, chartfile, audio_path=None):
         """ Initialize client, including making the pygame screen, setting up
         music, parsing the chart & adding runtime flags to the chart object, and
-        actually starting the game at the given start time. """
-        # make chart into json object
+        actually starting the game at the given start time. The song is 
+        audio_path if given (the server sent it), or else the chart's audio 
+        file in charts/. """
+        # load chart into a note table
         self.gamestate.notes = parse_chart(chartfile)
         # get audio file
-        audio_path = pathlib.Path("charts") / self.gamestate.notes['audio'] 
+        if audio_path is None:
+            audio_path = pathlib.Path("charts") / self.gamestate.notes.audio
         if not audio_path.exists():
             raise FileNotFoundError(audio_path)
         # deal with chart offset (deals with delay between notes and start 
         # of song)
-        song_offset = self.gamestate.notes.get("offset", 0) / 1000 # to seconds
+        song_offset = self.gamestate.notes.offset / 1000 # to seconds
         # handle music playing
         pygame.mixer.pre_init(44100, -16, 2, 512)
         pygame.init()
         # better display for smoother gameplay (this is lifted from 
         # stackoverflow)
         flags = pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.SCALED
+        if self.dirty_rects:
+            # partial updates need the display to keep what we drew last frame
+            flags &= ~pygame.DOUBLEBUF
+        if self.clock is None:
+            self.clock = GameClock(self.starttime)
         # initialize screen
-        self.screen = pygame.display.set_mode((1080, 720), flags)
+        self.screen = pygame.display.set_mode((1080, 720), flags, 
+                                              vsync=int(self.clock.vsync))
+        if self.clock.vsync:
+            # draw once per refresh, so flips don't hold up input steps
+            refresh_rate = getattr(pygame.display, 'get_current_refresh_rate',
+                                   lambda: 0)()
+            self.clock.set_refresh_rate(refresh_rate)
         # show player name in window caption
         pygame.display.set_caption(f"Game: {self.name}")
-        # add flags used only at runtime to each note in notes
-        for note in self.gamestate.notes['notes']: 
-            note['holding']   = False      # latch state for holds
-            note['completed'] = False      # hold is completed
-            note['finished']  = False      # finished drawing
-        while time.time() < self.starttime: # wait until time to start game
-            time.sleep(0.01)
+        # wait for the images and convert them for the new display
+        self.assets.finish()
+        # hold bodies are drawn out of pre-tiled strips, reused every frame
+        self.body_cache = HoldBodyCache(self.assets.body_image, 
+                                        self.screen.get_height())
+        self.renderer = Renderer(self.screen, self.assets.background_image, 
+                                 JUDGE_Y, self.dirty_rects)
+        # clear flags used only at runtime (holding, completed, finished)
+        self.gamestate.notes.clear_flags()
+        self.lane_cursor = {}
+        self.clock.wait_for_start() # wait until time to start game
+        offset, error = self.clock_sync()
+        if error is not None:
+            print(f"{self.name}: clock is {offset:.2f} ms behind the server "
+                  f"(+/- {error:.2f} ms)")
 
         # define music start time
-        play_delay = max(0, self.starttime - time.time() + song_offset)
+        play_delay = max(0, song_offset - self.clock.elapsed_ms() / 1000)
         pygame.time.set_timer(pygame.USEREVENT + 1, int(play_delay*1000), 
                               loops=1)
         pygame.mixer.music.load(audio_path)
@@ -190,182 +266,213 @@ class Client:
 
 
     def client_loop(self):
-        """ Pygame gameplay loop. Displays notes, checks for hits, repeats. """
+        """ Pygame gameplay loop. Checks for misses and handles input at a 
+        fixed timestep, and draws notes whenever the clock says a frame is 
+        due. Returns when the song is over or the window is closed. """
+        frame_due = True
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
         while True: 
-            note_queue = {1: [], 2: [], 3: [], 4: [], 
-                          5: [], 6: [], 7: [], 8: []}
-            elapsed_time = 1000 * (time.time() - self.starttime)
-            # skip until notes that should be visible
-            visible = self.visible_index      
-            # note is two seconds behind -> skip forever   
-            while visible < len(self.gamestate.notes['notes']) and \
-                self.gamestate.notes['notes'][visible]['time'] \
-                    < elapsed_time - 2000:
-                visible += 1                      
-            self.visible_index = visible
-            # display notes
-            for i in range(visible, len(self.gamestate.notes['notes'])):
-                note = self.gamestate.notes['notes'][i]
-                # two seconds ahead -> stop scanning
-                if note['time'] > elapsed_time + 2000:
-                    break                         
-                if note['finished'] == True:
-                    # should stop drawing note as finished flag is set
-                    continue
-                y_position = 0
-                note_time = note['time']
-                if elapsed_time >= note_time: 
-                    lane = note['lane']
-                    x_position = (lane - 1) * 98 + 198
+            elapsed_time = self.clock.elapsed_ms()
+            self.update_notes(elapsed_time)
+            if profiler is not None:
+                profiler.lap(SCAN)
+            if not self.handle_events(elapsed_time):
+                pygame.quit()
+                return True
+            if profiler is not None:
+                profiler.lap(EVENTS)
+            if frame_due:
+                self.draw_frame(elapsed_time)
+            # sleep until the next input step
+            frame_due = self.clock.tick()
+            if profiler is not None:
+                profiler.lap(SLEEP)
+
+    def update_notes(self, elapsed_time):
+        """ Skip notes that are long gone, and score notes that fell past the
+        judgment line (or hold tails that ran out) as No Credit. """
+        notes = self.gamestate.notes
+        # read a streamed chart a little ahead of what's on screen
+        notes.ensure(elapsed_time + READ_AHEAD)
+        times, lanes, durations = notes.time, notes.lane, notes.duration
+        tails, judgments, flags = notes.tail, notes.judgment, notes.flags
+        # skip until notes that should be visible
+        visible = self.visible_index      
+        # note is two seconds behind -> skip forever   
+        while visible < len(notes) and times[visible] < elapsed_time - 2000:
+            visible += 1                      
+        self.visible_index = visible
+        for i in range(visible, len(notes)):
+            note_time = times[i]
+            # notes that haven't started falling can't be missed yet
+            if note_time > elapsed_time:
+                break                         
+            if flags[i] & FINISHED:
+                continue
+            y_position = (elapsed_time - note_time) * SPEED  
+            # other player has hit it, so it's no longer ours to miss
+            if y_position > JUDGE_Y and judgments[i] != NO_JUDGMENT: 
+                continue
+            duration = durations[i]
+            if y_position > 700 and duration == 0 and \
+                  not flags[i] & HOLDING: # missed note, score as NC
+                self.update_recent_hit(i, "No Credit")
+            if duration > 0 and not flags[i] & COMPLETED:
+                # same JUDGE_Y ms leniency
+                if elapsed_time > tails[i] + JUDGE_Y: # miss, score as NC
+                    notes.set_flag(i, COMPLETED)
+                    self.update_recent_hit(i, "No Credit")
+                    # if we were still holding
+                    self.active_holds.pop(lanes[i], None)      
+
+    def handle_events(self, elapsed_time):
+        """ Pygame event handling. Returns False when the game should end. """
+        for event in pygame.event.get():
+            # start music at correct time 
+            if event.type == pygame.USEREVENT + 1: 
+                pygame.mixer.music.play()
+            # handle hits and hold starts
+            elif event.type == pygame.KEYDOWN and event.key in LANE_KEY: 
+                self.key_down(LANE_KEY[event.key], elapsed_time)
+            # handle hold releases
+            elif event.type == pygame.KEYUP and event.key in LANE_KEY:
+                self.key_up(LANE_KEY[event.key], elapsed_time)
+            # quit nicely
+            if event.type == pygame.QUIT:
+                return False
+        # song is over
+        return elapsed_time < self.gamestate.notes.end
+
+    def key_down(self, lane, elapsed_time):
+        """ A lane's key was pressed: hit a note, or start holding one. """
+        notes = self.gamestate.notes
+        self.pressed_keys.add(lane)
+        # ---- HIT-DETECTION ----
+        if lane in self.active_lanes():
+            note = self.find_hittable(lane, elapsed_time)
+            if note is not None:
+                acc  = accuracy(notes, note, elapsed_time, lane)
+                if notes.duration[note] == 0:
+                    self.update_recent_hit(note, norman(acc))
+                    notes.set_flag(note, FINISHED)
+                    # we have hit the note so we can stop drawing it
+                # ---- HELD NOTES ----
+                elif acc > 0:
+                    notes.set_flag(note, HOLDING)
+                    self.active_holds[lane] = note
 
-                    y_position = (elapsed_time - note_time) * SPEED  
-                    # other player has hit it, we stop drawing it at the 
-                    # judgment line so that it doesn't look choppy
-                    if y_position > JUDGE_Y and note['judgment'] != "": 
-                        continue
-                    if y_position > 400 and y_position < 800:
-                        # okay, the note is hittable now
-                        note_queue[note['lane']].append(note) 
-                    # handle held notes
-                    if note['duration'] > 0:                                
-                        # total length in pixels
-                        total_tail_px = note['duration'] * SPEED
-                        # how far the head has travelled so far
-                        travelled_px  = (elapsed_time - note['time']) * SPEED
-                        # --- HEAD POSITION -----------------------------------
-                        if note['holding'] and not note['completed']:
-                            # freeze on the judgment line
-                            head_y = JUDGE_Y              
-                            # hide the head while holding
-                            draw_head = False             
-                            # while the player is holding, the body should 
-                            # shrink, so the amount of tail that is  visible is:
-                            remaining_tail_px = \
-                                max(0, total_tail_px - (travelled_px - JUDGE_Y))
-                        else:
-                            head_y = travelled_px         # still falling
-                            draw_head = True
-                            remaining_tail_px = total_tail_px 
-                        # --- BODY RECTANGLE ----------------------------------
-                        # rectangle starts at the top of the still-visible tail
-                        top_y = head_y - remaining_tail_px
-                        # height of the visible body
-                        rect_h = remaining_tail_px        
-                        # --- BODY IMAGE --------------------------------------
-                        if rect_h > 0:
-                            # calculate how many times the body image needs to 
-                            # be repeated
-                            num_repeats = int(rect_h / body_height) + 1
-                            # draw the body image repeatedly to fill the height
-                            for rep in range(num_repeats):
-                                segment_y = int(top_y) + rep * body_height
-                                if segment_y + body_height > top_y + rect_h:
-                                    # clip the last segment if it exceeds the 
-                                    # visible height
-                                    clipped_body = \
-                                        pygame.Surface((body_width, 
-                                                        int(top_y + rect_h - \
-                                                            segment_y)), 
-                                                        pygame.SRCALPHA)
-                                    clipped_body.blit(body_image, 
-                                                        (0, 0), 
-                                                        (0, 0, body_width, 
-                                                        int(top_y + rect_h - \
-                                                            segment_y)))
-                                    self.screen.blit(clipped_body, 
-                                                     (x_position - 28, 
-                                                      segment_y))
-                                else:
-                                    self.screen.blit(body_image, 
-                                                     (x_position - 28, 
-                                                      segment_y))
-                        # --- HEAD IMAGE --------------------------------------
-                        if draw_head:
-                            self.screen.blit(head_image, (x_position - 32, 
-                                                          int(head_y) - 31))
-                    else: # not held note
-                        # render note
-                        self.screen.blit(note_image, (x_position - 32, 
-                                                      int(y_position) - 31)) 
-                if y_position > 700 and note['duration'] == 0 and \
-                      note['holding'] == False: # missed note, score as NC
-                    self.update_recent_hit(note['id'], "No Credit")
-                if note['duration'] > 0 and not note['completed']:
-                    # same JUDGE_Y ms leniency
-                    tail_time = note['time'] + note['duration'] + JUDGE_Y  
-                    if elapsed_time > tail_time: # miss, score as NC
-                        note['judgment'] = "No Credit"
-                        note['completed'] = True
-                        self.update_recent_hit(note['id'], "No Credit")
-                        # if we were still holding
-                        self.active_holds.pop(note['lane'], None)      
-            # pygame event handling
-            for event in pygame.event.get():
-                # start music at correct time 
-                if event.type == pygame.USEREVENT + 1: 
-                    pygame.mixer.music.play()
-                # handle hits and hold starts
-                elif event.type == pygame.KEYDOWN and event.key in LANE_KEY: 
-                    lane = LANE_KEY[event.key]
-                    self.pressed_keys.add(lane)
-                    # ---- HIT-DETECTION ----
-                    if lane in self.active_lanes():
-                        curnotes = \
-                            [n for n in note_queue[lane] if n['judgment'] == ""]
-                        if curnotes:
-                            note = curnotes[0]
-                            acc  = accuracy(note, elapsed_time, lane)
-                            if note['duration'] == 0:
-                                self.update_recent_hit(note['id'], norman(acc))
-                                self.gamestate.notes['notes']\
-                                    [note['id']]['finished'] = True 
-                                # we have hit the note so we can stop drawing it
-                            # ---- HELD NOTES ----
-                            elif acc > 0:
-                                note['holding'] = True
-                                self.active_holds[lane] = note
-                # handle hold releases
-                elif event.type == pygame.KEYUP and event.key in LANE_KEY:
-                    lane = LANE_KEY[event.key]
-                    self.pressed_keys.discard(lane)
-                    note = self.active_holds.pop(lane, None)
-                    # score completed note
-                    if note and not note['completed']:
-                        tail_time = note['time'] + note['duration']
-                        late_by   = elapsed_time - tail_time
-                        j = norman(1 - late_by/1000) if late_by <= \
-                            self.release_window*1000 else "No Credit"
-                        note['completed']           = True
-                        self.update_recent_hit(note['id'], j)
-                        self.gamestate.notes['notes'][note['id']]['finished']\
-                            = True 
-                        # we have hit the note so we can stop drawing it
-                # quit nicely
-                if event.type == pygame.QUIT or elapsed_time >= \
-                    self.gamestate.notes['end']:
-                    pygame.quit()
-                    return True
+    def key_up(self, lane, elapsed_time):
+        """ A lane's key was released: score the hold it was holding, if any. 
+        """
+        notes = self.gamestate.notes
+        self.pressed_keys.discard(lane)
+        note = self.active_holds.pop(lane, None)
+        # score completed note
+        if note is not None and not notes.has_flag(note, COMPLETED):
+            late_by   = elapsed_time - notes.tail[note]
+            j = norman(1 - late_by/1000) if late_by <= \
+                self.release_window*1000 else "No Credit"
+            notes.set_flag(note, COMPLETED)
+            self.update_recent_hit(note, j)
+            notes.set_flag(note, FINISHED)
+            # we have hit the note so we can stop drawing it
 
-            # render the judgment image in the top center of the screen
-            if self.gamestate.recent_judgment in JUDGMENT_IMAGES:
-                judgment_image = JUDGMENT_IMAGES[self.gamestate.recent_judgment]
-                image_rect =\
-                    judgment_image.get_rect(center=(self.screen.\
-                                                    get_width() // 2, 50))
-                self.screen.blit(judgment_image, image_rect)
-            
-            # can only be holding two keys legally
-            active = self.active_lanes() 
-            for lane in self.pressed_keys:
-                pos = LANE_POS[lane]
-                if lane in active: # display as holding
-                    self.screen.blit(KEY_IMAGES[lane], pos)
-                else: # illegal, display as limited
-                    self.screen.blit(KEY_LIMIT_IMAGES[lane], pos)
+    def draw_frame(self, elapsed_time):
+        """ Draw the notes, judgment and pressed keys, and present the frame. 
+        """
+        profiler = self.profiler
+        self.renderer.begin_frame() # clear what the last frame drew
+        if profiler is not None:
+            profiler.lap(CLEAR)
+        assets = self.assets
+        notes = self.gamestate.notes
+        times, xs, durations = notes.time, notes.x, notes.duration
+        judgments, flags = notes.judgment, notes.flags
+        # display notes
+        for i in range(self.visible_index, len(notes)):
+            note_time = times[i]
+            # notes are drawn once they start falling from the top
+            if note_time > elapsed_time:
+                break                         
+            if flags[i] & FINISHED:
+                # should stop drawing note as finished flag is set
+                continue
+            x_position = xs[i]
+            y_position = (elapsed_time - note_time) * SPEED  
+            # other player has hit it, we stop drawing it at the 
+            # judgment line so that it doesn't look choppy
+            if y_position > JUDGE_Y and judgments[i] != NO_JUDGMENT: 
+                continue
+            duration = durations[i]
+            # handle held notes
+            if duration > 0:                                
+                if profiler is not None:
+                    profiler.lap(NOTES)
+                # total length in pixels
+                total_tail_px = duration * SPEED
+                # how far the head has travelled so far
+                travelled_px  = y_position
+                # --- HEAD POSITION -------------------------------------------
+                if flags[i] & (HOLDING | COMPLETED) == HOLDING:
+                    # freeze on the judgment line
+                    head_y = JUDGE_Y              
+                    # hide the head while holding
+                    draw_head = False             
+                    # while the player is holding, the body should 
+                    # shrink, so the amount of tail that is  visible is:
+                    remaining_tail_px = \
+                        max(0, total_tail_px - (travelled_px - JUDGE_Y))
+                else:
+                    head_y = travelled_px         # still falling
+                    draw_head = True
+                    remaining_tail_px = total_tail_px 
+                # --- BODY RECTANGLE ------------------------------------------
+                # rectangle starts at the top of the still-visible tail
+                top_y = head_y - remaining_tail_px
+                # height of the visible body
+                rect_h = remaining_tail_px        
+                # --- BODY IMAGE ----------------------------------------------
+                if rect_h > 0:
+                    # one blit out of the pre-tiled body strips
+                    self.renderer.mark(
+                        self.body_cache.draw(self.screen, x_position - 28, 
+                                             top_y, rect_h))
+                # --- HEAD IMAGE ----------------------------------------------
+                if draw_head:
+                    self.renderer.blit(assets.head_image, 
+                                       (x_position - 32, int(head_y) - 31))
+                if profiler is not None:
+                    profiler.lap(HOLDS)
+            else: # not held note
+                # render note
+                self.renderer.blit(assets.note_image, 
+                                   (x_position - 32, int(y_position) - 31)) 
 
-            pygame.display.flip() # update display
+        if profiler is not None:
+            profiler.lap(NOTES)
+        # render the judgment image in the top center of the screen
+        if self.gamestate.recent_judgment in assets.judgment_images:
+            judgment_image = \
+                assets.judgment_images[self.gamestate.recent_judgment]
+            image_rect = judgment_image.get_rect(
+                center=(self.screen.get_width() // 2, 50))
+            self.renderer.blit(judgment_image, image_rect)
+        
+        if profiler is not None:
+            profiler.lap(BANNER)
+        # can only be holding two keys legally
+        active = self.active_lanes() 
+        for lane in self.pressed_keys:
+            pos = LANE_POS[lane]
+            if lane in active: # display as holding
+                self.renderer.blit(assets.key_images[lane], pos)
+            else: # illegal, display as limited
+                self.renderer.blit(assets.key_limit_images[lane], pos)
 
-            self.screen.fill((0, 0, 0))  # Clear the screen
-            self.screen.blit(background_image, (0, 0))
-            pygame.draw.line(self.screen, (255, 255, 255), (0, JUDGE_Y), 
-                             (1080, JUDGE_Y), 5)
\ No newline at end of file
+        if profiler is not None:
+            profiler.lap(KEYS)
+        self.renderer.end_frame() # update display
+        if profiler is not None:
+            profiler.end_frame(elapsed_time)
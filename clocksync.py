@@ -0,0 +1,93 @@
+# clocksync.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines clock synchronization between a client and the server,
+# the same way NTP does it. The client stamps a time request with its own
+# clock (t0), the server stamps when it got the request (t1) and when it sent
+# the response (t2), and the client stamps when the response arrived (t3).
+# From one of these samples:
+#     round trip time = (t3 - t0) - (t2 - t1)
+#     offset          = ((t1 - t0) + (t2 - t3)) / 2
+# where offset is how far the server's clock is ahead of ours. A sample whose
+# round trip was slow is also a sample whose offset could be badly off (the
+# offset is only known to within half the round trip), so out of the recent
+# samples we trust the one with the smallest round trip. Samples are taken
+# several times during the handshake, then about once a second during play so
+# the estimate follows the clocks as they drift apart.
+
+import collections
+import threading
+import time
+from protocol import TIME_RESPONSE, encode_time_request, decode_time_request, \
+    encode_time_response, decode_time_response, read_message
+
+# time samples taken during the handshake
+HANDSHAKE_SAMPLES = 8
+# seconds between time samples during play
+RESYNC_INTERVAL = 1.0
+# how many recent samples the estimate is picked from
+SAMPLE_WINDOW = 16
+
+class ClockSync:
+    def __init__(self, window=SAMPLE_WINDOW):
+        # read both clocks together once; from now on only perf_counter is
+        # used, so our clock can't jump if the wall clock is adjusted
+        self.wall_anchor = time.time()
+        self.perf_anchor = time.perf_counter()
+        self.samples = collections.deque(maxlen=window) # (rtt, offset)
+        self.offset = 0.0 # seconds the server's clock is ahead of ours
+        self.rtt = None # round trip of the sample offset came from
+        self.lock = threading.Lock() # samples come in on the receive thread
+
+    def local_now(self):
+        """ Our clock: wall-clock time, measured with the performance
+        counter. """
+        return self.wall_anchor + (time.perf_counter() - self.perf_anchor)
+
+    def server_now(self):
+        """ Our best guess at what the server's clock reads right now. """
+        return self.local_now() + self.offset
+
+    def error(self):
+        """ Most the offset can be wrong by, in seconds (half the round trip
+        of the sample it came from), or None before the first sample. """
+        return None if self.rtt is None else self.rtt / 2
+
+    def add_sample(self, t0, t1, t2, t3):
+        """ Add one request/response exchange (see the top of this file) and
+        update the estimate. """
+        rtt = max(0.0, (t3 - t0) - (t2 - t1))
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        with self.lock:
+            self.samples.append((rtt, offset))
+            self.rtt, self.offset = min(self.samples)
+
+    def request(self):
+        """ A time request stamped with our clock. """
+        return encode_time_request(self.local_now())
+
+    def receive(self, message):
+        """ Take in the server's response to one of our requests. """
+        t3 = self.local_now()
+        t0, t1, t2 = decode_time_response(message)
+        self.add_sample(t0, t1, t2, t3)
+
+    def handshake(self, sock, samples=HANDSHAKE_SAMPLES):
+        """ Take samples, one after another, over a blocking socket. Returns
+        False if the server went away or didn't answer properly. """
+        for _ in range(samples):
+            sock.sendall(self.request())
+            message = read_message(sock)
+            if message is None or message[0] != TIME_RESPONSE:
+                return False
+            self.receive(message[1])
+        return True
+
+
+def answer(message, received):
+    """ The server's response to a time request it got at time received (use
+    time.time() on the server). """
+    return encode_time_response(decode_time_request(message), received,
+                                time.time())
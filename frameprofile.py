@@ -0,0 +1,145 @@
+# frameprofile.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the frame profiler for the client's gameplay loop (turn it
+# on with snowfall_client --profile-frames). The loop marks off each part of
+# its work as it finishes it (checking notes for misses, handling events,
+# clearing the screen, drawing notes, drawing hold notes, the judgment banner,
+# the pressed keys, flipping the display, and sleeping until the next step),
+# and the time since the last mark goes to that part. When a frame is drawn,
+# everything since the last frame is written as one row into a ring buffer
+# that is allocated up front, so recording costs a few perf_counter calls and
+# array stores per frame, and nothing is allocated while the song plays.
+#
+# At the end of the song the profiler prints a summary (percentiles per part,
+# and a histogram of frame times) and can write a Chrome trace (open it in
+# chrome://tracing or ui.perfetto.dev) with every frame's parts and the song
+# time it was drawn at, so a stutter can be matched to a part of a chart.
+
+from array import array
+import json
+import time
+from perfstats import percentile
+
+# parts of a frame, in the order they happen
+PHASES = ("scan", "events", "clear", "notes", "holds", "banner", "keys",
+          "flip", "sleep")
+SCAN, EVENTS, CLEAR, NOTES, HOLDS, BANNER, KEYS, FLIP, SLEEP = \
+    range(len(PHASES))
+# each row is: when the frame started (perf_counter seconds), the song time
+# it was drawn at (ms), then seconds spent in each phase
+START, SONG_TIME = 0, 1
+WIDTH = 2 + len(PHASES)
+# frames kept (a little over 4 minutes at 120 fps)
+DEFAULT_CAPACITY = 1 << 15
+# frame time histogram bucket edges, in ms
+BUCKETS = (2, 4, 8, 12, 16.7, 25, 33.3, 50, 100)
+
+
+class FrameProfiler:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.rows = array('d', bytes(8 * WIDTH * capacity))
+        self.count = 0 # frames recorded, including ones overwritten
+        self.current = array('d', bytes(8 * WIDTH)) # the frame in progress
+        self.mark = None # when the last lap ended
+        self.start()
+
+    def start(self):
+        """ Start timing the first frame from now, throwing away anything
+        counted so far. Call this right before the loop starts. """
+        self.mark = time.perf_counter()
+        for i in range(WIDTH):
+            self.current[i] = 0.0
+        self.current[START] = self.mark
+
+    def lap(self, phase):
+        """ Count the time since the last lap towards phase. """
+        now = time.perf_counter()
+        self.current[2 + phase] += now - self.mark
+        self.mark = now
+
+    def end_frame(self, elapsed_time):
+        """ Record the frame in progress (drawn at elapsed_time ms of song
+        time) and start the next one. """
+        self.lap(FLIP)
+        current = self.current
+        current[SONG_TIME] = elapsed_time
+        base = (self.count % self.capacity) * WIDTH
+        self.rows[base:base + WIDTH] = current
+        self.count += 1
+        for i in range(2, WIDTH):
+            current[i] = 0.0
+        current[START] = self.mark
+
+    def frames(self):
+        """ The recorded rows, oldest first, each a list of WIDTH values. """
+        kept = min(self.count, self.capacity)
+        first = self.count - kept
+        rows = self.rows
+        return [list(rows[base:base + WIDTH])
+                for base in ((i % self.capacity) * WIDTH
+                             for i in range(first, self.count))]
+
+    def histogram(self, buckets=BUCKETS):
+        """ How many frames took up to each bucket edge (ms) and how many
+        took longer than the last, as a list of (label, count). Frame time is
+        start to start, so it includes sleeping. """
+        frames = self.frames()
+        counts = [0] * (len(buckets) + 1)
+        for before, after in zip(frames, frames[1:]):
+            ms = 1000 * (after[START] - before[START])
+            index = 0
+            while index < len(buckets) and ms > buckets[index]:
+                index += 1
+            counts[index] += 1
+        labels = [f"<= {edge:g} ms" for edge in buckets]
+        labels.append(f"> {buckets[-1]:g} ms")
+        return list(zip(labels, counts))
+
+    def summary(self):
+        """ A text report: p50/p99/max of each phase, and the frame time
+        histogram. """
+        frames = self.frames()
+        lines = [f"{len(frames)} frames recorded"
+                 + (f" (last {self.capacity} of {self.count})"
+                    if self.count > self.capacity else ""),
+                 f"{'phase':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        for phase, name in enumerate(PHASES):
+            times = [1000 * row[2 + phase] for row in frames]
+            lines.append(f"{name:>8} {percentile(times, 0.5):>8.3f} "
+                         f"{percentile(times, 0.99):>8.3f} "
+                         f"{max(times, default=0):>8.3f}")
+        lines.append("frame times:")
+        histogram = self.histogram()
+        most = max((count for _, count in histogram), default=0) or 1
+        for label, count in histogram:
+            bar = '#' * (40 * count // most)
+            lines.append(f"{label:>11} {count:>7} {bar}")
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """ Write the recorded frames as a Chrome trace: one event per frame,
+        with its phases laid end to end inside it. The phases happen in this
+        order, but scan and events are added up over every input step since
+        the last frame, so where they start inside the frame is
+        approximate. """
+        events = []
+        for index, row in enumerate(self.frames()):
+            start = row[START] * 1e6 # trace times are in microseconds
+            total = sum(row[2:])
+            events.append({"name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": start, "dur": total * 1e6,
+                           "args": {"frame": index,
+                                    "song_ms": round(row[SONG_TIME])}})
+            for phase, name in enumerate(PHASES):
+                seconds = row[2 + phase]
+                if seconds:
+                    events.append({"name": name, "ph": "X", "pid": 1,
+                                   "tid": 1, "ts": start,
+                                   "dur": seconds * 1e6})
+                start += seconds * 1e6
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,116 @@
+# gameclock.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the clock that paces the client's gameplay loop. Game time
+# comes from time.perf_counter, which is monotonic and high resolution, anchored
+# once to the wall clock so it lines up with the start time the server sends.
+# Given a ClockSync (see clocksync.py), game time follows the server's clock
+# instead: the offset is applied all at once before the song starts, and after
+# that it's slewed towards each new estimate a little at a time, so notes never
+# jump on screen.
+# Input is handled at a fixed rate, and frames are drawn at a (lower) target
+# frame rate in between, so judgments don't depend on how fast the machine can
+# draw and the loop sleeps instead of pinning a core. With vsync, frames are
+# still only drawn when one is due (once per display refresh), so the input
+# steps in between run on time; only the step that flips can wait for the
+# display, by up to one refresh.
+
+import time
+
+DEFAULT_FPS = 120
+DEFAULT_INPUT_HZ = 500
+# most the offset can move per second of play (5 ms), once the song is going
+MAX_SLEW = 0.005
+
+class GameClock:
+    def __init__(self, starttime, fps=DEFAULT_FPS, input_hz=DEFAULT_INPUT_HZ, 
+                 vsync=False, sync=None):
+        # time the song starts, on the server's clock if we have a sync
+        self.starttime = starttime
+        self.fps = fps # 0 means draw a frame every input step
+        self.vsync = vsync # flipping waits for the display to refresh
+        self.input_step = 1 / input_hz
+        self.frame_step = 1 / fps if fps else 0
+        # read both clocks together once; from now on only perf_counter is
+        # used, so the game clock can't jump if the wall clock is adjusted
+        self.wall_anchor = time.time()
+        self.perf_anchor = time.perf_counter()
+        self.sync = sync
+        self.offset = 0.0 # seconds added to our clock to get game time
+        if sync is not None:
+            # share the sync's clock, so its offset applies to ours exactly
+            self.wall_anchor = sync.wall_anchor
+            self.perf_anchor = sync.perf_anchor
+            self.offset = sync.offset
+        self.next_input = self.perf_anchor
+        self.next_frame = self.perf_anchor
+        self.last_tick = self.perf_anchor # when tick last returned
+
+    def set_refresh_rate(self, hz):
+        """ With vsync, draw once per display refresh (hz a second) instead
+        of at fps. Unknown rates (0) leave fps in charge. """
+        if self.vsync and self.fps and hz > 0:
+            self.frame_step = 1 / hz
+
+    def now(self):
+        """ Current wall-clock time, measured with the performance counter,
+        and moved onto the server's clock if we have a sync. """
+        return (self.wall_anchor + (time.perf_counter() - self.perf_anchor) + 
+                self.offset)
+
+    def error(self):
+        """ Most our clock can be off from the server's, in seconds (None if
+        we don't know). """
+        if self.sync is None or self.sync.error() is None:
+            return None
+        return self.sync.error() + abs(self.sync.offset - self.offset)
+
+    def elapsed_ms(self):
+        """ Milliseconds since the song started (negative before that). """
+        return 1000 * (self.now() - self.starttime)
+
+    def wait_for_start(self):
+        """ Sleep until the song's start time. """
+        remaining = self.starttime - self.now()
+        while remaining > 0:
+            time.sleep(min(remaining, 0.01))
+            if self.sync is not None:
+                # nothing is moving yet, so take the newest estimate as is
+                self.offset = self.sync.offset
+            remaining = self.starttime - self.now()
+        self.next_input = self.next_frame = time.perf_counter()
+        self.last_tick = self.next_input
+
+    def tick(self):
+        """ Sleep until the next input step. Returns True if a frame should be
+        drawn at this step. If we fall behind, we skip ahead instead of trying
+        to catch up on steps we missed. """
+        now = time.perf_counter()
+        self.next_input += self.input_step
+        if self.next_input > now:
+            time.sleep(self.next_input - now)
+            now = self.next_input
+        else:
+            self.next_input = now
+        if self.sync is not None:
+            # slew by the time that really passed, which is more than a step
+            # when drawing or flipping ran long
+            self.slew(time.perf_counter() - self.last_tick)
+        self.last_tick = time.perf_counter()
+        if not self.frame_step:
+            return True
+        if now >= self.next_frame:
+            self.next_frame += self.frame_step
+            if self.next_frame < now:
+                self.next_frame = now + self.frame_step
+            return True
+        return False
+
+    def slew(self, seconds):
+        """ Move the offset towards the sync's estimate, by at most MAX_SLEW
+        per second of seconds. """
+        target = self.sync.offset
+        most = MAX_SLEW * seconds
+        self.offset += max(-most, min(most, target - self.offset))
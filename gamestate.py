@@ -10,6 +10,7 @@
 # clients as well for ease of access.
 
 import queue
+from notetable import NoteTable
 
 class Gamestate:
     def __init__(self, notes, lanes_pressed, score, recent_id, 
@@ -25,9 +26,9 @@ class Gamestate:
     @staticmethod
     def empty_gamestate():
         """ Make a new gamestate object with empty values. """
-        return Gamestate(notes=[], lanes_pressed=[], score=0, recent_id=None, 
-                         recent_judgment=None, combo=0)
+        return Gamestate(notes=NoteTable(), lanes_pressed=[], score=0, 
+                         recent_id=None, recent_judgment=None, combo=0)
 
     def update_score(self, new_score): 
-        """ Increases score by new_score. Always called under a lock. """
+        """ Increases score by new_score. """
         self.score += new_score
\ No newline at end of file
@@ -0,0 +1,205 @@
+# headless.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines a headless engine for the client's gameplay logic. It runs
+# the same Client.update_notes, key_down and key_up that client_loop does, but
+# against a virtual clock and a scripted list of key presses, with no window,
+# no audio and no waiting. A whole chart plays in a fraction of a second, so it
+# can be used for regression tests, autoplay bots and generating realistic hits
+# for load tests.
+#
+# The real loop handles input on a fixed step (see gameclock.py): a key press
+# is seen at the first step after it happens, and a miss is scored at the first
+# step after the note falls past the line. Stepping through every one of those
+# steps would take as long as playing, so the engine only stops at the steps
+# where something can happen, which are those after an input or after a note's
+# miss deadline. Judgments come out exactly as a real loop with perfect timing
+# would give.
+#
+# An input is (time in ms of song time, lane, True for press/False for
+# release).
+#
+# Usage: python headless.py song.chart
+#        python headless.py song.chart --inputs presses.json
+#        python headless.py song.chart --jitter 40 --seed 7
+
+import argparse
+import heapq
+import json
+import math
+import random
+import sys
+import time
+from client import Client
+from gameclock import DEFAULT_INPUT_HZ
+from gamestate import Gamestate
+from layout import JUDGE_Y, SPEED
+from notetable import NoteTable
+
+# a tap is missed once it is this far (ms) past its time (see update_notes)
+TAP_MISS_MS = 700 / SPEED
+# how long autoplay holds a tap down, in ms
+TAP_LENGTH = 30
+
+
+class VirtualClock:
+    """ Stands in for GameClock: game time is whatever the engine says. """
+    def __init__(self):
+        self.elapsed = 0.0
+        self.sync = None # never synced to a server
+
+    def elapsed_ms(self):
+        return self.elapsed
+
+
+class SimResult:
+    """ What happened during a headless run. """
+    def __init__(self, notes, hits, steps, seconds):
+        self.notes = notes # the note table, with every judgment
+        self.hits = hits # (time in ms, note id, judgment), in order sent
+        self.steps = steps # loop steps that were run
+        self.seconds = seconds # real time the run took
+
+    def counts(self):
+        """ How many notes got each judgment. """
+        return self.notes.count_judgments()
+
+
+def autoplay(notes, error=0, rng=None):
+    """ Inputs that hit every note in notes on time. Taps and hold heads are
+    pressed when they reach the judgment line and holds are let go right at
+    their tail. With error, each press and release is moved by a random
+    amount up to error ms either way (rng is a random.Random, for repeatable
+    runs). """
+    rng = rng or random.Random()
+    inputs = []
+    for note_id in range(len(notes)):
+        lane = notes.lane[note_id]
+        press = notes.time[note_id] + JUDGE_Y
+        if error:
+            press += rng.uniform(-error, error)
+        if notes.duration[note_id] > 0:
+            release = notes.tail[note_id]
+            if error:
+                release += rng.uniform(-error, error)
+        else:
+            release = press + TAP_LENGTH
+        inputs.append((press, lane, True))
+        # let go before the next press, or it's never released in between
+        inputs.append((max(release, press + 1), lane, False))
+    # at the same time, releases go first so chords don't hold keys too long
+    inputs.sort(key=lambda i: (i[0], i[2]))
+    return inputs
+
+
+class Simulation:
+    """ Plays a note table through a Client's gameplay logic, headless. """
+    def __init__(self, notes, name="headless", input_hz=DEFAULT_INPUT_HZ):
+        self.clock = VirtualClock()
+        gamestate = Gamestate.empty_gamestate()
+        gamestate.notes = notes
+        notes.clear_flags()
+        self.client = Client(name, gamestate, starttime=0, clock=self.clock)
+        self.step = 1000 / input_hz # ms between input steps
+
+    def step_after(self, t):
+        """ Time of the first input step strictly after t ms. """
+        return (math.floor(t / self.step) + 1) * self.step
+
+    def step_at(self, t):
+        """ Time of the first input step at or after t ms. """
+        return math.ceil(t / self.step) * self.step
+
+    def deadlines(self):
+        """ Step times at which notes can be missed, in order. """
+        notes = self.client.gamestate.notes
+        times = []
+        for note_id in range(len(notes)):
+            if notes.duration[note_id] > 0:
+                # hold tails run out JUDGE_Y ms after the tail
+                times.append(self.step_after(notes.tail[note_id] + JUDGE_Y))
+            else:
+                times.append(self.step_after(notes.time[note_id] +
+                                             TAP_MISS_MS))
+        times.sort()
+        return times
+
+    def run(self, inputs):
+        """ Play the whole chart with inputs (in time order). Returns a
+        SimResult. """
+        started = time.perf_counter()
+        client = self.client
+        notes = client.gamestate.notes
+        outbox = client.gamestate.outbox
+        hits = []
+        # step times where something happens, each with the inputs seen then
+        pressed = [(self.step_at(t), k, lane, down)
+                   for k, (t, lane, down) in enumerate(inputs)]
+        missed = [(t, len(inputs) + k, None, None)
+                  for k, t in enumerate(self.deadlines())]
+        steps = 0
+        events = heapq.merge(pressed, missed)
+        event = next(events, None)
+        while event is not None:
+            elapsed = event[0]
+            if elapsed >= notes.end: # song is over
+                break
+            self.clock.elapsed = elapsed
+            client.update_notes(elapsed)
+            # every input seen at this step, in the order they happened
+            while event is not None and event[0] == elapsed:
+                _, _, lane, down = event
+                if down is True:
+                    client.key_down(lane, elapsed)
+                elif down is False:
+                    client.key_up(lane, elapsed)
+                event = next(events, None)
+            while not outbox.empty():
+                note_id, judgment = outbox.get_nowait()
+                hits.append((elapsed, note_id, judgment))
+            steps += 1
+        return SimResult(notes, hits, steps, time.perf_counter() - started)
+
+
+def simulate(chartpath, inputs=None, error=0, seed=None):
+    """ Load a chart and play it headless. Without inputs, autoplay plays it
+    (with error, see autoplay). """
+    notes = NoteTable.load(chartpath)
+    if inputs is None:
+        inputs = autoplay(notes, error, random.Random(seed))
+    return Simulation(notes).run(inputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play a chart with no window, as fast as possible.")
+    parser.add_argument('chart', help='Chart file to play.')
+    parser.add_argument('--inputs', default=None,
+                        help='JSON file with a list of [time, lane, pressed] '
+                             'inputs (default: autoplay).')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Autoplay presses up to this many ms early or '
+                             'late.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for --jitter.')
+    args = parser.parse_args()
+
+    inputs = None
+    if args.inputs is not None:
+        with open(args.inputs, encoding='utf-8') as f:
+            inputs = [(t, lane, bool(down)) for t, lane, down in json.load(f)]
+        inputs.sort(key=lambda i: i[0])
+    try:
+        result = simulate(args.chart, inputs, args.jitter, args.seed)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Played {len(result.notes)} notes in {result.steps} steps, "
+          f"{1000 * result.seconds:.1f} ms")
+    for judgment, count in result.counts().items():
+        print(f"{judgment:<11}: {count}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# layout.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the playfield layout and timing windows: where lanes are
+# on the screen, where the judgment line is, and when a note can be hit. The
+# client draws and judges with these, and chartprep.py uses them to work out
+# each note's position and windows once when a chart is loaded. It doesn't
+# need pygame, so tools that only read charts can use it too.
+
+# lanes go from 1 to LANES
+LANES = 8
+JUDGE_Y = 615
+SPEED = 1
+# a note can be hit while it is between these y positions
+HIT_WINDOW_START = 400
+HIT_WINDOW_END = 800
+# x position of the center of lane 1, and the distance between lanes
+FIRST_LANE_X = 198
+LANE_SPACING = 98
+
+
+def lane_x(lane):
+    """ x position of the center of a lane on the screen. """
+    return (lane - 1) * LANE_SPACING + FIRST_LANE_X
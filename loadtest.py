@@ -0,0 +1,113 @@
+# loadtest.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file is a load test for the lobby (snowfall_server --lobby). For every
+# room count given, it starts a fresh lobby server, fills that many rooms with
+# simulated clients (see simclient.py), and has the first player of every room
+# hit notes at a steady rate. Every hit is passed on to every player, so we
+# time how long each takes to come back and print one line per room count, to
+# see how latency and throughput hold up as rooms are added.
+#
+# Usage: python loadtest.py --rooms 1 10 50 100 --hits 300 --rate 50
+
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+from perfstats import percentile
+from simclient import SimClient
+
+async def open_room(host, port, room, players):
+    """ Open all of a room's connections, in order. The lobby groups players
+    in the order they connect, so these end up in the same room. """
+    return [await SimClient.open(host, port, f"room{room}-p{index}")
+            for index in range(players)]
+
+
+async def run_room(players, hits, rate, latencies):
+    """ Handshake a room's players, then have player 0 hit notes 0 to
+    hits - 1 at rate hits per second. Every returned hit's latency (in ms)
+    is added to latencies. """
+    await asyncio.gather(*(player.handshake() for player in players))
+    loop = asyncio.get_running_loop()
+    sent_at = {}
+
+    async def receive(player):
+        for _ in range(hits):
+            hit = await player.read_hit()
+            if hit is None:
+                return
+            _, note_id, _ = hit
+            latencies.append(1000 * (loop.time() - sent_at[note_id]))
+
+    receivers = [asyncio.create_task(receive(player)) for player in players]
+    for note_id in range(hits):
+        sent_at[note_id] = loop.time()
+        players[0].send_hit(note_id, 5) # Excellent, so it's always passed on
+        await asyncio.sleep(1 / rate)
+    await asyncio.wait(receivers, timeout=10)
+    for player in players:
+        await player.close()
+
+
+async def run_rooms(host, port, rooms, players, hits, rate):
+    """ Fill rooms rooms of players players at once. Returns (latencies,
+    seconds taken). """
+    latencies = []
+    all_players = [await open_room(host, port, room, players)
+                   for room in range(rooms)]
+    started = time.perf_counter()
+    await asyncio.gather(*(run_room(players, hits, rate, latencies)
+                           for players in all_players))
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the lobby.")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65433)
+    parser.add_argument('--chart', type=str,
+                        default='./charts/c18h27no3.chart',
+                        help='Chart every room plays (needs >= --hits notes).')
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1, 10, 50],
+                        help='Room counts to test, one after another.')
+    parser.add_argument('--players', type=int, default=2,
+                        help='Players per room.')
+    parser.add_argument('--hits', type=int, default=300,
+                        help='Hits sent per room.')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='Hits per second per room.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Lobby worker threads.')
+    args = parser.parse_args()
+
+    print(f"{'rooms':>6} {'hits/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'lost':>6}")
+    for rooms in args.rooms:
+        server = subprocess.Popen(
+            [sys.executable, "snowfall_server.py", "--lobby",
+             "--host", args.host, "--port", str(args.port),
+             "--room-charts", args.chart, "--workers", str(args.workers),
+             "--players", str(args.players)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1) # let the lobby load its chart and start listening
+            latencies, seconds = asyncio.run(
+                run_rooms(args.host, args.port, rooms, args.players,
+                          args.hits, args.rate))
+        finally:
+            server.terminate()
+            server.wait()
+        expected = args.players * rooms * args.hits
+        print(f"{rooms:>6} {len(latencies) / seconds:>9.0f} "
+              f"{statistics.median(latencies) if latencies else 0:>8.2f} "
+              f"{percentile(latencies, 0.99):>8.2f} "
+              f"{max(latencies, default=0):>8.2f} "
+              f"{expected - len(latencies):>6}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# lobby.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the lobby, which lets one snowfall_server process host
+# many matches at once (run it with --lobby). The lobby accepts connections
+# forever and groups them into rooms in the order they arrive. Each room gets
+# its own Server, Gamestate and Stats, and its own chart (rooms take turns
+# through the --room-charts list). Rooms are spread over a pool of worker
+# threads, each running an asyncio event loop, and each room runs the same
+# handshake and gameplay as the asyncio engine (see async_server.py). When a
+# room's match ends, its sockets are closed and it is removed from the lobby.
+# With --record, every room's match is recorded to its own file in a directory
+# (see replaylog.py).
+
+import asyncio
+import itertools
+import os
+import socket
+import sys
+import threading
+import time
+import async_server
+import chartcache
+from gamestate import Gamestate
+from metrics import Metrics
+from notetable import NoteTable
+from replaylog import ReplayRecorder
+from server import Server
+from stats import Stats
+
+# seconds to wait before accepting again after accept fails (out of file
+# descriptors, say)
+ACCEPT_BACKOFF = 0.1
+
+class Worker:
+    """ A thread running an asyncio event loop that rooms are run on. """
+    def __init__(self, index):
+        self.index = index
+        self.rooms = 0 # rooms currently running here
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name=f"lobby-worker-{index}",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class Room:
+    """ One match: its players' sockets, and its own gameplay server. """
+    def __init__(self, room_id, chartpath, notes, blobs, sockets, 
+                 max_backlog, trace_every=0, record_path=None):
+        self.room_id = room_id
+        self.chartpath = chartpath
+        self.sockets = sockets
+        self.max_backlog = max_backlog
+        self.server = Server(stats=Stats.empty_stats(),
+                             gamestate=Gamestate.empty_gamestate(),
+                             num_players=len(sockets), 
+                             metrics=Metrics(trace_every))
+        self.server.set_notes(notes)
+        self.server.blobs = blobs
+        if record_path is not None:
+            self.server.recorder = ReplayRecorder(record_path)
+        self.task = None
+
+    async def run(self):
+        """ Handshake with every player, then play the match. """
+        # the event loop only keeps weak references to tasks, so the room 
+        # (which the lobby holds on to) keeps its own task alive
+        self.task = asyncio.current_task()
+        connections = []
+        try:
+            for sock in self.sockets:
+                connections.append(await asyncio.open_connection(sock=sock))
+            players, future_time = await async_server.start_match(
+                connections, self.server.blobs, self.max_backlog)
+            if len(players) != len(self.sockets):
+                print(f"Room {self.room_id}: a player left during the "
+                      f"handshake, closing room.", file=sys.stderr)
+                for player in players:
+                    player.close()
+                return
+            if self.server.recorder is not None:
+                self.server.recorder.begin(self.server, future_time)
+            await async_server.run_match(self.server, players)
+        finally:
+            if self.server.recorder is not None:
+                # closing waits for the writer thread to flush the log, so
+                # wait off the loop, where it won't hold up other rooms
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.server.recorder.close, self.server)
+            for _, writer in connections:
+                writer.close()
+            for sock in self.sockets:
+                sock.close()
+
+
+class Lobby:
+    def __init__(self, host, port, charts, players_per_room=2, workers=4,
+                 max_backlog=async_server.DEFAULT_MAX_BACKLOG, registry=None,
+                 trace_every=0, record_dir=None):
+        self.host = host
+        self.port = port
+        self.players_per_room = players_per_room
+        self.max_backlog = max_backlog
+        # rooms' metrics are added while they play (see metrics.py)
+        self.registry = registry
+        self.trace_every = trace_every
+        # directory every room's match is recorded to, if any
+        self.record_dir = record_dir
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+        # load (and hash) every chart once; each room gets a fresh copy of 
+        # its notes
+        self.charts = []
+        for path in charts:
+            notes = NoteTable.load(path)
+            self.charts.append((path, notes, 
+                                chartcache.chart_blobs(path, notes.audio)))
+        self.next_chart = itertools.cycle(self.charts)
+        self.workers = [Worker(i) for i in range(workers)]
+        self.rooms = {} # room id -> Room, for rooms that are still playing
+        self.rooms_lock = threading.Lock()
+        self.next_room_id = itertools.count()
+        self.listener = None
+        self.stopping = False # set by shutdown
+
+    def open_room(self, sockets):
+        """ Make a room for these sockets and start it on the least busy
+        worker. """
+        chartpath, notes, blobs = next(self.next_chart)
+        room_id = next(self.next_room_id)
+        record_path = None
+        if self.record_dir is not None:
+            record_path = os.path.join(self.record_dir,
+                                       f"room-{room_id}.snowlog")
+        room = Room(room_id, chartpath, notes.copy(), blobs, sockets,
+                    self.max_backlog, self.trace_every, record_path)
+        if self.registry is not None:
+            self.registry.add(room.server.metrics, room=room.room_id)
+        with self.rooms_lock:
+            worker = min(self.workers, key=lambda w: w.rooms)
+            worker.rooms += 1
+            self.rooms[room.room_id] = room
+        print(f"Room {room.room_id}: opened with {len(sockets)} players on "
+              f"{chartpath} (worker {worker.index})")
+        future = asyncio.run_coroutine_threadsafe(room.run(), worker.loop)
+        future.add_done_callback(
+            lambda done: self.close_room(room, worker, done))
+        return room
+
+    def close_room(self, room, worker, done):
+        """ Teardown once a room's match is over. """
+        with self.rooms_lock:
+            worker.rooms -= 1
+            del self.rooms[room.room_id]
+        if self.registry is not None:
+            self.registry.remove(room.server.metrics)
+        if done.exception() is not None:
+            print(f"Room {room.room_id}: crashed: {done.exception()}",
+                  file=sys.stderr)
+            return
+        server = room.server
+        print(f"Room {room.room_id}: finished, score "
+              f"{server.gamestate.score}, max combo {server.stats.max_combo}")
+
+    def serve_forever(self):
+        """ Accept connections forever, opening a room every time enough
+        players are waiting. """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(128)
+        print(f"Lobby started on {self.host}:{self.port} with "
+              f"{len(self.workers)} workers")
+        waiting = []
+        try:
+            while True:
+                try:
+                    client_socket, client_address = self.listener.accept()
+                except OSError as e:
+                    if self.stopping or self.listener.fileno() == -1:
+                        break # shutting down
+                    # running out of file descriptors, a connection reset
+                    # before we got to it... the lobby keeps going
+                    print(f"Lobby: accept failed: {e}", file=sys.stderr)
+                    time.sleep(ACCEPT_BACKOFF)
+                    continue
+                waiting.append(client_socket)
+                if len(waiting) == self.players_per_room:
+                    self.open_room(waiting)
+                    waiting = []
+        except KeyboardInterrupt:
+            pass # shutting down
+        finally:
+            for sock in waiting:
+                sock.close()
+            self.listener.close()
+
+    def shutdown(self):
+        """ Stop accepting, and stop the workers (abandoning open rooms). """
+        self.stopping = True
+        if self.listener is not None:
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+        for worker in self.workers:
+            worker.stop()
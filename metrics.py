@@ -0,0 +1,274 @@
+# metrics.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the server's metrics. Every Server has a Metrics object
+# that counts messages and bytes in and out, how many hits were waiting each
+# time they were applied, how long hits waited and how long applying them
+# took, and each player's round trip time and unsent backlog. Only the thread
+# that owns the server writes to its metrics, so counting takes no lock; the
+# exporter only reads them.
+#
+# With snowfall_server --metrics-port, a small HTTP server on its own thread
+# serves every live server's metrics at /metrics in the Prometheus text format
+# (rooms in the lobby are labeled by room). With --trace-every N, one hit in N
+# is also traced (when it came in, how long it waited, whether it was passed
+# on), and the most recent traces are served as JSON at /traces.
+
+from array import array
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import json
+import struct
+import threading
+import time
+try:
+    import fcntl
+    import termios
+except ImportError: # Windows can't tell us a socket's backlog
+    fcntl = None
+
+# hit wait and apply time histogram bucket edges, in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+           0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+# traced hits kept for /traces
+TRACES_KEPT = 1000
+MESSAGE_TYPES = ("hit", "time_request", "bad")
+
+
+class Histogram:
+    """ Counts of observations by bucket, the Prometheus way. """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = array('Q', bytes(8 * (len(buckets) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class ClientMetrics:
+    """ What we know about one player's connection. backlog is a function
+    that returns the bytes queued for them but not sent yet, or None. """
+    def __init__(self, name, rtt, backlog):
+        self.name = name
+        self.rtt = rtt
+        self.backlog = backlog
+        self.connected = True
+
+
+class Metrics:
+    def __init__(self, trace_every=0):
+        self.messages_in = dict.fromkeys(MESSAGE_TYPES, 0)
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.broadcasts = 0 # hits passed on to everyone
+        self.hits_applied = 0
+        self.queue_depth = 0 # hits waiting at the last apply pass
+        self.max_queue_depth = 0
+        self.hit_wait = Histogram() # from push to apply, per hit
+        self.apply_time = Histogram() # per apply pass
+        self.clients = {} # player index -> ClientMetrics
+        # 1 in trace_every hits is traced (0 for none)
+        self.trace_every = trace_every
+        self.traces = collections.deque(maxlen=TRACES_KEPT)
+
+    def received(self, message_type, size):
+        """ Count a message from a client. message_type is one of
+        MESSAGE_TYPES. """
+        self.messages_in[message_type] += 1
+        self.bytes_in += size
+
+    def sent(self, size, count=1):
+        """ Count a message sent to count clients. """
+        self.messages_out += count
+        self.bytes_out += size * count
+
+    def add_client(self, player, name, rtt, backlog=lambda: None):
+        self.clients[player] = ClientMetrics(name, rtt, backlog)
+
+    def drop_client(self, player):
+        if player in self.clients:
+            self.clients[player].connected = False
+
+    def applied(self, stamp, now, note_id, code, player, passed_on):
+        """ Count one hit applied at now (perf_counter) that was pushed at
+        stamp, and trace it if it's sampled. """
+        self.hits_applied += 1
+        self.hit_wait.observe(now - stamp)
+        if passed_on:
+            self.broadcasts += 1
+        if self.trace_every and self.hits_applied % self.trace_every == 0:
+            self.traces.append({
+                "received": time.time() - (time.perf_counter() - stamp),
+                "player": player, "note": note_id, "judgment": code,
+                "wait_ms": 1000 * (now - stamp), "passed_on": passed_on})
+
+    def apply_pass(self, depth, seconds):
+        """ Count one apply_hits pass over depth waiting hits. """
+        self.queue_depth = depth
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        self.apply_time.observe(seconds)
+
+
+def _escape(value):
+    """ A label value escaped for the Prometheus text format. Player names
+    come from clients, so they can't be trusted to be well-behaved. """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"'
+                          for key, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """ Every live server's metrics, with labels to tell them apart. Rooms
+    come and go from other threads, so adding and removing takes a lock. """
+    def __init__(self):
+        self.sources = {} # id(metrics) -> (labels, metrics)
+        self.lock = threading.Lock()
+
+    def add(self, metrics, **labels):
+        with self.lock:
+            self.sources[id(metrics)] = (tuple(labels.items()), metrics)
+
+    def remove(self, metrics):
+        with self.lock:
+            self.sources.pop(id(metrics), None)
+
+    def render(self):
+        """ Every metric in the Prometheus text format. """
+        with self.lock:
+            sources = list(self.sources.values())
+        families = collections.defaultdict(list) # name -> sample lines
+        kinds = {}
+        helps = {}
+
+        def add(name, kind, text, labels, value):
+            kinds[name], helps[name] = kind, text
+            families[name].append(f"{name}{_labels(labels)} {value}")
+
+        def add_histogram(name, text, labels, histogram):
+            kinds[name], helps[name] = "histogram", text
+            lines = families[name]
+            total = 0
+            edges = histogram.buckets + ('+Inf',)
+            for edge, count in zip(edges, histogram.counts):
+                total += count
+                bucket_labels = _labels(labels + (('le', edge),))
+                lines.append(f"{name}_bucket{bucket_labels} {total}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+        for labels, m in sources:
+            for message_type, count in m.messages_in.items():
+                add("snowfall_messages_in_total", "counter",
+                    "Messages received from clients.",
+                    labels + (("type", message_type),), count)
+            add("snowfall_bytes_in_total", "counter",
+                "Bytes of messages received from clients.", labels, m.bytes_in)
+            add("snowfall_messages_out_total", "counter",
+                "Messages sent to clients (one per client).", labels,
+                m.messages_out)
+            add("snowfall_bytes_out_total", "counter",
+                "Bytes of messages sent to clients.", labels, m.bytes_out)
+            add("snowfall_hits_applied_total", "counter",
+                "Hits applied to the gamestate.", labels, m.hits_applied)
+            add("snowfall_broadcasts_total", "counter",
+                "Hits passed on to every client.", labels, m.broadcasts)
+            add("snowfall_queue_depth", "gauge",
+                "Hits waiting at the last apply pass.", labels, m.queue_depth)
+            add("snowfall_queue_depth_max", "gauge",
+                "Most hits ever waiting at one apply pass.", labels,
+                m.max_queue_depth)
+            add_histogram("snowfall_hit_wait_seconds",
+                          "Time from a hit being read to being applied.",
+                          labels, m.hit_wait)
+            add_histogram("snowfall_apply_seconds",
+                          "Time taken by each pass applying waiting hits.",
+                          labels, m.apply_time)
+            for player, client in list(m.clients.items()):
+                client_labels = labels + (("player", player),
+                                          ("name", client.name))
+                add("snowfall_client_connected", "gauge",
+                    "1 while the client is connected.", client_labels,
+                    int(client.connected))
+                if client.rtt is not None:
+                    add("snowfall_client_rtt_seconds", "gauge",
+                        "Round trip time measured in the handshake.",
+                        client_labels, client.rtt)
+                backlog = client.backlog() if client.connected else 0
+                if backlog is not None:
+                    add("snowfall_client_send_backlog_bytes", "gauge",
+                        "Bytes queued for the client but not sent yet.",
+                        client_labels, backlog)
+        out = []
+        for name, lines in families.items():
+            out.append(f"# HELP {name} {helps[name]}")
+            out.append(f"# TYPE {name} {kinds[name]}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    def traces(self):
+        """ Every live server's recent traces, with their labels. """
+        with self.lock:
+            sources = list(self.sources.values())
+        return [dict(labels, **trace) for labels, m in sources
+                for trace in list(m.traces)]
+
+
+def serve_metrics(registry, host, port):
+    """ Serve registry at http://host:port/metrics (and /traces) from a
+    daemon thread. Returns the HTTP server (call shutdown to stop it). """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = registry.render().encode('utf-8')
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/traces":
+                body = json.dumps(registry.traces()).encode('utf-8')
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # don't print a line for every scrape
+
+    http_server = ThreadingHTTPServer((host, port), Handler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="metrics",
+                     daemon=True).start()
+    print(f"Metrics at http://{host}:{port}/metrics")
+    return http_server
+
+
+def socket_backlog(sock):
+    """ A backlog function for a blocking socket: the bytes the kernel
+    hasn't sent yet, where the OS can tell us (Linux), else None. """
+    if fcntl is None:
+        return lambda: None
+
+    def backlog():
+        try:
+            return struct.unpack("i", fcntl.ioctl(sock, termios.TIOCOUTQ,
+                                                  b"\0\0\0\0"))[0]
+        except (OSError, ValueError):
+            return None
+    return backlog
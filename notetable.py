@@ -0,0 +1,247 @@
+# notetable.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the NoteTable, which holds every note of a chart during
+# runtime. Instead of one dict per note, each note field is its own array
+# (time, lane, duration, judgment code, runtime flags), and a note is just a
+# row index into those arrays. A note's id is always its row index. Both the
+# client and the server keep their notes in one of these, inside the gamestate.
+#
+# A note table can also be opened from a streamed chart (see 
+# chartformat.stream_chart), in which case it starts out empty and notes are 
+# only read from the file, in time order, as far ahead as ensure or 
+# ensure_count ask for.
+#
+# Every chart goes through chartprep.py on its way in: notes are sorted into
+# time order and checked, and each note also gets derived columns (x position,
+# tail time, hit window start and end) so the game loop only has to look them
+# up.
+
+from array import array
+import sys
+from chartformat import PackedChart, load_chart, stream_chart
+from chartprep import ChartError, NoteChecker, derive, derive_note, \
+    time_order, validate
+
+# judgments from worst to best. a judgment's code is its index in this list.
+JUDGMENTS = ['No Credit', 'Poor', 'Fair', 'Good', 'Very Good', 'Excellent']
+NO_CREDIT = 0
+NO_JUDGMENT = -1 # note hasn't been judged yet ("" in .chart files)
+JUDGMENT_CODE = {judgment: code for code, judgment in enumerate(JUDGMENTS)}
+JUDGMENT_CODE[""] = NO_JUDGMENT
+
+# runtime flags, packed into one byte per note
+HOLDING   = 1 # latch state for holds
+COMPLETED = 2 # hold is completed
+FINISHED  = 4 # finished drawing
+PREDICTED = 8 # judgment is our own, not confirmed by the server yet
+
+
+def judgment_name(code):
+    """ Turn a judgment code back into its judgment string. """
+    return "" if code == NO_JUDGMENT else JUDGMENTS[code]
+
+
+class NoteTable:
+    def __init__(self, time=(), lane=(), duration=(), audio=None, offset=0,
+                 end=0):
+        self.time = array('i', time)
+        self.lane = array('B', lane)
+        self.duration = array('i', duration)
+        self.judgment = array('b', [NO_JUDGMENT]) * len(self.time)
+        self.flags = array('B', bytes(len(self.time)))
+        # derived from the columns above (see prepare)
+        self.x, self.tail, self.hit_start, self.hit_end = \
+            derive(self.time, self.lane, self.duration)
+        self.audio = audio
+        self.offset = offset
+        self.end = end
+        # per-lane note ids and times, sorted by time (see build_lane_index)
+        self.lane_notes = {}
+        self.lane_times = {}
+        # notes not read yet, for a streamed chart (None once they all are)
+        self.source = None
+        self.last_time = None # time of the last note read from source
+        self.checker = None # checks notes from source as they're read
+
+    @staticmethod
+    def from_chart(chart):
+        """ Make a note table from a loaded chart, either a PackedChart or a
+        json-style chart object. """
+        if isinstance(chart, PackedChart):
+            table = NoteTable(audio=chart.audio, offset=chart.offset,
+                              end=chart.end)
+            # straight copies out of the mapped file, no per-note objects
+            for name in ("time", "lane", "duration"):
+                getattr(table, name).frombytes(chart.columns[name].cast('B'))
+            table.judgment = array('b', [NO_JUDGMENT]) * len(table.time)
+            table.flags = array('B', bytes(len(table.time)))
+            table.prepare()
+            return table
+        notes = chart['notes']
+        table = NoteTable(time=[n['time'] for n in notes],
+                          lane=[n['lane'] for n in notes],
+                          duration=[n['duration'] for n in notes],
+                          audio=chart.get('audio'),
+                          offset=chart.get('offset', 0), end=chart['end'])
+        for i, note in enumerate(notes):
+            table.judgment[i] = JUDGMENT_CODE[note.get('judgment', "")]
+        table.prepare()
+        return table
+
+    @staticmethod
+    def load(path):
+        """ Load the chart at path (packed or JSON) into a note table. """
+        chart = load_chart(path)
+        table = NoteTable.from_chart(chart)
+        if isinstance(chart, PackedChart):
+            chart.close()
+        return table
+
+    @staticmethod
+    def open(path):
+        """ Open the chart at path without reading its notes yet, if it can
+        be streamed. Otherwise (plain JSON charts) this is the same as load. 
+        """
+        header, notes = stream_chart(path)
+        if notes is None:
+            return NoteTable.load(path)
+        table = NoteTable(audio=header.get('audio'),
+                          offset=header.get('offset', 0), end=header['end'])
+        table.source = notes
+        table.checker = NoteChecker()
+        return table
+
+    def __len__(self):
+        return len(self.time)
+
+    def prepare(self):
+        """ Get a freshly loaded table ready to play: put the notes in time
+        order, make sure the chart can be played (raises ChartError if not),
+        and fill in the derived columns and the lane index. """
+        order = time_order(self.time)
+        if order is not None:
+            for name in ("time", "lane", "duration", "judgment", "flags"):
+                column = getattr(self, name)
+                setattr(self, name, 
+                        array(column.typecode, [column[i] for i in order]))
+        problems = validate(self.time, self.lane, self.duration)
+        if problems:
+            raise ChartError(problems)
+        self.x, self.tail, self.hit_start, self.hit_end = \
+            derive(self.time, self.lane, self.duration)
+        self.build_lane_index()
+
+    def append(self, time, lane, duration):
+        """ Add a note to the end of the table, and to the lane index. Notes
+        have to be appended in time order to keep the lane index sorted. """
+        # time goes last: its length is the table's length, and another 
+        # thread may be looking up judgments as we go
+        x, tail, hit_start, hit_end = derive_note(time, lane, duration)
+        self.x.append(x)
+        self.tail.append(tail)
+        self.hit_start.append(hit_start)
+        self.hit_end.append(hit_end)
+        self.lane.append(lane)
+        self.duration.append(duration)
+        self.judgment.append(NO_JUDGMENT)
+        self.flags.append(0)
+        self.time.append(time)
+        if lane not in self.lane_notes:
+            self.lane_notes[lane] = array('i')
+            self.lane_times[lane] = array('i')
+        self.lane_notes[lane].append(len(self.time) - 1)
+        self.lane_times[lane].append(time)
+        self.last_time = time
+
+    def ensure(self, time):
+        """ Read notes from a streamed chart until every note up to time
+        (in ms) is in the table. Does nothing once the chart is fully read. 
+        """
+        while self.source is not None and \
+                (self.last_time is None or self.last_time <= time):
+            self.read_next()
+
+    def ensure_count(self, count):
+        """ Read notes from a streamed chart until there are count notes in
+        the table, or the chart runs out. """
+        while self.source is not None and len(self.time) < count:
+            self.read_next()
+
+    def read_next(self):
+        """ Read one more note from the streamed chart. The chart is cut
+        off at the first note that can't be played, the same way on every
+        machine that plays it. """
+        note = next(self.source, None)
+        problem = None if note is None else self.checker.check(*note)
+        if problem is not None:
+            print(f"Chart stopped early: {problem}", file=sys.stderr)
+            self.source.close()
+            note = None
+        if note is None:
+            self.source = None # that was the last one
+        else:
+            self.append(*note)
+
+    def copy(self):
+        """ A fresh copy of this table: same notes, no judgments or flags. 
+        Cheaper than loading the chart again. Only for tables that have been
+        read all the way. """
+        table = NoteTable(audio=self.audio, offset=self.offset, end=self.end)
+        table.time = array('i', self.time)
+        table.lane = array('B', self.lane)
+        table.duration = array('i', self.duration)
+        table.judgment = array('b', [NO_JUDGMENT]) * len(self.time)
+        table.flags = array('B', bytes(len(self.time)))
+        # the derived columns and the lane index are never changed after
+        # loading, so they can be shared
+        table.x, table.tail = self.x, self.tail
+        table.hit_start, table.hit_end = self.hit_start, self.hit_end
+        table.lane_notes = self.lane_notes
+        table.lane_times = self.lane_times
+        return table
+
+    def build_lane_index(self):
+        """ Split the note ids up by lane, each lane sorted by time, so the
+        notes of one lane inside a time window can be found with a bisect. This
+        is done once when the chart is loaded, after the notes are sorted. """
+        self.lane_notes = {}
+        self.lane_times = {}
+        for note_id in range(len(self.time)):
+            lane = self.lane[note_id]
+            if lane not in self.lane_notes:
+                self.lane_notes[lane] = array('i')
+                self.lane_times[lane] = array('i')
+            self.lane_notes[lane].append(note_id)
+            self.lane_times[lane].append(self.time[note_id])
+
+    def get_judgment(self, note_id):
+        """ Returns the judgment string of a note, "" if it has none yet. """
+        return judgment_name(self.judgment[note_id])
+
+    def set_judgment(self, note_id, judgment):
+        """ Sets the judgment of a note from a judgment string. """
+        self.judgment[note_id] = JUDGMENT_CODE[judgment]
+
+    def has_flag(self, note_id, flag):
+        return self.flags[note_id] & flag != 0
+
+    def set_flag(self, note_id, flag):
+        self.flags[note_id] |= flag
+
+    def clear_flag(self, note_id, flag):
+        self.flags[note_id] &= ~flag
+
+    def clear_flags(self):
+        """ Reset every note's runtime flags. """
+        self.flags = array('B', bytes(len(self.time)))
+
+    def count_judgments(self):
+        """ Returns a dict of how many notes got each judgment. """
+        counts = dict.fromkeys(JUDGMENTS, 0)
+        for code in self.judgment:
+            if code != NO_JUDGMENT:
+                counts[JUDGMENTS[code]] += 1
+        return counts
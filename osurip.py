@@ -8,67 +8,202 @@
 # formatted for use in the game Snowfall. Some of this code was modified based
 # on a osu! forum post for parsing .osu files.
 #
+# Each .osu file is read in one pass. Hit objects go straight into columns
+# (one array per field) instead of one dict per note, and lanes and durations
+# are worked out a column at a time. The number of lanes comes from the map's
+# key count (CircleSize, for osu!mania maps), and the map's timing points
+# (BPM changes) are kept in the chart too. Output is minified JSON (.chart), or
+# the packed (.chartb) or line (.chartl) formats from chartformat.py, picked by
+# the output file's extension. Batch mode converts a whole folder of maps at
+# once, spread over a pool of processes.
+#
 # Usage: python osurip.py song.osu /path/to/output.chart
+#        python osurip.py --batch library/ /path/to/charts/ --format chartb
 
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import json, sys
+import argparse
+import json
+import os
+import sys
+from chartformat import write_columns, write_lines
 
-def get_general_tags(path):
-    audio = None
-    lead  = 0
-    inside = False
-    with open(path, encoding='utf8') as f:
-        for line in f:
-            if line.startswith('[General]'):
-                inside = True
-                continue
-            if inside:
-                if line.startswith('['):   # next section
-                    break
-                if line.startswith('AudioFilename:'):
-                    audio = line.split(':',1)[1].strip()
-                elif line.startswith('AudioLeadIn:'):
-                    lead = int(line.split(':',1)[1])
-    return audio, lead
-
-def osu_to_chart(path, columns=8):
-    out, note_id = [], 0
-    lane_width = 512 / columns
-    audio, offset = get_general_tags(path)
+MANIA = 3 # Mode for osu!mania maps
+# lanes we have in game
+MAX_LANES = 8
+FORMATS = ('chart', 'chartb', 'chartl')
+
+class OsuMap:
+    """ The parts of a .osu file we use, with hit objects as columns. """
+    def __init__(self):
+        self.audio = None
+        self.lead_in = 0
+        self.mode = 0
+        self.keys = None # osu!mania key count (CircleSize)
+        self.timing = [] # (time, ms per beat) for every BPM change
+        self.x = array('i')
+        self.time = array('i')
+        self.end = array('i') # end time for holds, start time otherwise
+
+
+def parse_osu(path):
+    """ Read a .osu file in one pass. """
+    osu = OsuMap()
+    x, times, ends = osu.x, osu.time, osu.end
+    section = None
     with open(path, encoding='utf8') as f:
-        hitobjects = False
         for line in f:
-            if line.startswith('[HitObjects]'):
-                hitobjects = True
+            if line.startswith('['): # next section
+                section = line.strip()
                 continue
-            if not hitobjects or not line.strip():
-                continue
-            x, y, t, typ, *_rest = line.split(',')[:5]
-            # for some reason, since osu!standard is a game where notes have 
-            # x and y positions, the notes in osu!mania (the vertical-scrolling
-            # rhythm game version) also have x positions.
-            # we divide them up into our lanes here
-            lane = int(int(x) // lane_width) + 1          # 1-based (sorry)
-            t = int(t)
-            typ = int(typ)
-            duration = 0
-            if typ & 128:                                 # hold note
-                end = int(line.split(',')[5].split(':')[0])
-                duration = end - t
-            out.append(
-                dict(id=note_id, lane=lane,
-                     time=t, duration=duration, judgment="")
-            )
-            note_id += 1
-    song_end = max(n['time'] + n['duration'] for n in out)
-    return {"notes": out, "end": song_end + 2000,  # end 2 secs after
-            "audio": audio, "offset": -offset}
+            if section == '[HitObjects]':
+                parts = line.split(',')
+                if len(parts) < 5:
+                    continue
+                t = int(parts[2])
+                x.append(int(parts[0]))
+                times.append(t)
+                if int(parts[3]) & 128: # hold note
+                    ends.append(int(parts[5].partition(':')[0]))
+                else:
+                    ends.append(t)
+            elif section == '[TimingPoints]':
+                parts = line.split(',')
+                # inherited points (uninherited = 0) only change scroll speed
+                if len(parts) >= 2 and (len(parts) < 7 or
+                                        parts[6].strip() == '1'):
+                    osu.timing.append((int(float(parts[0])),
+                                       float(parts[1])))
+            elif section == '[General]':
+                key, _, value = line.partition(':')
+                if key == 'AudioFilename':
+                    osu.audio = value.strip()
+                elif key == 'AudioLeadIn':
+                    osu.lead_in = int(value)
+                elif key == 'Mode':
+                    osu.mode = int(value)
+            elif section == '[Difficulty]':
+                key, _, value = line.partition(':')
+                if key == 'CircleSize':
+                    osu.keys = int(float(value))
+    return osu
+
+
+def to_columns(osu, columns=None):
+    """ Turn a map's hit objects into our note columns (see
+    chartformat.COLUMNS). columns is the number of lanes to split the
+    playfield into; by default it's the map's key count. """
+    if columns is None:
+        columns = osu.keys if osu.keys and osu.keys <= MAX_LANES \
+            else MAX_LANES
+    # for some reason, since osu!standard is a game where notes have x and y
+    # positions, the notes in osu!mania (the vertical-scrolling rhythm game
+    # version) also have x positions. we divide them up into our lanes here
+    lane = array('B', [min(x * columns // 512, columns - 1) + 1 # 1-based
+                       for x in osu.x])
+    duration = array('i', [end - t for t, end in zip(osu.time, osu.end)])
+    return {"time": osu.time, "duration": duration,
+            "id": array('i', range(len(osu.time))), "lane": lane}
+
+
+def song_end(osu):
+    """ When the chart ends: 2 seconds after the last note does. """
+    return max(osu.end, default=0) + 2000
 
-if __name__ == "__main__":
-    # python osurip.py song.osu /path/to/output.chart
-    chart = osu_to_chart(sys.argv[1])            
-    out_path = Path(sys.argv[2]).with_suffix('.chart')
 
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(chart, f, indent=2)
-    print("Wrote ", out_path)
\ No newline at end of file
+def to_chart(osu, columns=None):
+    """ Turn a parsed map into a json-style chart object. """
+    cols = to_columns(osu, columns)
+    notes = [dict(id=i, lane=lane, time=t, duration=duration, judgment="")
+             for i, (lane, t, duration) in
+             enumerate(zip(cols['lane'], cols['time'], cols['duration']))]
+    return {"notes": notes, "end": song_end(osu), "audio": osu.audio,
+            "offset": -osu.lead_in, "timing": osu.timing}
+
+
+def osu_to_chart(path, columns=None):
+    """ Convert a .osu file to a json-style chart object. """
+    return to_chart(parse_osu(path), columns)
+
+
+def write_chart(osu, out_path, columns=None):
+    """ Write a parsed map to out_path, in the format its extension says. 
+    Packed charts are written straight from the columns. """
+    out_path = Path(out_path)
+    if out_path.suffix == '.chartb':
+        write_columns(to_columns(osu, columns), osu.audio, -osu.lead_in,
+                      song_end(osu), out_path)
+        return
+    chart = to_chart(osu, columns)
+    if out_path.suffix == '.chartl':
+        write_lines(chart, out_path)
+    else:
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(chart, f, separators=(',', ':'))
+
+
+def convert_one(job):
+    """ Batch worker: convert one map. Returns (path, error), where error is
+    None if it worked. """
+    path, out_path, columns = job
+    try:
+        osu = parse_osu(path)
+        if osu.mode != MANIA:
+            return path, "not an osu!mania map"
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        write_chart(osu, out_path, columns)
+        return path, None
+    except (OSError, ValueError, IndexError) as e:
+        return path, str(e)
+
+
+def convert_library(library, out_dir, fmt='chart', columns=None, jobs=None):
+    """ Convert every .osu file under library into out_dir (keeping the
+    folder layout), over a pool of jobs processes. Maps that aren't
+    osu!mania maps are skipped. """
+    library, out_dir = Path(library), Path(out_dir)
+    paths = sorted(library.rglob('*.osu'))
+    work = [(path, (out_dir / path.relative_to(library)).with_suffix(
+                '.' + fmt), columns) for path in paths]
+    converted = skipped = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # big chunks keep the per-map overhead of the pool down
+        chunksize = max(1, len(work) // (4 * (jobs or os.cpu_count() or 1)))
+        for path, error in pool.map(convert_one, work, chunksize=chunksize):
+            if error is None:
+                converted += 1
+            else:
+                skipped += 1
+                print(f"Skipped {path}: {error}", file=sys.stderr)
+    print(f"Converted {converted} maps into {out_dir} ({skipped} skipped)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert osu!mania maps to Snowfall charts.")
+    parser.add_argument('source', help='.osu file, or a folder with --batch')
+    parser.add_argument('output', help='Output chart file, or a folder with '
+                                       '--batch')
+    parser.add_argument('--batch', action='store_true',
+                        help='Convert every .osu file under source.')
+    parser.add_argument('--format', choices=FORMATS, default='chart',
+                        help='Output format for --batch.')
+    parser.add_argument('--keys', type=int, default=None,
+                        help='Lanes to use instead of the map\'s key count.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Processes for --batch (default: one per CPU).')
+    args = parser.parse_args()
+
+    if args.batch:
+        convert_library(args.source, args.output, args.format, args.keys,
+                        args.jobs)
+        return
+    out_path = Path(args.output)
+    if out_path.suffix not in ('.chartb', '.chartl'):
+        out_path = out_path.with_suffix('.chart')
+    write_chart(parse_osu(args.source), out_path, args.keys)
+    print("Wrote ", out_path)
+
+if __name__ == "__main__":
+    main()
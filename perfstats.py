@@ -0,0 +1,14 @@
+# perfstats.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file holds the small statistics helpers shared by the tools that
+# measure performance (loadtest.py, bench.py and frameprofile.py).
+
+def percentile(values, fraction):
+    """ The value below which fraction of values fall. """
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
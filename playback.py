@@ -0,0 +1,277 @@
+# playback.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines playback of recorded matches (see replaylog.py). It draws
+# the match as a spectator would have seen it with the client's own drawing
+# code (Client.draw_frame), either in a window you can scrub through or onto an
+# offscreen surface that is saved as a numbered image sequence.
+#
+# Nothing is simulated while playing. When the recording is opened, it is run
+# through the server's rules once to build a timeline: for every note, when it
+# was first judged and when it was first hit, and for every hit that was passed
+# on to the players, when it happened and the score and combo right after. A
+# frame at any song time is then worked out from the timeline alone (a bisect
+# for the notes on screen, and one for the latest judgment), so seeking
+# anywhere costs O(log n), and the same song time always draws the same frame.
+#
+# The server only hears about a hold when it is let go, so a hold that was hit
+# is drawn held from when its head reaches the line until its judgment came in.
+#
+# Window keys: space pauses, left/right seek 5 seconds (with shift, 30), up/down
+# double/halve the speed (0.25x to 8x), 0-9 jump to that tenth of the song,
+# home goes back to the start.
+#
+# Usage: python playback.py match.snowlog --chart song.chart
+#        python playback.py match.snowlog --chart song.chart --speed 2 \
+#            --export frames --fps 30 --start 10000 --end 20000
+
+from array import array
+from bisect import bisect_left, bisect_right
+import argparse
+import os
+import sys
+import pygame
+import chartcache
+from client import Client
+from gamestate import Gamestate
+from layout import JUDGE_Y, SPEED
+from notetable import NoteTable, NO_CREDIT, NO_JUDGMENT, HOLDING, FINISHED, \
+    judgment_name
+from render import HoldBodyCache, Renderer
+from replaylog import ReplayLog
+
+# speeds playback can run at
+MIN_SPEED = 0.25
+MAX_SPEED = 8
+# ms of song time arrow keys seek by (with shift, the bigger one)
+SEEK_STEP = 5000
+BIG_SEEK_STEP = 30000
+SCREEN_SIZE = (1080, 720)
+NEVER = float('inf')
+
+
+class Timeline:
+    """ Everything about a recorded match that changes with time, indexed by
+    song time. Built once, by running the recording through the server's
+    rules; after that nothing is replayed. """
+    def __init__(self, log, notes):
+        self.notes = notes
+        # server as it was when recording started, before any hits
+        server = log.state_at(notes, float('-inf'))
+        count = len(notes)
+        # when each note was first judged (passed on, as anything), and when
+        # it was first hit (anything but NC)
+        self.judged_at = array('d', [NEVER]) * count
+        self.hit_at = array('d', [NEVER]) * count
+        # every hit passed on to the players, in order: when, what, and the
+        # score and combo right after it
+        self.times = array('d')
+        self.codes = array('b')
+        self.scores = array('i')
+        self.combos = array('i')
+        gamestate = server.gamestate
+        for hit_ms, note_id, player, code, _ in \
+                log.hit_records(log.snapshot_offsets[0]):
+            if not server.has_note(note_id):
+                continue
+            if not server.apply_hit(note_id, code, player):
+                continue
+            if self.judged_at[note_id] == NEVER:
+                self.judged_at[note_id] = hit_ms
+            if code != NO_CREDIT and self.hit_at[note_id] == NEVER:
+                self.hit_at[note_id] = hit_ms
+            self.times.append(hit_ms)
+            self.codes.append(code)
+            self.scores.append(gamestate.score)
+            self.combos.append(gamestate.combo)
+        self.end = notes.end
+
+    def last_hit(self, song_ms):
+        """ Index of the last hit passed on at or before song_ms, or -1. """
+        return bisect_right(self.times, song_ms) - 1
+
+    def score_at(self, song_ms):
+        """ (score, combo) at song_ms. """
+        index = self.last_hit(song_ms)
+        if index < 0:
+            return 0, 0
+        return self.scores[index], self.combos[index]
+
+    def judgment_at(self, song_ms):
+        """ The judgment showing on the banner at song_ms, or None. """
+        index = self.last_hit(song_ms)
+        if index < 0:
+            return None
+        return judgment_name(self.codes[index])
+
+    def set_notes(self, song_ms):
+        """ Set the judgments and flags of the notes on screen at song_ms the
+        way they were then. Returns the first of them (the rest of the table
+        isn't looked at when drawing). """
+        notes = self.notes
+        times, durations = notes.time, notes.duration
+        judgments, flags = notes.judgment, notes.flags
+        judged_at, hit_at = self.judged_at, self.hit_at
+        # draw_frame skips notes more than 2 seconds past, like update_notes
+        first = bisect_left(times, song_ms - 2000)
+        last = bisect_right(times, song_ms)
+        for i in range(first, last):
+            judgments[i] = NO_JUDGMENT
+            flags[i] = 0
+            if hit_at[i] <= song_ms:
+                flags[i] = FINISHED # hit, so it's gone
+            elif hit_at[i] != NEVER and durations[i] > 0 and \
+                    song_ms >= times[i] + JUDGE_Y / SPEED:
+                flags[i] = HOLDING # being held down
+            elif judged_at[i] <= song_ms:
+                judgments[i] = NO_CREDIT # falls to the line, then goes
+        return first
+
+
+class Playback:
+    """ Draws a recorded match at any song time, onto surface. """
+    def __init__(self, log, notes, surface, present=True):
+        self.timeline = Timeline(log, notes)
+        gamestate = Gamestate.empty_gamestate()
+        gamestate.notes = notes
+        # a client that only draws: it never plays, so it needs no clock
+        self.client = Client("playback", gamestate, starttime=0)
+        client = self.client
+        client.assets.finish()
+        client.screen = surface
+        client.body_cache = HoldBodyCache(client.assets.body_image,
+                                          surface.get_height())
+        client.renderer = Renderer(surface, client.assets.background_image,
+                                   JUDGE_Y, present=present)
+
+    def draw(self, song_ms):
+        """ Draw the frame at song_ms. """
+        client = self.client
+        client.visible_index = self.timeline.set_notes(song_ms)
+        client.gamestate.recent_judgment = self.timeline.judgment_at(song_ms)
+        client.draw_frame(song_ms)
+
+
+def clamp_speed(speed):
+    return min(MAX_SPEED, max(MIN_SPEED, speed))
+
+
+def format_time(ms):
+    seconds = max(0, ms) / 1000
+    return f"{int(seconds // 60)}:{seconds % 60:04.1f}"
+
+
+def export(playback, directory, start, end, speed, fps):
+    """ Save frames from start to end ms of song time to directory, fps frames
+    for each second of playback at speed. Returns how many were saved. """
+    os.makedirs(directory, exist_ok=True)
+    surface = playback.client.screen
+    step = 1000 / fps * speed # song ms between frames
+    frames = int((end - start) // step) + 1
+    for frame in range(frames):
+        playback.draw(start + frame * step)
+        pygame.image.save(surface, os.path.join(directory,
+                                                f"frame-{frame:06d}.png"))
+    return frames
+
+
+def watch(playback, start, speed, fps):
+    """ Play back in the window until it's closed. """
+    timeline = playback.timeline
+    song_ms = start
+    playing = True
+    clock = pygame.time.Clock()
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return
+            if event.type != pygame.KEYDOWN:
+                continue
+            step = BIG_SEEK_STEP if event.mod & pygame.KMOD_SHIFT \
+                else SEEK_STEP
+            if event.key == pygame.K_SPACE:
+                playing = not playing
+            elif event.key == pygame.K_LEFT:
+                song_ms -= step
+            elif event.key == pygame.K_RIGHT:
+                song_ms += step
+            elif event.key == pygame.K_UP:
+                speed = clamp_speed(speed * 2)
+            elif event.key == pygame.K_DOWN:
+                speed = clamp_speed(speed / 2)
+            elif event.key == pygame.K_HOME:
+                song_ms = 0
+            elif pygame.K_0 <= event.key <= pygame.K_9:
+                song_ms = timeline.end * (event.key - pygame.K_0) / 10
+        song_ms = min(max(song_ms, 0), timeline.end)
+        playback.draw(song_ms)
+        score, combo = timeline.score_at(song_ms)
+        pygame.display.set_caption(
+            f"Playback: {format_time(song_ms)} / {format_time(timeline.end)}"
+            f" at {speed:g}x{'' if playing else ' (paused)'} -- score "
+            f"{score}, combo {combo}")
+        elapsed = clock.tick(fps)
+        if playing:
+            song_ms += elapsed * speed
+            if song_ms >= timeline.end:
+                playing = False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play back a recorded match, or save it as images.")
+    parser.add_argument('log', help='Recording from snowfall_server --record.')
+    parser.add_argument('--chart', required=True,
+                        help='The chart the match was played on.')
+    parser.add_argument('--speed', type=float, default=1,
+                        help=f'Playback speed, {MIN_SPEED:g}x to '
+                             f'{MAX_SPEED:g}x.')
+    parser.add_argument('--start', type=float, default=0,
+                        help='Song time (ms) to start from.')
+    parser.add_argument('--end', type=float, default=None,
+                        help='Song time (ms) to export up to (default: the '
+                             'end of the song).')
+    parser.add_argument('--fps', type=int, default=60,
+                        help='Frames per second of playback.')
+    parser.add_argument('--export', type=str, default=None,
+                        help='Save frames as PNGs in this directory instead '
+                             'of opening a window.')
+    args = parser.parse_args()
+    if not MIN_SPEED <= args.speed <= MAX_SPEED:
+        parser.error(f"--speed must be between {MIN_SPEED:g} and "
+                     f"{MAX_SPEED:g}")
+    if args.fps <= 0:
+        parser.error("--fps must be positive")
+
+    try:
+        log = ReplayLog(args.log)
+        notes = NoteTable.load(args.chart)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if chartcache.hash_file(args.chart) != log.chart_sha256:
+        print(f"Warning: {args.chart} is not the chart this match was "
+              f"played on.", file=sys.stderr)
+
+    if args.export is not None:
+        # no window: the display only has to exist to convert images for
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    display = pygame.display.set_mode(SCREEN_SIZE)
+    if args.export is None:
+        playback = Playback(log, notes, display)
+        watch(playback, args.start, args.speed, args.fps)
+    else:
+        surface = pygame.Surface(SCREEN_SIZE).convert()
+        playback = Playback(log, notes, surface, present=False)
+        end = playback.timeline.end if args.end is None else args.end
+        frames = export(playback, args.export, args.start, end, args.speed,
+                        args.fps)
+        print(f"Saved {frames} frames to {args.export}")
+    pygame.quit()
+    log.close()
+
+if __name__ == "__main__":
+    main()
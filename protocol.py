@@ -0,0 +1,135 @@
+# protocol.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines the binary messages that snowfall_client and
+# snowfall_server send each other during gameplay. Every message starts with a
+# protocol version byte and a message type byte, and each message type has a
+# fixed size, so a reader always knows how much more to read after the first
+# two bytes. Messages are packed with precompiled structs, and written either
+# one at a time with sendall or several at a time with send_all.
+#
+# A hit message is: version, type, player index, judgment code, note id.
+# Clients don't know their own player index, so they send NO_PLAYER and the
+# server fills it in when it passes the hit on.
+#
+# A time request is: version, type, the client's clock when it was sent. The
+# server answers right away with a time response: version, type, the time from
+# the request, and the server's clock when the request came in and when the
+# response went out. Times are seconds, as doubles (see clocksync.py).
+
+import struct
+
+VERSION = 1
+
+# message types
+HIT = 1
+TIME_REQUEST = 2
+TIME_RESPONSE = 3
+
+NO_PLAYER = 255
+
+HEADER = struct.Struct("!BB") # version, type
+# version, type, player index, judgment code, note id
+HIT_MESSAGE = struct.Struct("!BBBbI")
+# version, type, client send time
+TIME_REQUEST_MESSAGE = struct.Struct("!BBd")
+# version, type, client send time, server receive time, server send time
+TIME_RESPONSE_MESSAGE = struct.Struct("!BBddd")
+
+# message type -> total size of that message in bytes
+SIZES = {HIT: HIT_MESSAGE.size, 
+         TIME_REQUEST: TIME_REQUEST_MESSAGE.size,
+         TIME_RESPONSE: TIME_RESPONSE_MESSAGE.size}
+
+# most buffers one sendmsg call takes (IOV_MAX on Linux and macOS)
+MAX_BUFFERS = 1024
+
+
+class ProtocolError(ValueError):
+    """ Raised when a peer sends something that isn't a valid message. """
+
+
+def encode_hit(player, note_id, judgment):
+    """ Pack a hit message. judgment is a judgment code (see notetable). """
+    return HIT_MESSAGE.pack(VERSION, HIT, player, judgment, note_id)
+
+
+def decode_hit(message):
+    """ Unpack a hit message into (player, note_id, judgment code). """
+    _, _, player, judgment, note_id = HIT_MESSAGE.unpack(message)
+    return player, note_id, judgment
+
+
+def encode_time_request(sent):
+    """ Pack a time request sent at client time sent. """
+    return TIME_REQUEST_MESSAGE.pack(VERSION, TIME_REQUEST, sent)
+
+
+def decode_time_request(message):
+    """ Unpack a time request into the client time it was sent at. """
+    return TIME_REQUEST_MESSAGE.unpack(message)[2]
+
+
+def encode_time_response(client_sent, received, sent):
+    """ Pack a time response: the request's client time, and server times 
+    for when the request was received and when this response was sent. """
+    return TIME_RESPONSE_MESSAGE.pack(VERSION, TIME_RESPONSE, client_sent, 
+                                      received, sent)
+
+
+def decode_time_response(message):
+    """ Unpack a time response into (client_sent, received, sent). """
+    return TIME_RESPONSE_MESSAGE.unpack(message)[2:]
+
+
+def send_all(sock, messages):
+    """ Send a list of messages. Where the OS supports it this is one 
+    vectored write (sendmsg) for the whole list; otherwise (Windows) the 
+    messages are joined and sent with one sendall. """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(messages))
+        return
+    buffers = [memoryview(message) for message in messages]
+    first = 0 # index of the first buffer not fully sent yet
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + MAX_BUFFERS])
+        # skip whatever was fully sent, and trim a partly sent buffer
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+def recv_exact(sock, length):
+    """ Receive exactly length bytes. Returns fewer (possibly none) if the
+    connection closed first. """
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return bytes(data[:received])
+        received += count
+    return bytes(data)
+
+
+def read_message(sock):
+    """ Read one whole message from sock. Returns (message type, message
+    bytes), or None if the connection closed. Raises ProtocolError if the
+    message has the wrong version or an unknown type. """
+    header = recv_exact(sock, HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    version, message_type = HEADER.unpack(header)
+    if version != VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if message_type not in SIZES:
+        raise ProtocolError(f"unknown message type {message_type}")
+    rest = recv_exact(sock, SIZES[message_type] - HEADER.size)
+    if len(rest) < SIZES[message_type] - HEADER.size:
+        return None
+    return message_type, header + rest
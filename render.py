@@ -0,0 +1,125 @@
+# render.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file holds drawing helpers used by the client's gameplay loop. The hold
+# body cache keeps hold-note bodies pre-tiled, so drawing a long note is a
+# single blit out of a surface we already have instead of tiling the body image
+# (and allocating a surface for the clipped last tile) every frame. The 
+# renderer owns clearing and presenting frames, and can optionally only redraw
+# the parts of the screen that changed, or draw onto an offscreen surface and
+# never present at all (see playback.py).
+
+import pygame
+
+class HoldBodyCache:
+    # strip heights are rounded up to a multiple of this, so a handful of 
+    # strips covers every hold length
+    BUCKET = 128
+
+    def __init__(self, body_image, max_height):
+        self.body_image = body_image
+        self.width, self.tile_height = body_image.get_size()
+        self.max_height = max_height # nothing below this is ever visible
+        self.strips = {} # bucketed height -> pre-tiled surface
+
+    def strip(self, height):
+        """ Returns a pre-tiled strip at least height + one tile tall, building
+        it the first time a strip that size is asked for. The extra tile lets
+        the strip be blitted starting partway into a tile. """
+        bucket = -(-height // self.BUCKET) * self.BUCKET # round up
+        bucket = min(bucket, self.max_height)
+        strip = self.strips.get(bucket)
+        if strip is None:
+            strip = pygame.Surface((self.width, bucket + self.tile_height), 
+                                   pygame.SRCALPHA)
+            for y in range(0, bucket + self.tile_height, self.tile_height):
+                # adding onto a fully transparent surface copies the pixels
+                # exactly, without blending the alpha twice
+                strip.blit(self.body_image, (0, y), 
+                           special_flags=pygame.BLEND_RGBA_ADD)
+            self.strips[bucket] = strip
+        return strip
+
+    def draw(self, screen, x, top_y, height):
+        """ Draw a hold body from top_y down, height pixels tall, with the body
+        image tiled from top_y. Only the part that is on screen is blitted. 
+        Returns the rectangle drawn to (None if nothing was visible). """
+        top = int(top_y)
+        bottom = int(top_y + height)
+        visible_top = max(top, 0)
+        visible_bottom = min(bottom, self.max_height)
+        if visible_bottom <= visible_top:
+            return None
+        # where in the tile pattern the visible part starts
+        phase = (visible_top - top) % self.tile_height
+        visible_height = visible_bottom - visible_top
+        return screen.blit(self.strip(visible_height), (x, visible_top), 
+                           (0, phase, self.width, visible_height))
+
+
+class Renderer:
+    """ Draws frames onto the screen. In the default mode every frame clears
+    the whole screen and flips it. In dirty-rectangle mode only the rectangles
+    drawn to in the last frame are cleared, and only those plus the ones drawn
+    to in this frame are pushed to the display, so a sparse part of a chart 
+    only costs the few notes that are actually on screen. With present off,
+    screen can be any surface, and frames are left on it instead of being
+    pushed to the display. """
+    def __init__(self, screen, background, judge_y, dirty_rects=False,
+                 present=True):
+        self.screen = screen
+        self.background = background
+        self.judge_y = judge_y
+        self.dirty_rects = dirty_rects
+        self.present = present
+        self.drawn = []      # rectangles drawn to this frame
+        self.last_drawn = [] # rectangles drawn to last frame, to be erased
+        self.full_redraw = True # first frame always draws everything
+
+    def clear(self, rect=None):
+        """ Redraw the background and judgment line, either over the whole 
+        screen or only inside rect. """
+        self.screen.set_clip(rect)
+        self.screen.fill((0, 0, 0))
+        self.screen.blit(self.background, (0, 0))
+        pygame.draw.line(self.screen, (255, 255, 255), (0, self.judge_y), 
+                         (self.screen.get_width(), self.judge_y), 5)
+        self.screen.set_clip(None)
+
+    def begin_frame(self):
+        """ Erase whatever the last frame drew. """
+        if not self.dirty_rects or self.full_redraw:
+            self.clear()
+            return
+        for rect in self.last_drawn:
+            self.clear(rect)
+
+    def blit(self, surface, pos, area=None):
+        """ Blit onto the screen, remembering where we drew. """
+        rect = self.screen.blit(surface, pos, area)
+        if self.dirty_rects:
+            self.drawn.append(rect)
+        return rect
+
+    def mark(self, rect):
+        """ Remember a rectangle that was drawn to directly on the screen. """
+        if self.dirty_rects and rect is not None:
+            self.drawn.append(rect)
+
+    def end_frame(self):
+        """ Push this frame to the display. """
+        if not self.present:
+            return
+        if not self.dirty_rects:
+            pygame.display.flip()
+            return
+        if self.full_redraw:
+            pygame.display.update()
+            self.full_redraw = False
+        else:
+            # erased rectangles need updating too, or old notes stay visible
+            pygame.display.update(self.last_drawn + self.drawn)
+        self.last_drawn = self.drawn
+        self.drawn = []
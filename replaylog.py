@@ -0,0 +1,272 @@
+# replaylog.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines match recording (snowfall_server --record) and the tool
+# that reads recordings back. While a match is played, every hit the server
+# applies is appended to a compact binary log along with what came of it, and
+# every few seconds a snapshot of the whole score state (every note's
+# judgment, what each player said about each note, score, combo, max combo)
+# is appended too. The gameplay thread only packs a record and puts it on a
+# queue; a background thread does the writing, so play never waits on the
+# disk.
+#
+# To see the match as it stood at any moment, the reader jumps to the last
+# snapshot before it and applies the hits after that snapshot with the
+# server's own apply_hit, so the result is exactly what the server had.
+#
+# A log is a header (magic, version, players, when the song started on the
+# server's clock, SHA-256 of the chart) followed by records, each one type
+# byte and then:
+#     hit:      song time (ms), note id, player, judgment code, passed on
+#     snapshot: song time (ms), score, combo, max combo, note count, then the
+#               note judgments, miss counts and per-player judgments arrays
+# Song time is ms since the song started, the same clock the chart uses.
+#
+# Usage: python replaylog.py match.snowlog --chart song.chart
+#        python replaylog.py match.snowlog --chart song.chart --at 30000
+
+from array import array
+from bisect import bisect_right
+import argparse
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+import chartcache
+from gamestate import Gamestate
+from notetable import NoteTable
+from server import Server
+from stats import Stats
+
+MAGIC = b"SNWL"
+VERSION = 1
+# magic, version, players, song start (server clock, s), chart sha256
+HEADER = struct.Struct("<4sHBd32s")
+# record types
+HIT = 1
+SNAPSHOT = 2
+# song time (ms), note id, player, judgment code, passed on to everyone
+HIT_RECORD = struct.Struct("<dIBbB")
+# song time (ms), score, combo, max combo, note count
+SNAPSHOT_RECORD = struct.Struct("<diiiI")
+# seconds of play between snapshots
+SNAPSHOT_INTERVAL = 5.0
+
+
+class ReplayRecorder:
+    """ Records one server's match to a file. Everything but close is called
+    from the thread that owns the server. """
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.file = open(path, 'wb')
+        self.queue = queue.SimpleQueue() # packed records; None to stop
+        self.thread = threading.Thread(target=self._write, name="recorder",
+                                       daemon=True)
+        self.thread.start()
+        self.song_start = None # set by begin
+        self.perf_anchor = None
+        self.next_snapshot = None
+
+    def _write(self):
+        """ Writer thread: write records as they come, flushing whenever
+        we've caught up. """
+        with self.file:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    return
+                self.file.write(record)
+                if self.queue.empty():
+                    self.file.flush()
+
+    def song_time(self, stamp):
+        """ A perf_counter stamp as ms of song time. """
+        return 1000 * (stamp - self.perf_anchor)
+
+    def begin(self, server, song_start):
+        """ Start the log: song_start is when the song starts on the server's
+        clock (time.time()). """
+        # song time from here on comes from perf_counter, so it can't jump
+        self.perf_anchor = time.perf_counter() - (time.time() - song_start)
+        self.song_start = song_start
+        sha256 = server.blobs["chart"].sha256 if "chart" in server.blobs \
+            else "00" * 32
+        self.queue.put(HEADER.pack(MAGIC, VERSION, server.num_players,
+                                   song_start, bytes.fromhex(sha256)))
+        self.snapshot(server)
+
+    def hit(self, stamp, note_id, code, player, passed_on):
+        """ Record one applied hit, pushed at stamp (perf_counter). """
+        self.queue.put(bytes((HIT,)) + HIT_RECORD.pack(
+            self.song_time(stamp), note_id, player, code, passed_on))
+
+    def maybe_snapshot(self, server):
+        """ Take a snapshot if it's been long enough since the last one. """
+        if time.perf_counter() >= self.next_snapshot:
+            self.snapshot(server)
+
+    def snapshot(self, server):
+        """ Record the server's whole score state as it is now. """
+        now = time.perf_counter()
+        self.next_snapshot = now + self.interval
+        gamestate = server.gamestate
+        judgments = gamestate.notes.judgment
+        count = len(server.misses) # notes the server has looked at so far
+        self.queue.put(
+            bytes((SNAPSHOT,)) +
+            SNAPSHOT_RECORD.pack(self.song_time(now), gamestate.score,
+                                 gamestate.combo, server.stats.max_combo,
+                                 count) +
+            judgments[:count].tobytes() + server.misses.tobytes() +
+            server.player_judgments.tobytes())
+
+    def close(self, server=None):
+        """ Take a last snapshot of server (if given and the log was begun),
+        then finish writing and close the file. """
+        if server is not None and self.perf_anchor is not None:
+            self.snapshot(server)
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ReplayLog:
+    """ A recorded match, opened for reading. """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size:
+            raise ValueError(f"{path} is not a match recording")
+        magic, version, self.players, self.song_start, sha256 = \
+            HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a match recording")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported version {version}")
+        self.chart_sha256 = sha256.hex()
+        # (song time, offset) of every snapshot, found by hopping over
+        # records without decoding the hits
+        self.snapshot_times = []
+        self.snapshot_offsets = []
+        self.end = HEADER.size # where the last whole record ends
+        self.hits = 0
+        offset = HEADER.size
+        size = len(self._mmap)
+        while offset < size:
+            kind = self._mmap[offset]
+            if kind == HIT:
+                length = 1 + HIT_RECORD.size
+                self.hits += 1
+            elif kind == SNAPSHOT and \
+                    offset + 1 + SNAPSHOT_RECORD.size <= size:
+                song_ms, _, _, _, count = \
+                    SNAPSHOT_RECORD.unpack_from(self._mmap, offset + 1)
+                length = 1 + SNAPSHOT_RECORD.size + \
+                    count * (2 + self.players)
+                if offset + length <= size:
+                    self.snapshot_times.append(song_ms)
+                    self.snapshot_offsets.append(offset)
+            else:
+                break # a record cut off by a crash, or garbage
+            if offset + length > size:
+                break
+            offset += length
+            self.end = offset
+        if not self.snapshot_offsets:
+            raise ValueError(f"{path} has no snapshots")
+
+    def close(self):
+        self._mmap.close()
+
+    def hit_records(self, offset=HEADER.size):
+        """ Every hit from offset on, as (song ms, note id, player, judgment
+        code, passed on). """
+        data = self._mmap
+        while offset < self.end:
+            kind = data[offset]
+            if kind == HIT:
+                yield HIT_RECORD.unpack_from(data, offset + 1)
+                offset += 1 + HIT_RECORD.size
+            else:
+                count = SNAPSHOT_RECORD.unpack_from(data, offset + 1)[4]
+                offset += 1 + SNAPSHOT_RECORD.size + count * (2 + self.players)
+
+    def state_at(self, notes, song_ms=None):
+        """ The server as it was song_ms into the song (the end of the match
+        if None), rebuilt on a copy of notes (the chart's note table). """
+        if song_ms is None:
+            song_ms = float('inf')
+        index = max(0, bisect_right(self.snapshot_times, song_ms) - 1)
+        offset = self.snapshot_offsets[index]
+        data = self._mmap
+        _, score, combo, max_combo, count = \
+            SNAPSHOT_RECORD.unpack_from(data, offset + 1)
+        if count > len(notes):
+            raise ValueError("the log has more notes than the chart")
+        start = offset + 1 + SNAPSHOT_RECORD.size
+        gamestate = Gamestate.empty_gamestate()
+        server = Server(stats=Stats.empty_stats(), gamestate=gamestate,
+                        num_players=self.players)
+        notes = notes.copy()
+        server.set_notes(notes)
+        server.has_note(count - 1)
+        notes.judgment[:count] = array('b', data[start:start + count])
+        start += count
+        server.misses[:count] = array('B', data[start:start + count])
+        start += count
+        slots = count * self.players
+        server.player_judgments[:slots] = \
+            array('b', data[start:start + slots])
+        gamestate.score = score
+        gamestate.combo = combo
+        server.stats.max_combo = max_combo
+        server.stats.score = score
+        # then play the hits after the snapshot forward with the server's
+        # own rules
+        for hit_ms, note_id, player, code, _ in \
+                self.hit_records(start + slots):
+            if hit_ms > song_ms:
+                break
+            if server.has_note(note_id):
+                server.apply_hit(note_id, code, player)
+        server.stats.score = gamestate.score
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show a recorded match as it stood at some moment.")
+    parser.add_argument('log', help='Recording from snowfall_server --record.')
+    parser.add_argument('--chart', required=True,
+                        help='The chart the match was played on.')
+    parser.add_argument('--at', type=float, default=None,
+                        help='Song time in ms (default: the end).')
+    args = parser.parse_args()
+
+    try:
+        log = ReplayLog(args.log)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if chartcache.hash_file(args.chart) != log.chart_sha256:
+        print(f"Warning: {args.chart} is not the chart this match was "
+              f"played on.", file=sys.stderr)
+    server = log.state_at(NoteTable.load(args.chart), args.at)
+    print(f"{log.hits} hits and {len(log.snapshot_times)} snapshots from "
+          f"{log.players} players")
+    at = "end of the match" if args.at is None else f"{args.at:g} ms"
+    print(f"At {at}:")
+    print(f"Score      : {server.gamestate.score}")
+    print(f"Combo      : {server.gamestate.combo}")
+    print(f"Max combo  : {server.stats.max_combo}")
+    for judgment, count in server.gamestate.notes.count_judgments().items():
+        print(f"{judgment:<11}: {count}")
+    log.close()
+
+if __name__ == "__main__":
+    main()
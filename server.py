@@ -9,76 +9,203 @@
 # determine if that message needs to be passed back to the clients. This also
 # handles chart file parsing on the server side.
 
-import json
 import threading
+import time
+from array import array
+import chartcache
+from metrics import Metrics
+from notetable import NoteTable, JUDGMENT_CODE, NO_CREDIT, NO_JUDGMENT
 
 def better(judgment1, judgment2):
     """ Returns true if judgment1 is better than judgment2. 
     E > VG > G > F > P > NC. """ 
-    judgments = ['No Credit', 'Poor', 'Fair', 'Good', 'Very Good', 'Excellent']
-    return judgments.index(judgment1) > judgments.index(judgment2)
+    return JUDGMENT_CODE[judgment1] > JUDGMENT_CODE[judgment2]
+
+# points for each judgment code, No Credit (0) through Excellent (5)
+SCORES = array('H', [0, 100, 200, 300, 400, 500])
 
 def calcscore(judgment):
     """ Returns a number score to increment given a judgment string. """
-    if judgment == 'No Credit':
-        return 0
-    elif judgment == 'Poor':
-        return 100
-    elif judgment == 'Fair':
-        return 200
-    elif judgment == 'Good':
-        return 300
-    elif judgment == 'Very Good':
-        return 400
-    elif judgment == 'Excellent':
-        return 500
-    else:
+    if judgment not in JUDGMENT_CODE or judgment == "":
         raise ValueError("Invalid judgment value")
+    return SCORES[JUDGMENT_CODE[judgment]]
+
+class HitRing:
+    """ A fixed-size ring buffer of hit events (note id, judgment code, 
+    player, and when it was pushed) waiting to be applied to the gamestate. 
+    Each event is one slot in four parallel arrays, so pushing never 
+    allocates. Only one thread (the server's owner) should push and drain. 
+    """
+    def __init__(self, capacity=1024):
+        # capacity is rounded up to a power of two so we can mask, not mod
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.mask = size - 1
+        self.note_ids = array('I', [0]) * size
+        self.codes = array('b', [0]) * size
+        self.players = array('B', [0]) * size
+        self.stamps = array('d', [0.0]) * size # perf_counter at push
+        self.head = 0 # total events read
+        self.tail = 0 # total events written
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def push(self, note_id, code, player):
+        """ Add an event. Returns False (and drops it) if the ring is full. """
+        if self.tail - self.head > self.mask:
+            return False
+        slot = self.tail & self.mask
+        self.note_ids[slot] = note_id
+        self.codes[slot] = code
+        self.players[slot] = player
+        self.stamps[slot] = time.perf_counter()
+        self.tail += 1
+        return True
+
+    def pop(self):
+        """ Remove and return the oldest event as (note id, code, player,
+        stamp). """
+        slot = self.head & self.mask
+        self.head += 1
+        return (self.note_ids[slot], self.codes[slot], self.players[slot],
+                self.stamps[slot])
 
 class Server:
-    def __init__(self, stats, gamestate):
+    def __init__(self, stats, gamestate, num_players=2, metrics=None):
         self.stats = stats # only display at end of song
         self.gamestate = gamestate
-        self.gamestatelock = threading.Lock() # lock for gamestate
+        # lock for gamestate, only used by receive_score and set_notes. 
+        # Gameplay loops own the server and use push_hit/apply_hits instead.
+        self.gamestatelock = threading.Lock()
+        self.num_players = num_players # players in this match
+        self.hits = HitRing() # hits received but not applied yet
+        self.blobs = {} # chart and audio files clients can ask us for
+        # counted by whoever owns the server (see metrics.py)
+        self.metrics = metrics if metrics is not None else Metrics()
+        # writes every applied hit to a match recording (see replaylog.py)
+        self.recorder = None
+        self.set_notes(gamestate.notes)
 
     def parse_chart(self, chartpath):
-        """ Turn chart at filepath into json object. """
-        # encoding UTF-8 to handle weird outputs from chart conversion script
-        with open(chartpath, 'r', encoding="utf-8") as file: 
-            data = json.load(file)
+        """ Open chart at filepath as the gamestate's note table. Works for
+        packed .chartb, line .chartl and plain JSON .chart files. Streamable
+        charts are read lazily, as hits for their notes come in. """
+        data = NoteTable.open(chartpath)
         print(f"Chart at {chartpath} loaded successfully!")
+        # what we'll hand to clients that don't have the chart yet
+        self.blobs = chartcache.chart_blobs(chartpath, data.audio)
+        self.set_notes(data)
+
+    def set_notes(self, notes):
+        """ Make notes the gamestate's note table, and clear what every player
+        has sent us about them. """
         with self.gamestatelock:
-            self.gamestate.notes = data 
+            self.gamestate.notes = notes 
+            # each player's own judgment of each note, note by note: player p's
+            # judgment of note n is at n * num_players + p
+            self.player_judgments = \
+                array('b', [NO_JUDGMENT]) * (len(notes) * self.num_players)
+            # how many players have missed each note
+            self.misses = array('B', bytes(len(notes)))
+
+    def has_note(self, note_id):
+        """ Returns true if note_id is a note in the chart, reading further
+        into a streamed chart if it has to. """
+        notes = self.gamestate.notes
+        if note_id >= len(self.misses):
+            notes.ensure_count(note_id + 1)
+            # make room for the new notes' judgments
+            added = len(notes) - len(self.misses)
+            if added > 0:
+                self.player_judgments.extend(
+                    array('b', [NO_JUDGMENT]) * (added * self.num_players))
+                self.misses.extend(bytes(added))
+        return 0 <= note_id < len(notes)
 
-    def receive_score(self, note_id, judgment):
+    def push_hit(self, note_id, code, player=0):
+        """ Queue a hit from player for the next apply_hits. Returns False if
+        too many hits are waiting, in which case apply them and push again. """
+        return self.hits.push(note_id, code, player)
+
+    def apply_hits(self, notify):
+        """ Apply every queued hit, in the order they came in, and call 
+        notify(player, note_id, code) for each one all clients should hear
+        about. Only the thread that owns this server may call this. """
+        hits = self.hits
+        depth = len(hits)
+        if not depth:
+            return
+        metrics = self.metrics
+        recorder = self.recorder
+        started = time.perf_counter()
+        while hits.tail != hits.head:
+            note_id, code, player, stamp = hits.pop()
+            passed_on = self.apply_hit(note_id, code, player)
+            if passed_on:
+                notify(player, note_id, code)
+            metrics.applied(stamp, time.perf_counter(), note_id, code, player,
+                            passed_on)
+            if recorder is not None:
+                recorder.hit(stamp, note_id, code, player, passed_on)
+        metrics.apply_pass(depth, time.perf_counter() - started)
+        if recorder is not None:
+            recorder.maybe_snapshot(self)
+
+    def apply_hit(self, note_id, code, player):
         """ Handle received score: update single point of truth gamestate, 
-        stats object. Indicate if this information should be passed on to both 
-        clients. We should do this if both clients scored NC on this note, or 
-        when the first client doesn't score NC. If we already have a non-NC 
-        judgment saved for a note, and we receive an NC judgment, we don't 
-        care."""
-        # assign points to the note for all of our very competitive players
-        score = calcscore(judgment) 
-        tellOtherPlayer = False # update if we should send 
-        # both client listening threads could be here at the same time
-        with self.gamestatelock: 
-            # get the note from the gamestate
-            our_note = self.gamestate.notes['notes'][note_id]  
-            # case where both players miss
-            if judgment == 'No Credit' and our_note['judgment'] == 'No Credit': 
+        stats object. Indicate if this information should be passed on to all 
+        clients. We should do this when the first judgment for a note comes 
+        in, when the first non-NC judgment comes in, and when every player 
+        has scored NC on this note (that's when it actually counts as a miss).
+        If we already have a non-NC judgment saved for a note, and we receive 
+        an NC judgment, we don't care. A player telling us they missed the 
+        same note twice only counts once. Takes no lock: only the server's 
+        owner calls this. """
+        judgments = self.gamestate.notes.judgment
+        # get the note's current judgment from the gamestate
+        current = judgments[note_id]
+        slot = note_id * self.num_players + player
+        if code == NO_CREDIT:
+            if self.player_judgments[slot] != NO_JUDGMENT:
+                # this player already told us about this note
+                return False
+            self.player_judgments[slot] = code
+            self.misses[note_id] += 1
+            tellOtherPlayer = False # update if we should send 
+            # first word on this note: record the NC for now
+            if current == NO_JUDGMENT:
+                judgments[note_id] = code
+                tellOtherPlayer = True
+            # case where every player misses
+            if self.misses[note_id] == self.num_players:
                 # then we actually have a miss
                 self.gamestate.combo = 0 # reset combo
                 tellOtherPlayer = True    
-            # case where we have a first non-NC score
-            elif our_note['judgment'] == "" or \
-                    our_note['judgment'] == 'No Credit': 
-                # scoring when there's no score yet
-                our_note['judgment'] = judgment
-                self.gamestate.update_score(score)
-                # increment combo if the note was hit
-                if judgment != 'No Credit':
-                    self.gamestate.combo += 1 
-                    self.stats.update_max_combo(self.gamestate.combo) 
-                tellOtherPlayer = True
-            # else we don't do anything and we don't need to inform anyone
-        return tellOtherPlayer
+            return tellOtherPlayer
+        self.player_judgments[slot] = code
+        # case where we have a first non-NC score (NC is 0, nothing is -1)
+        if current <= NO_CREDIT: 
+            # assign points to the note for all of our very competitive players
+            judgments[note_id] = code
+            gamestate = self.gamestate
+            gamestate.score += SCORES[code]
+            # increment combo since the note was hit
+            gamestate.combo += 1 
+            if gamestate.combo > self.stats.max_combo:
+                self.stats.max_combo = gamestate.combo
+            return True
+        # else we don't do anything and we don't need to inform anyone
+        return False
+
+    def receive_score(self, note_id, judgment, player=0):
+        """ The old way in: apply one hit given as a judgment string, right 
+        away and under the gamestate lock, so any thread can call it. Returns
+        whether all clients should be told. """
+        code = JUDGMENT_CODE[judgment]
+        # client listening threads could be here at the same time
+        with self.gamestatelock: 
+            if not self.has_note(note_id):
+                raise IndexError(f"no note {note_id} in the chart")
+            return self.apply_hit(note_id, code, player)
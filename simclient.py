@@ -0,0 +1,110 @@
+# simclient.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# This file defines a simulated Snowfall client for load testing. It follows
+# the same handshake as snowfall_client.main and speaks the same binary hit
+# messages, but it has no window or game loop: whoever uses it decides which
+# hits to send and when. It runs on asyncio so one process can drive hundreds
+# of them.
+
+import asyncio
+import struct
+from chartcache import LENGTH, encode_json
+from clocksync import ClockSync, HANDSHAKE_SAMPLES
+from protocol import HEADER, HIT, SIZES, NO_PLAYER, TIME_RESPONSE, \
+    encode_hit, decode_hit
+
+class SimClient:
+    def __init__(self, name, reader, writer, future_time, rtt):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.future_time = future_time # start time the server gave us
+        self.rtt = rtt # best round trip time of the handshake, in seconds
+        self.sync = ClockSync() # our clock against the server's
+
+    @staticmethod
+    async def connect(host, port, name):
+        """ Connect to a server and do the handshake. """
+        client = await SimClient.open(host, port, name)
+        await client.handshake()
+        return client
+
+    @staticmethod
+    async def open(host, port, name):
+        """ Open the connection but don't do the handshake yet. The server
+        won't finish the handshake until its match is full, so to fill a match
+        from one task, open every connection first and then handshake. """
+        reader, writer = await asyncio.open_connection(host, port)
+        return SimClient(name, reader, writer, None, None)
+
+    async def handshake(self):
+        """ The same handshake as snowfall_client.main. """
+        reader, writer = self.reader, self.writer
+        # the server asks for our name
+        await reader.readexactly(len(b"Retrieving client name..."))
+        name_bytes = self.name.encode()
+        writer.write(struct.pack("!I", len(name_bytes)) + name_bytes)
+        # receive acknowledgment for connection
+        await reader.readexactly(len(b"Connection Established"))
+        writer.write(b"ACK")
+        # we don't play the chart, so we don't need the server's files
+        length = LENGTH.unpack(await reader.readexactly(LENGTH.size))[0]
+        await reader.readexactly(length)
+        writer.write(encode_json([]))
+        # sync clocks
+        await reader.readexactly(5)
+        for _ in range(HANDSHAKE_SAMPLES):
+            writer.write(self.sync.request())
+            message = await self.read_message()
+            if message is None or message[0] != TIME_RESPONSE:
+                raise ConnectionError("server didn't answer a time request")
+            self.sync.receive(message[1])
+        self.rtt = self.sync.rtt
+        # receive the future time from the server (on the server's clock)
+        self.future_time = struct.unpack("!d", await reader.readexactly(8))[0]
+        writer.write(b"ACK")
+        await writer.drain()
+
+    def send_hit(self, note_id, judgment):
+        """ Send a hit (judgment is a judgment code) without waiting. """
+        self.writer.write(encode_hit(NO_PLAYER, note_id, judgment))
+
+    def send_time_request(self):
+        """ Ask for another time sample; read_hit takes in the answer. """
+        self.writer.write(self.sync.request())
+
+    async def read_message(self):
+        """ Read one whole message. Returns (message type, message bytes),
+        or None if the server closed the connection. """
+        try:
+            header = await self.reader.readexactly(HEADER.size)
+            _, message_type = HEADER.unpack(header)
+            rest = await self.reader.readexactly(SIZES[message_type] -
+                                                 HEADER.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return message_type, header + rest
+
+    async def read_hit(self):
+        """ Wait for the next hit the server passes on. Returns (player,
+        note_id, judgment code), or None if the server closed the
+        connection. """
+        while True:
+            message = await self.read_message()
+            if message is None:
+                return None
+            message_type, message_bytes = message
+            if message_type == HIT:
+                return decode_hit(message_bytes)
+            if message_type == TIME_RESPONSE:
+                self.sync.receive(message_bytes)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
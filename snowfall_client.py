@@ -20,8 +20,17 @@ import time
 from gamestate import Gamestate
 from stats import Stats
 from client import Client
+from gameclock import GameClock, DEFAULT_FPS, DEFAULT_INPUT_HZ
+from assetmanager import AssetManager
+from frameprofile import FrameProfiler
+from notetable import JUDGMENT_CODE, NO_JUDGMENT, judgment_name
+from chartcache import ContentCache
+from clocksync import ClockSync, RESYNC_INTERVAL
+from protocol import HIT, NO_PLAYER, TIME_RESPONSE, encode_hit, decode_hit, \
+    read_message, recv_exact, send_all
 import threading
 import pickle
+import queue
 
 def main():
     # create a socket object
@@ -35,9 +44,40 @@ def main():
     parser.add_argument('--port', type=int, required=True, 
                         help='Server port number')
     parser.add_argument('--chart', type=str, default='./charts/basic.chart', 
-                        help='Path to the chart file.')
+                        help='Path to the chart file, if the server does not '
+                             'send one.')
+    parser.add_argument('--chart-cache', type=str, default='./chart-cache', 
+                        help='Directory to keep charts and songs the server '
+                             'sends in.')
     parser.add_argument('--name', type=str, required=True, help='Client name')
+    parser.add_argument('--dirty-rects', action='store_true', 
+                        help='Only redraw the parts of the screen that change '
+                             'each frame (faster on slow machines).')
+    parser.add_argument('--fps', type=int, default=DEFAULT_FPS, 
+                        help='Target frame rate (0 draws every input step).')
+    parser.add_argument('--vsync', action='store_true', 
+                        help='Wait for the display to refresh when flipping, '
+                             'drawing once per refresh instead of at --fps. '
+                             'Input is still handled between frames, but the '
+                             'step that flips can be late by up to one '
+                             'refresh.')
+    parser.add_argument('--input-hz', type=int, default=DEFAULT_INPUT_HZ, 
+                        help='How many times a second input is handled.')
+    parser.add_argument('--asset-cache', type=str, default=None, 
+                        help='Directory to cache the packed image atlas in.')
+    parser.add_argument('--flush-window', type=float, default=0, 
+                        help='Milliseconds to wait after a hit for more hits '
+                             'to send along with it.')
+    parser.add_argument('--profile-frames', type=str, nargs='?', default=None,
+                        const='frame-trace.json', metavar='TRACE_FILE',
+                        help='Time every part of every frame, print a summary '
+                             'at the end of the song and write a Chrome trace '
+                             'to TRACE_FILE (default frame-trace.json).')
     args = parser.parse_args()
+    if args.input_hz <= 0:
+        parser.error("--input-hz must be positive")
+    if args.fps < 0:
+        parser.error("--fps can't be negative")
 
     # assign host and port from arguments
     host = args.host
@@ -47,6 +87,10 @@ def main():
 
     stop_event = threading.Event()
 
+    # load images in the background while we talk to the server
+    assets = AssetManager(cache_dir=args.asset_cache)
+    assets.start()
+
     # connect to the server
     try:
         server_socket.connect((host, port))
@@ -67,31 +111,52 @@ def main():
     data = server_socket.recv(1024)  
     server_socket.send(b"ACK")
 
-    # ping for latency
+    # get the server's chart and song, unless we already have them
+    try:
+        fetched = ContentCache(args.chart_cache).fetch(server_socket)
+    except (OSError, ValueError) as e:
+        print(f"Error getting the chart from the server: {e}", 
+              file=sys.stderr)
+        sys.exit(1)
+    chartfile = fetched.get("chart", chartfile)
+    audio_path = fetched.get("audio")
+    print(f"Playing chart {chartfile}")
+
+    # sync our clock with the server's
+    sync = ClockSync()
     data = server_socket.recv(5)  
-    if data:
-        server_socket.send(b"pong!")
+    if data and sync.handshake(server_socket):
+        print(f"Clock offset {1000 * sync.offset:.2f} ms "
+              f"(+/- {1000 * sync.error():.2f} ms)")
+    else:
+        print("Could not sync clock with the server.", file=sys.stderr)
 
-    # receive the future time from the server
-    data = server_socket.recv(8)  
-    if data:
+    # receive the future time from the server (on its clock)
+    data = recv_exact(server_socket, 8)  
+    if len(data) == 8:
         future_time = struct.unpack("!d", data)[0]
         print(f"Received future time: {future_time}")
     server_socket.send(b"ACK")
 
     
     # create client object (runs game)
+    clock = GameClock(future_time, fps=args.fps, input_hz=args.input_hz, 
+                      vsync=args.vsync, sync=sync)
     client_game = Client(name=name, gamestate=Gamestate.empty_gamestate(), 
-                         starttime=future_time)
+                         starttime=future_time, dirty_rects=args.dirty_rects, 
+                         clock=clock, assets=assets, 
+                         profiler=FrameProfiler() if args.profile_frames 
+                                  else None)
     client_game.set_socket(server_socket)  
     
     # start threads for sending and receiving messages
     receive_thread = threading.Thread(target=receive_messages, 
                                       args=[server_socket, name, 
-                                            client_game, stop_event])
+                                            client_game, stop_event, sync])
     send_thread = threading.Thread(target=send_messages, 
                                    args=[server_socket, name, client_game, 
-                                         stop_event])
+                                         stop_event, args.flush_window / 1000, 
+                                         sync])
     # this helps prevent errors with sockets passing messages around
     receive_thread.daemon = True
     send_thread.daemon = True
@@ -100,24 +165,34 @@ def main():
     send_thread.start()
     # gameplay!
     # returns when song is over (really, when we reach "end" time in the chart)
-    client_game.client_init(chartfile)
+    client_game.client_init(chartfile, audio_path)
+    if client_game.profiler is not None:
+        print(client_game.profiler.summary())
+        client_game.profiler.write_trace(args.profile_frames)
+        print(f"Wrote frame trace to {args.profile_frames}")
     # tell listener and sender threads to wrap up
     stop_event.set()
-    # end threads
+    # end threads. shutdown wakes up the receive thread if it's blocked on
+    # recv, which close alone doesn't do
+    try:
+        server_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass # server already hung up
     server_socket.close()
     receive_thread.join()
     send_thread.join()
 
 
 
-def receive_messages(server_socket, client_name, client_instance, stop_event):
+def receive_messages(server_socket, client_name, client_instance, stop_event,
+                     sync=None):
     """
     Threading function to receive messages from the server.
     messsage receiving follows this pattern:
-        - recv waits for 4 byte int indicating how much data to receive
-        - then we recv again and wait for that much data
-        - we split up that message (which is always a note confirmation from 
-            the server)
+        - read one fixed-size binary message (see protocol.py)
+        - if it's the answer to a time request, hand it to sync
+        - otherwise it's a note confirmation from the server, so unpack the 
+            note id and judgment code from it
         - use that to call the gameplay client's "receive_hit_confirmation" 
             method
         - repeat
@@ -127,29 +202,23 @@ def receive_messages(server_socket, client_name, client_instance, stop_event):
     """
     while not stop_event.is_set(): # go until told to stop
         try:
-            len_data_bytes = server_socket.recv(4)
-            if not len_data_bytes:
+            message = read_message(server_socket)
+            if message is None:
                 print(f"{client_name}: Connection to server closed \
                        (receiving).")
                 stop_event.set()
                 break
-            message_length = struct.unpack("!I", len_data_bytes)[0]
-            message_bytes = server_socket.recv(message_length)
-            if not message_bytes:
-                print(f"{client_name}: Connection to server closed \
-                       (receiving).")
-                stop_event.set()
-                break
-            message = message_bytes.decode('utf-8')
-            try:
-                # first split is client id, which we don't care about
-                _, note_id, note_judgment = message.split(", ")
-                note_id = int(note_id.strip())
-                note_judgment = note_judgment.strip()
-            except ValueError as e:
-                print(f"Error parsing message: {e}", file=sys.stderr)
+            message_type, message_bytes = message
+            if message_type == TIME_RESPONSE:
+                if sync is not None:
+                    sync.receive(message_bytes)
                 continue
-            client_instance.receive_hit_confirmation(note_id, note_judgment)
+            if message_type != HIT:
+                continue
+            # first field is the player who hit it, which we don't care about
+            _, note_id, note_judgment = decode_hit(message_bytes)
+            client_instance.receive_hit_confirmation(
+                note_id, judgment_name(note_judgment))
         except Exception as e:
             msg = str(e)
             # server has stopped
@@ -160,38 +229,72 @@ def receive_messages(server_socket, client_name, client_instance, stop_event):
                 print(f"{client_name}: Error receiving message: {e}")
             break
 
-def send_messages(server_socket, client_name, client, stop_event):
+def send_messages(server_socket, client_name, client, stop_event, 
+                  flush_window=0, sync=None):
     """
     Threading function to send messages to the server.
     messsage sending follows this pattern:
-        - whenever 
-        - send 4 byte int indicating how much data to receive
-        - send that much data
-        - we split up that message (which is always a note confirmation from 
-            the server)
-        - use that to call the gameplay client's "receive_hit_confirmation" 
-            method
+        - wait until the gameplay client puts a hit in the outbox, or until
+            it's time to send sync another time sample (every 
+            RESYNC_INTERVAL seconds)
+        - optionally wait flush_window more seconds, so hits that come right 
+            after it (chords, a run of misses) go out in the same batch
+        - take everything that is in the outbox, keeping only the best 
+            judgment for each note
+        - pack each into a fixed-size binary hit message (see protocol.py)
+        - send the whole batch in one write, with a time request at the end
+            if one is due
         - repeat
-    This repeats until told to stop by "stop_event." If any recv fails, this is
+    This repeats until told to stop by "stop_event." If any send fails, this is
     because the server has stopped for some reason. In that case we break and 
     tell all threads to quit.
     """
-    while not stop_event.is_set():
-        # Check if the recent_id has changed and hasn't been sent before
+    outbox = client.gamestate.outbox
+    done = False
+    next_sync = time.monotonic() + RESYNC_INTERVAL
+    while not stop_event.is_set() and not done:
         try: 
-            item = client.gamestate.outbox.get()
-            if item is None: # quit
-                break
-            note_id, judgment = item # otherwise parse note
-
-            # encode data
-            data_to_send = f"{client_name}, {note_id}, {judgment}".encode()
-
-            # send the length of the data followed by the data itself
-            server_socket.sendall(struct.pack("!I", len(data_to_send)))
-            server_socket.sendall(data_to_send)
-            # done with task in queue
-            client.gamestate.outbox.task_done() 
+            items = []
+            try:
+                # wait for something to send
+                if sync is None:
+                    items.append(outbox.get())
+                else:
+                    items.append(outbox.get(
+                        timeout=max(0, next_sync - time.monotonic())))
+            except queue.Empty:
+                if stop_event.is_set(): # the game ended while we waited
+                    break
+            if flush_window and items and items[0] is not None:
+                time.sleep(flush_window)
+            # drain whatever else is already waiting
+            while True:
+                try:
+                    items.append(outbox.get_nowait())
+                except queue.Empty:
+                    break
+            batch = {} # note id -> judgment code, in the order first seen
+            for item in items:
+                outbox.task_done() 
+                if item is None: # quit, after sending what we have
+                    done = True
+                    continue
+                note_id, judgment = item # otherwise parse note
+                code = JUDGMENT_CODE[judgment]
+                # the same note can be queued more than once (e.g. a miss is
+                # queued every frame until the server confirms it)
+                if code > batch.get(note_id, NO_JUDGMENT):
+                    batch[note_id] = code
+            # encode data; the server knows which player we are
+            messages = [encode_hit(NO_PLAYER, note_id, code)
+                        for note_id, code in batch.items()]
+            if sync is not None and time.monotonic() >= next_sync:
+                # stamped last thing, so it's as close to the send as it gets
+                messages.append(sync.request())
+                next_sync = time.monotonic() + RESYNC_INTERVAL
+            if not messages:
+                continue
+            send_all(server_socket, messages)
         except Exception as e:
             print(f"Error sending message: {e}")
             break
@@ -25,6 +25,20 @@ from gamestate import Gamestate
 from stats import Stats
 import time
 import select
+from notetable import JUDGMENTS
+from chartprep import ChartError
+from protocol import HIT, NO_PLAYER, TIME_REQUEST, ProtocolError, \
+    encode_hit, decode_hit, read_message
+import chartcache
+import clocksync
+from clocksync import HANDSHAKE_SAMPLES
+import asyncio
+import async_server
+import lobby
+from metrics import Metrics, MetricsRegistry, serve_metrics, \
+    socket_backlog
+import os
+from replaylog import ReplayRecorder
 
 def main():
     # arg parsing for server
@@ -35,21 +49,97 @@ def main():
                         help='Port to bind the server to.')
     parser.add_argument('--chart', type=str, default='./charts/basic.chart', 
                         help='Path to the chart file.')
+    parser.add_argument('--players', type=int, default=2, 
+                        help='Players per match (or per room in the lobby).')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], 
+                        default='threads', 
+                        help='Threads + select, or one asyncio event loop.')
+    parser.add_argument('--max-backlog', type=int, 
+                        default=async_server.DEFAULT_MAX_BACKLOG, 
+                        help='Unsent bytes to hold for one client before '
+                             'dropping it (asyncio engine and lobby only).')
+    parser.add_argument('--lobby', action='store_true', 
+                        help='Keep accepting players and run many matches '
+                             'at once, in rooms.')
+    parser.add_argument('--room-charts', type=str, nargs='+', default=None, 
+                        help='Charts rooms take turns playing (lobby only; '
+                             'defaults to --chart).')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, 
+                        help='Worker threads rooms are spread over (lobby '
+                             'only).')
+    parser.add_argument('--metrics-port', type=int, default=None, 
+                        help='Serve Prometheus metrics over HTTP on this '
+                             'port, at /metrics.')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1', 
+                        help='Host to serve metrics on.')
+    parser.add_argument('--trace-every', type=int, default=0, 
+                        help='Trace one hit in this many, served at /traces '
+                             'with --metrics-port (0 traces none).')
+    parser.add_argument('--record', type=str, default=None, 
+                        help='Record the match to this file (in the lobby, '
+                             'a directory to record every room to).')
     args = parser.parse_args()
+    # player numbers have to fit in a hit message, and NO_PLAYER is taken
+    if not 1 <= args.players < NO_PLAYER:
+        parser.error(f"--players must be between 1 and {NO_PLAYER - 1}")
 
     host = args.host
     port = args.port
 
+    # every server's metrics, served over HTTP if asked for
+    registry = MetricsRegistry()
+    if args.metrics_port is not None:
+        serve_metrics(registry, args.metrics_host, args.metrics_port)
+
+    if args.lobby:
+        # many matches at once, forever
+        try:
+            room_lobby = lobby.Lobby(host, port, 
+                                     args.room_charts or [args.chart], 
+                                     players_per_room=args.players, 
+                                     workers=args.workers, 
+                                     max_backlog=args.max_backlog, 
+                                     registry=registry, 
+                                     trace_every=args.trace_every, 
+                                     record_dir=args.record)
+        except ChartError as e:
+            print(f"Error: can't play chart: {e}", file=sys.stderr)
+            sys.exit(1)
+        try:
+            room_lobby.serve_forever()
+        finally:
+            room_lobby.shutdown()
+        return
+
+    # creating server object
+    server = Server(stats=Stats.empty_stats(), 
+                    gamestate=Gamestate.empty_gamestate(), 
+                    num_players=args.players, 
+                    metrics=Metrics(args.trace_every)) 
+    registry.add(server.metrics)
+    try:
+        server.parse_chart(args.chart)
+    except ChartError as e:
+        print(f"Error: can't play {args.chart}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.record is not None:
+        server.recorder = ReplayRecorder(args.record)
+
+    if args.engine == 'asyncio':
+        # one event loop handles every connection
+        asyncio.run(async_server.serve(server, host, port, 
+                                       num_players=args.players, 
+                                       max_backlog=args.max_backlog))
+        if server.recorder is not None:
+            server.recorder.close(server)
+        print_results(server)
+        return
+
     # initializing server socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind((host, port))
     server_socket.listen(5)
     print(f"Server started on {host}:{port}")
-
-    # creating server object
-    server = Server(stats=Stats.empty_stats(), 
-                    gamestate=Gamestate.empty_gamestate()) 
-    server.parse_chart(args.chart)
     
     # connecting clients
     clients_lock = threading.Lock()
@@ -57,22 +147,33 @@ def main():
     client_names = {}
     client_threads = []
 
-    while len(clients) < 2: 
+    while len(clients) < args.players: 
         client_socket, client_address = server_socket.accept()
         print(f"Accepted connection from {client_address}")
         with clients_lock:
             clients[client_socket] =  ("", "")
     
     # tell clients we accepted them, then wait for them to send their names
-    # send a time 2 seconds into the future so that we can start syncing then
-    future_time = time.time() + 3  # Current time + 2 seconds
-
     # start client connecting threads
     for client_socket in list(clients.keys()):  
         thread = threading.Thread(target=connect_client, 
                                   args=[clients, client_socket, 
-                                        clients_lock, future_time, 
-                                        client_names])
+                                        clients_lock, client_names, 
+                                        server.blobs])
+        client_threads.append(thread)
+        thread.start()
+    
+    for thread in client_threads:
+        thread.join()
+
+    # everyone has the chart now (which can take a while to send), so send a
+    # time 3 seconds into the future so that we can start syncing then
+    future_time = time.time() + 3
+    client_threads = []
+    for client_socket in list(clients.keys()):  
+        thread = threading.Thread(target=send_start_time, 
+                                  args=[clients, client_socket, 
+                                        clients_lock, future_time])
         client_threads.append(thread)
         thread.start()
     
@@ -80,30 +181,33 @@ def main():
         thread.join()
     
     # run gameplay processing on main thread
+    if server.recorder is not None:
+        server.recorder.begin(server, future_time)
     gameplay(clients, server)
+    if server.recorder is not None:
+        server.recorder.close(server)
     
     # print stats to terminal after gameplay
-    notes = server.gamestate.notes["notes"]
+    print_results(server)
+    
+    # close the server socket
+    server_socket.close()
 
+def print_results(server):
+    """ Print the final score, max combo and judgment counts. """
     labels = [
         "Excellent", "Very Good", "Good", "Fair", "Poor", "No Credit"
     ]
 
-    counts = {
-        lab: sum(n["judgment"] == lab for n in notes)
-        for lab in labels
-    }
+    counts = server.gamestate.notes.count_judgments()
 
     print(f"Final score: {server.gamestate.score}")
     print(f"Max combo  : {server.stats.max_combo}")
 
     for lab in labels:
         print(f"{lab:<11}: {counts[lab]}")
-    
-    # close the server socket
-    server_socket.close()
 
-def connect_client(clients, client, clients_lock, future_time, name_array):
+def connect_client(clients, client, clients_lock, name_array, blobs):
     """
     Handles the connection process for a client in the server-client 
     architecture. This function performs the following steps:
@@ -112,9 +216,12 @@ def connect_client(clients, client, clients_lock, future_time, name_array):
         client's information.
     3. Sends a connection acknowledgment to the client and waits for the client
         to acknowledge.
-    4. Measures the round-trip time (ping) between the server and the client.
-    5. Sends a future time value to the client, adjusted by the measured ping, 
-        and waits for acknowledgment.
+    4. Offers the client our chart and audio (blobs), and sends whichever 
+        ones it doesn't have yet (see chartcache.py).
+    5. Answers the client's time requests so it can work out how far its 
+        clock is from ours (see clocksync.py), and measures round-trip time.
+    The start time is sent afterwards by send_start_time, once every client
+    is done with this.
     
     - If the client disconnects or fails to respond at any step, the client is 
         removed from the `clients` dictionary.
@@ -162,28 +269,59 @@ def connect_client(clients, client, clients_lock, future_time, name_array):
         print(f"{client_name} did not acknowledge connection!", file=sys.stderr)
         return
 
-    # get round-trip time by pinging
-    ping = time.time()
-    client.sendall("ping!".encode('utf-8'))
-    ack_pong = recv_data(client, 5)
-    pong = time.time() - ping
-    if not ack_pong:
-        print(f"{client_name} disconnected before ponging server ping.", 
+    # hand over the chart and audio, if the client doesn't have them already
+    try:
+        sent = chartcache.offer(client, blobs)
+    except (OSError, ValueError) as e:
+        print(f"Error sending the chart to {client_name}: {e}", 
+              file=sys.stderr)
+        sent = None
+    if sent is None:
+        print(f"{client_name} disconnected before getting the chart.", 
               file=sys.stderr)
         with clients_lock:
             del clients[client]
         return
-    ack = ack_pong.decode('utf-8').strip()
-    if ack != "pong!":
-        print(f"{client_name} did not acknowledge ping!", file=sys.stderr)
+    if sent:
+        print(f"Sent {', '.join(sent)} to {client_name}")
+
+    # sync clocks: the client sends time requests and we answer each one
+    client.sendall("ping!".encode('utf-8'))
+    rtt = None
+    answered = None # when we answered the last request
+    for _ in range(HANDSHAKE_SAMPLES):
+        try:
+            message = read_message(client)
+        except ProtocolError as e:
+            message = None
+            print(f"{client_name} sent a bad time request: {e}", 
+                  file=sys.stderr)
+        received = time.time()
+        if message is None or message[0] != TIME_REQUEST:
+            print(f"{client_name} disconnected before syncing clocks.", 
+                  file=sys.stderr)
+            with clients_lock:
+                del clients[client]
+            return
+        # the client asks again as soon as it hears back, so the time from 
+        # one answer to the next request is about one round trip
+        if answered is not None and (rtt is None or received - answered < rtt):
+            rtt = received - answered
+        client.sendall(clocksync.answer(message[1], received))
+        answered = time.time()
     # update client information with new RTT
     with clients_lock:
         client_name, _ = clients[client]
-        clients[client] = (client_name, pong)
-        print(f"{client_name} has ping {pong}")
+        clients[client] = (client_name, rtt)
+        print(f"{client_name} has ping {rtt}")
 
-    # pack the time as a double
-    future_time_bytes = struct.pack("!d", future_time + pong) 
+def send_start_time(clients, client, clients_lock, future_time):
+    """ Sends the future start time (on our clock) to a client that finished
+    connect_client, and waits for acknowledgment. """
+    client_name, _ = clients[client]
+    # pack the time as a double. Clients convert it to their own clocks with
+    # the offset they just measured, so everyone starts at the same moment
+    future_time_bytes = struct.pack("!d", future_time) 
 
     # send the future time to the client
     client.sendall(future_time_bytes)  
@@ -203,63 +341,86 @@ def connect_client(clients, client, clients_lock, future_time, name_array):
 
 def gameplay(clients, server):
     """ Gameplay logic. Listens for client note hits and then informs clients 
-    when to not draw notes anymore."""
+    when to not draw notes anymore. This thread owns server: hits are queued
+    with push_hit as they're read and applied together after every select, 
+    so scoring never needs a lock."""
     client_sockets = list(clients.keys())
-    # ensure two players are connected
-    if len(client_sockets) != 2:
+    # ensure every player is connected
+    if len(client_sockets) != server.num_players:
         print("Error: Not enough clients to start gameplay.", file=sys.stderr)
         return
+    # players are numbered in the order they connected
+    players = {sock: index for index, sock in enumerate(client_sockets)}
+    metrics = server.metrics
+    for sock, index in players.items():
+        name, rtt = clients[sock]
+        metrics.add_client(index, name, rtt, socket_backlog(sock))
+    failed = [] # sockets we couldn't send to
+
+    def drop(sock):
+        """ Forget about a client. Returns False once nobody is left. """
+        # this pattern is to ensure that we never send anything to this 
+        # client ever again after it disconnects
+        if sock in clients:
+            del clients[sock] 
+            client_sockets.remove(sock)
+            metrics.drop_client(players[sock])
+        if not client_sockets:
+            print("All clients disconnected. Ending gameplay.")
+            return False
+        return True
+
+    def broadcast(player, note_id, code):
+        # stamp who hit it, then tell all clients that a note was hit -- the 
+        # same encoded bytes go to everyone
+        message = encode_hit(player, note_id, code)
+        for soc in client_sockets: 
+            try:
+                soc.sendall(message)
+            except OSError:
+                failed.append(soc)
+        metrics.sent(len(message), len(client_sockets))
 
     while True:
         # wait until a socket has a message to parse
         readable, _, _ = select.select(client_sockets, [], [], 0.01)  
         for sock in readable:
             try:
-                # get data length
-                len_data_bytes = recv_data(sock, 4)
-                if not len_data_bytes: # client DC
+                # get one whole message
+                message = read_message(sock)
+                if message is None: # client DC
                     print(f"Client {clients[sock]} disconnected.", 
                           file=sys.stderr)
-                    # this pattern is to ensure that we never send anything to 
-                    # this client ever again after it disconnects
-                    del clients[sock] 
-                    client_sockets.remove(sock)
-                    if not client_sockets:
-                        print("All clients disconnected. Ending gameplay.")
+                    if not drop(sock):
                         return
                     continue
-                length = struct.unpack("!I", len_data_bytes)[0]
-
-                # get "length" much data
-                data_bytes = recv_data(sock, length)
-                if not data_bytes: # client DC
-                    print(f"Client {clients[sock]} disconnected during \
-                          message.", file=sys.stderr)
-                    del clients[sock]
-                    client_sockets.remove(sock)
-                    if not client_sockets:
-                        print("All clients disconnected. Ending gameplay.")
-                        return
-                message = data_bytes.decode('utf-8').strip()
+                message_type, message_bytes = message
+                if message_type == TIME_REQUEST:
+                    metrics.received("time_request", len(message_bytes))
+                    # answer right away, so the client's sample is accurate
+                    answer = clocksync.answer(message_bytes, time.time())
+                    sock.sendall(answer)
+                    metrics.sent(len(answer))
+                    continue
+                if message_type != HIT:
+                    metrics.received("bad", len(message_bytes))
+                    continue
                 
                 # Parse the received message
-                try:
-                    # first is client ID and we don't care
-                    _, note_id, note_judgment = message.split(", ") 
-                    note_id = int(note_id.strip())
-                    note_judgment = note_judgment.strip()
-                except ValueError as e:
-                    print(f"Error parsing message from {clients[sock]}: {e}", 
+                # first is the player index, which the client doesn't know
+                _, note_id, note_judgment = decode_hit(message_bytes)
+                if not server.has_note(note_id) or \
+                        not 0 <= note_judgment < len(JUDGMENTS):
+                    print(f"Error parsing message from {clients[sock]}: "
+                          f"bad note {note_id} or judgment {note_judgment}", 
                           file=sys.stderr)
+                    metrics.received("bad", len(message_bytes))
                     continue
-                # Update server gamestate with received data
-                notify = server.receive_score(note_id, note_judgment)  
-                if notify:
-                    message = message.encode('utf-8')
-                    # tell all clients that a note was hit
-                    for soc in client_sockets: 
-                        soc.sendall(struct.pack("!I", len(message)))
-                        soc.sendall(message)
+                metrics.received("hit", len(message_bytes))
+                # Queue it up for the server
+                if not server.push_hit(note_id, note_judgment, players[sock]):
+                    server.apply_hits(broadcast)
+                    server.push_hit(note_id, note_judgment, players[sock])
             # if we got some error, treat it as client DC (which it is)
             except Exception as e:
                 # this handles the error that shows up when a client 
@@ -270,17 +431,23 @@ def gameplay(clients, server):
                     print(f"Error handling client {clients[sock]}: {e}", 
                           file=sys.stderr)
                 # again make sure we never send anything to this client ever 
-                del clients[sock] 
-                client_sockets.remove(sock)
-                if not client_sockets: 
-                    print("All clients disconnected. Ending gameplay.")
+                if not drop(sock):
                     return
+        # Update server gamestate with everything received this round
+        server.apply_hits(broadcast)
+        while failed:
+            sock = failed.pop()
+            if sock in clients:
+                print(f"Error sending to client {clients[sock]}.", 
+                      file=sys.stderr)
+            if not drop(sock):
+                return
 
 def recv_data(client, length):
     """ Receives data over sockets of given length. This was originally 
     implemented because we were planning to send a lot more data (charts and 
-    mp3 files) over the sockets, but we scrapped this. This function still 
-    works for smaller data lengths, but normal recv would work just fine too."""
+    mp3 files) over the sockets. Those are sent by chartcache now, straight 
+    from disk, so this is only used for the small handshake messages."""
     data = b""
     while len(data) < length:
         packet = client.recv(length - len(data))
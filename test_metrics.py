@@ -0,0 +1,41 @@
+# test_metrics.py
+# CS21 Concurrent Programming
+# Final Project -- Snowfall
+# Team Snowfall -- Stephanie Wilson, Rachel Bonanno, Justin Millette
+#
+# Tests for the /metrics exposition in metrics.py. Run with
+# python -m pytest, or python -m unittest test_metrics.
+
+import unittest
+from metrics import Metrics, MetricsRegistry
+
+
+class LabelEscapingTest(unittest.TestCase):
+    def render_with_name(self, name):
+        registry = MetricsRegistry()
+        metrics = Metrics()
+        metrics.add_client(0, name, 0.001)
+        registry.add(metrics, room=1)
+        return registry.render()
+
+    def test_hostile_name_is_escaped(self):
+        # quotes, backslashes and a newline trying to start a fake series
+        name = 'evil\\"} 1\nsnowfall_fake{x="y'
+        text = self.render_with_name(name)
+        connected = [line for line in text.splitlines()
+                     if line.startswith("snowfall_client_connected{")]
+        self.assertEqual(connected, [
+            'snowfall_client_connected{room="1",player="0",'
+            'name="evil\\\\\\"} 1\\nsnowfall_fake{x=\\"y"} 1'])
+        # no line of the scrape is the injected series
+        self.assertFalse(any(line.startswith("snowfall_fake")
+                             for line in text.splitlines()))
+
+    def test_plain_name_is_unchanged(self):
+        text = self.render_with_name("alice")
+        self.assertIn('snowfall_client_connected{room="1",player="0",'
+                      'name="alice"} 1', text)
+
+
+if __name__ == "__main__":
+    unittest.main()